@@ -0,0 +1,5 @@
+"""
+Benchmarks for python-canada-post. Run each module with python -m, e.g.
+
+    python -m benchmarks.templates
+"""
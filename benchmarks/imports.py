@@ -0,0 +1,112 @@
+"""
+Import time of the package entry points, measured with `python -X importtime`
+in a fresh interpreter (python 3.7+), and the heavy dependencies each one
+loads. Importing the utilities, the cache, canada_post.service or
+canada_post.api, or creating a CanadaPostAPI or a RetryPolicy, mustn't load
+lxml or requests: the services and the session import them on first use.
+
+    python -m benchmarks.imports [runs]
+
+The exit status is 1 if one of the light entry points loads a heavy module,
+which tests/test_imports.py checks too. benchmarks.suite includes these
+results, so they're compared with its --baseline
+"""
+import subprocess
+import sys
+
+# modules that are only needed once a request is built, sent or parsed
+HEAVY = ("lxml", "requests", "urllib3", "numpy", "aiohttp")
+
+# (name, statement, whether it must stay clear of the HEAVY modules)
+ENTRY_POINTS = (
+    ('util', "import canada_post.util.parcel, canada_post.util.address", True),
+    ('cache', "import canada_post.cache", True),
+    # where the Service class passed to create_shipment comes from
+    ('service', "import canada_post.service", True),
+    ('retry', "from canada_post.retry import RetryPolicy\n"
+              "RetryPolicy()", True),
+    ('api', "import canada_post.api", True),
+    ('client', "from canada_post.api import CanadaPostAPI\n"
+               "CanadaPostAPI('1234567', 'user', 'pass')", True),
+    # what the first GetRates call pays, for reference
+    ('rating', "import canada_post.service.rating", False),
+)
+
+_MARKER = "-- canada_post --"
+
+_SCRIPT = """import sys
+sys.stderr.write({marker!r} + "\\n")
+{statement}
+sys.stdout.write(" ".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+def measure(statement):
+    """
+    Run `statement` in a new interpreter. Returns the microseconds spent
+    importing, as reported by -X importtime, the number of modules imported
+    and the HEAVY modules loaded
+    """
+    script = _SCRIPT.format(marker=_MARKER, statement=statement, heavy=HEAVY)
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c",
+                                script], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError("{0!r} failed:\n{1}".format(statement, err))
+    # the interpreter's own startup imports come before the marker
+    lines = err.split(_MARKER, 1)[1].splitlines()
+    total = modules = 0
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip() == "cumulative":
+            continue
+        modules += 1
+        if not name[1:].startswith(" "):
+            # top level, its cumulative time includes the nested imports
+            total += int(cumulative)
+    return total, modules, out.split()
+
+def run(runs=5):
+    """
+    {name: {'import_us', 'modules', 'heavy'}} for every entry point, the
+    fastest of `runs`
+    """
+    results = {}
+    for name, statement, _ in ENTRY_POINTS:
+        times = []
+        for _ in range(runs):
+            total, modules, heavy = measure(statement)
+            times.append(total)
+        results[name] = {
+            'import_us': min(times),
+            'modules': modules,
+            'heavy': heavy,
+        }
+    return results
+
+def violations(results):
+    """
+    (name, heavy modules) of the light entry points that load heavy modules
+    """
+    return [(name, results[name]['heavy'])
+            for name, _, light in ENTRY_POINTS
+            if light and results[name]['heavy']]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    runs = int(argv[0]) if argv else 5
+    results = run(runs)
+    for name, _, _ in ENTRY_POINTS:
+        result = results[name]
+        print("{0:<7} {1:>9.1f}ms  {2:>4} modules  {3}".format(
+            name, result['import_us'] / 1e3, result['modules'],
+            " ".join(result['heavy']) or "-"))
+    for name, heavy in violations(results):
+        print("HEAVY IMPORT {0}: {1}".format(name, " ".join(heavy)))
+    return 1 if violations(results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
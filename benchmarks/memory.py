@@ -0,0 +1,118 @@
+"""
+Memory used per rate quote (a Service with its Price and two Adjustments) and
+per Parcel/Origin/Destination, with the slotted value objects against the
+original __dict__ based ones.
+
+    python -m benchmarks.memory [count]
+"""
+import sys
+import tracemalloc
+from decimal import Decimal
+
+from canada_post.service import Service
+from canada_post.util.address import Destination
+from canada_post.util.money import Price, Adjustment
+from canada_post.util.parcel import Parcel
+
+class LegacyInfoObject(object):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+class LegacyAdjustment(LegacyInfoObject):
+    pass
+
+class LegacyPrice(LegacyInfoObject):
+    def __init__(self, due, base, gst, gst_pc, pst, pst_pc, hst, hst_pc,
+                 adjustments):
+        self.due = due
+        self.base = base
+        self.gst = gst
+        self.gst_pc = gst_pc
+        self.pst = pst
+        self.pst_pc = pst_pc
+        self.hst = hst
+        self.hst_pc = hst_pc
+        self.tax_total = gst + pst + hst
+        self.adjustments = adjustments
+        self.adjustment_total = sum(adj.cost for adj in adjustments)
+
+class LegacyService(object):
+    def __init__(self, data):
+        self.code = data['code']
+        self.link = data['link']
+        self.name = data['name']
+        self.price = data['price']
+
+class LegacyParcel(LegacyInfoObject):
+    pass
+
+class LegacyDestination(LegacyInfoObject):
+    pass
+
+def make_quote(index, service_class, price_class, adjustment_class):
+    adjustments = [
+        adjustment_class(code="FUELSC", name="Fuel surcharge",
+                         cost=Decimal("1.23"), percent="17.75"),
+        adjustment_class(code="AUTDISC", name="Automation discount",
+                         cost=Decimal("-0.29"), percent="3.000"),
+    ]
+    price = price_class(due=Decimal(index), base=Decimal("9.59"),
+                        gst=Decimal("0.56"), gst_pc=Decimal("5.00"),
+                        pst=Decimal("1.12"), pst_pc=Decimal("9.975"),
+                        hst=Decimal("0.00"), hst_pc=Decimal("0"),
+                        adjustments=adjustments)
+    return service_class(data={'code': "DOM.EP", 'link': {}, 'name': "EP",
+                               'price': price})
+
+def make_address(index, destination_class):
+    # AddressBase normalizes the postal code into a new string, do the same
+    #  for the legacy class
+    postal_code = "k1a 0b1".replace(" ", "").upper()
+    return destination_class(country_code="CA", postal_code=postal_code,
+                             name="Name", company=None, phone=None,
+                             address1="12 Main St", address2="", city="Ottawa",
+                             province="ON", extra=None)
+
+def make_parcel(index, parcel_class):
+    return parcel_class(weight=index, length=10, width=20, height=30,
+                        unpackaged=False)
+
+def bytes_per_object(factory, count):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objects = [factory(index) for index in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del objects
+    return float(used) / count
+
+def bench(count):
+    cases = [
+        ("quote", lambda i: make_quote(i, LegacyService, LegacyPrice,
+                                       LegacyAdjustment),
+         lambda i: make_quote(i, Service, Price, Adjustment)),
+        ("parcel", lambda i: make_parcel(i, LegacyParcel),
+         lambda i: make_parcel(i, Parcel)),
+        ("destination", lambda i: make_address(i, LegacyDestination),
+         lambda i: make_address(i, _destination)),
+    ]
+    results = {}
+    for name, before, after in cases:
+        results[name] = {
+            'before': bytes_per_object(before, count),
+            'after': bytes_per_object(after, count),
+        }
+        print("{name:<12} before {before:7.0f} B, after {after:7.0f} B "
+              "({ratio:.0%})".format(name=name, ratio=results[name]['after'] /
+                                     results[name]['before'],
+                                     **results[name]))
+    return results
+
+def _destination(country_code, postal_code, address1, address2, extra,
+                 **kwargs):
+    return Destination(country_code, extra=extra, postal_code=postal_code,
+                       address=(address1, address2), **kwargs)
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
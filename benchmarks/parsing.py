@@ -0,0 +1,145 @@
+"""
+Compare canada_post.service.parsing with the original namespace-stripping
+parser on synthetic GetRates responses of growing size, and check they agree.
+
+    python -m benchmarks.parsing [iterations]
+"""
+import io
+import sys
+import timeit
+import tracemalloc
+
+from lxml import etree
+
+from canada_post.service import Service
+from canada_post.service.parsing import (parse_rates, iter_rates,
+                                         RATE_NAMESPACE)
+from canada_post.util.money import Price, Adjustment, get_decimal
+
+QUOTE = (
+    u"<price-quote>"
+    u"<service-code>{code}</service-code>"
+    u'<service-link rel="service" '
+    u'href="https://ct.soa-gw.canadapost.ca/rs/ship/service/{code}?country=CA"'
+    u' media-type="application/vnd.cpc.ship.rate-v2+xml"/>'
+    u"<service-name>Service {index}</service-name>"
+    u"<price-details>"
+    u"<base>{base}</base>"
+    u'<taxes><gst percent="5.00">0.56</gst><pst percent="9.975">1.12</pst>'
+    u'<hst percent="0">0.00</hst></taxes>'
+    u"<due>{due}</due>"
+    u"<options><option><option-code>DC</option-code>"
+    u"<option-name>Delivery confirmation</option-name>"
+    u"<option-price>0</option-price></option></options>"
+    u"<adjustments>"
+    u"<adjustment><adjustment-code>FUELSC</adjustment-code>"
+    u"<adjustment-name>Fuel surcharge</adjustment-name>"
+    u"<adjustment-cost>1.23</adjustment-cost>"
+    u"<qualifier><percent>17.75</percent></qualifier></adjustment>"
+    u"<adjustment><adjustment-code>AUTDISC</adjustment-code>"
+    u"<adjustment-name>Automation discount</adjustment-name>"
+    u"<adjustment-cost>-0.29</adjustment-cost>"
+    u"<qualifier><percent>3.000</percent></qualifier></adjustment>"
+    u"</adjustments>"
+    u"</price-details>"
+    u"<weight-details/>"
+    u"<service-standard><am-delivery>false</am-delivery>"
+    u"<guaranteed-delivery>true</guaranteed-delivery>"
+    u"<expected-transit-time>{index}</expected-transit-time>"
+    u"<expected-delivery-date>2026-10-20</expected-delivery-date>"
+    u"</service-standard>"
+    u"</price-quote>")
+
+def rates_response(quotes):
+    """
+    A GetRates response body with the given number of quotes
+    """
+    body = u"".join(QUOTE.format(code="DOM.S{0}".format(index), index=index,
+                                 base=u"{0}.59".format(10 + index % 50),
+                                 due=u"{0}.21".format(12 + index % 50))
+                    for index in range(quotes))
+    return (u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<price-quotes xmlns="{ns}">{body}</price-quotes>'
+            .format(ns=RATE_NAMESPACE, body=body)).encode("utf-8")
+
+def _legacy_price(xml):
+    due = get_decimal(xml.find("due").text)
+    base = get_decimal(xml.find("base").text)
+    taxes = {}
+    for name in ("gst", "pst", "hst"):
+        tax = xml.find("taxes/" + name)
+        taxes[name] = get_decimal(tax.text)
+        taxes[name + "_pc"] = get_decimal(tax.get("percent"))
+    adjustments = [Adjustment(xml_source=adj)
+                   for adj in xml.findall("adjustments/adjustment")]
+    return Price(due=due, base=base, adjustments=adjustments, **taxes)
+
+def legacy_parse(content):
+    """
+    The namespace-stripping parser the parsing module replaced
+    """
+    restree = etree.XML(content.replace(b' xmlns="', b' xmlnamespace="'))
+    services = []
+    for xml in restree.findall("price-quote"):
+        services.append(Service(data={
+            'code': xml.find("service-code").text,
+            'link': dict(xml.find("service-link").attrib),
+            'name': xml.find("service-name").text,
+            'price': _legacy_price(xml.find("price-details")),
+        }))
+    return services
+
+def parse(content):
+    return [Service(data=data) for data in parse_rates(content)]
+
+def iterparse(content):
+    return [Service(data=data) for data in iter_rates(io.BytesIO(content))]
+
+def check(content):
+    expected = [repr(service) for service in legacy_parse(content)]
+    assert [repr(service) for service in parse(content)] == expected
+    assert [repr(service) for service in iterparse(content)] == expected
+
+def peak_memory(func, content):
+    tracemalloc.start()
+    for _ in func(content):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def streaming_peak(content):
+    """
+    Peak memory when consuming iter_rates without keeping the services
+    """
+    tracemalloc.start()
+    for _ in iter_rates(io.BytesIO(content)):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench(iterations):
+    results = {}
+    for quotes in (10, 100, 1000):
+        content = rates_response(quotes)
+        check(content)
+        number = max(1, iterations // quotes)
+        row = {}
+        for name, func in (("legacy", legacy_parse), ("parse_rates", parse),
+                           ("iter_rates", iterparse)):
+            seconds = min(timeit.repeat(lambda: func(content), number=number,
+                                        repeat=3)) / number
+            row[name] = seconds * 1e6 / quotes
+        row['streaming_peak_kb'] = streaming_peak(content) / 1024.0
+        row['parse_peak_kb'] = peak_memory(parse, content) / 1024.0
+        results[quotes] = row
+        print("{quotes:>5} quotes ({size:>7} bytes): legacy {legacy:6.1f} "
+              "us/quote, parse_rates {parse_rates:6.1f} us/quote, iter_rates "
+              "{iter_rates:6.1f} us/quote; peak memory parse_rates "
+              "{parse_peak_kb:.0f} KiB, streaming {streaming_peak_kb:.0f} KiB"
+              .format(quotes=quotes, size=len(content), **row))
+    return results
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
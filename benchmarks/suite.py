@@ -0,0 +1,234 @@
+"""
+Benchmark suite for the request/response hot path of GetRates, CreateShipment
+and VoidShipment, run against a local canada_post.simulator.Simulator.
+
+For each operation it measures
+  * build_us: computing the request's template values
+  * serialize_us: rendering them to the XML body
+  * parse_us: parsing a response body into Service/Shipment/Price objects
+  * alloc_bytes: peak memory allocated by one end-to-end call
+  * rps, p50_ms, p99_ms: end-to-end throughput and latency with `concurrency`
+    concurrent callers
+and the import time of the package entry points (see benchmarks.imports).
+
+Results are written as JSON. Given a previous results file as --baseline, any
+metric that got worse by more than --threshold is reported and the exit
+status is 1, so it can gate upgrades in CI.
+
+    python -m benchmarks.suite --output bench.json [--baseline old.json]
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+from benchmarks import imports
+from canada_post import VERSION
+from canada_post.api import CanadaPostAPI
+from canada_post.batch import run_many
+from canada_post.service import Service
+from canada_post.simulator import Simulator
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel
+
+try:
+    from time import perf_counter
+except ImportError:
+    # python 2
+    from time import time as perf_counter
+
+# metrics where a higher value is better, all the others are lower is better
+HIGHER_IS_BETTER = ("rps",)
+
+PARCEL = Parcel(weight=2, length=30, width=20, height=10)
+ORIGIN = Origin(postal_code="H2B1A0", name="Shipping", company="ACME",
+                phone="514 555 0101", address="1234 Main Street",
+                city="Montreal", province="QC")
+DESTINATION = Destination("CA", postal_code="K1A0B1", name="Jo",
+                          phone="613 555 0100", address="1 Wellington St",
+                          city="Ottawa", province="ON")
+SERVICE = Service(data={'code': "DOM.EP"})
+GROUP = "bench"
+
+def per_call_us(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+def alloc_bytes(func, calls=20):
+    """
+    Average peak of memory allocated by a call to func
+    """
+    peaks = []
+    for _ in range(calls):
+        tracemalloc.start()
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return sum(peaks) / float(len(peaks))
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def end_to_end(func, inputs, concurrency):
+    """
+    Call func for every input tuple with `concurrency` workers, return the
+    throughput and latency percentiles
+    """
+    latencies = []
+
+    def timed(*args):
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    results = list(run_many(timed, inputs, workers=concurrency))
+    elapsed = perf_counter() - start
+    return {
+        'rps': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'errors': sum(1 for result in results if not result.ok),
+    }
+
+def bench_rates(cpa, requests, concurrency, number):
+    get_rates = cpa.get_rates
+    args = (PARCEL, ORIGIN, DESTINATION)
+    values = get_rates.request_values(*args)
+    content = get_rates._send(get_rates.build_request(*args)).content
+    result = {
+        'build_us': per_call_us(lambda: get_rates.request_values(*args),
+                                number),
+        'serialize_us': per_call_us(lambda: get_rates.render(values), number),
+        'parse_us': per_call_us(lambda: get_rates.parse_response(content),
+                                number),
+        'alloc_bytes': alloc_bytes(lambda: get_rates(*args)),
+    }
+    result.update(end_to_end(get_rates, [args] * requests, concurrency))
+    return result
+
+def bench_shipment(cpa, requests, concurrency, number):
+    create = cpa.create_shipment
+    args = (PARCEL, ORIGIN, DESTINATION, SERVICE, GROUP)
+    values = create.request_values(*args)
+    content = create._request('POST', create.get_url(),
+                              data=create.build_request(*args),
+                              headers=create.HEADERS).content
+    result = {
+        'build_us': per_call_us(lambda: create.request_values(*args), number),
+        'serialize_us': per_call_us(lambda: create.render(values), number),
+        'parse_us': per_call_us(lambda: create.parse_response(content),
+                                number),
+        'alloc_bytes': alloc_bytes(lambda: create(*args)),
+    }
+    result.update(end_to_end(create, [args] * requests, concurrency))
+    return result
+
+def bench_void(cpa, requests, concurrency, number):
+    void = cpa.void_shipment
+    create = cpa.create_shipment
+    args = (PARCEL, ORIGIN, DESTINATION, SERVICE, GROUP)
+    shipment = create(*args)
+    result = {
+        'build_us': per_call_us(lambda: void.get_link(shipment), number),
+        'alloc_bytes': alloc_bytes(lambda: void(create(*args))),
+    }
+    # every void needs its own shipment
+    shipments = [(create(*args),) for _ in range(requests)]
+    result.update(end_to_end(void, shipments, concurrency))
+    return result
+
+def run(requests=500, concurrency=8, number=2000, latency=0):
+    with Simulator(latency=latency, seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              "42708517",
+                                              pool_maxsize=concurrency))
+        results = {
+            'rates': bench_rates(cpa, requests, concurrency, number),
+            'shipment': bench_shipment(cpa, requests, concurrency, number),
+            'void': bench_void(cpa, requests, concurrency, number),
+        }
+        cpa.close()
+    for name, result in imports.run().items():
+        results['import_' + name] = {
+            'import_us': result['import_us'],
+            'modules': result['modules'],
+        }
+    return {
+        'meta': {
+            'version': VERSION,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'requests': requests,
+            'concurrency': concurrency,
+            'latency': latency,
+        },
+        'results': results,
+    }
+
+def compare(results, baseline, threshold):
+    """
+    Return a list of (operation, metric, baseline, current) that regressed by
+    more than `threshold` (a fraction) from the baseline
+    """
+    regressions = []
+    for operation, metrics in results['results'].items():
+        old_metrics = baseline['results'].get(operation, {})
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if not old or metric == 'errors':
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (old - value) / float(old)
+            else:
+                change = (value - old) / float(old)
+            if change > threshold:
+                regressions.append((operation, metric, old, value))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change reported as a regression")
+    parser.add_argument("--requests", type=int, default=500,
+                        help="end-to-end requests per operation")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--number", type=int, default=2000,
+                        help="iterations of the micro benchmarks")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="simulated server latency, in seconds")
+    args = parser.parse_args(argv)
+
+    results = run(requests=args.requests, concurrency=args.concurrency,
+                  number=args.number, latency=args.latency)
+    for operation, metrics in sorted(results['results'].items()):
+        print("{0:<9} ".format(operation) + "  ".join(
+            "{0}={1:.1f}".format(metric, value)
+            for metric, value in sorted(metrics.items())))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.threshold)
+        for operation, metric, old, new in regressions:
+            print("REGRESSION {0}.{1}: {2:.1f} -> {3:.1f}".format(
+                operation, metric, old, new))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
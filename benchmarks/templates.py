@@ -0,0 +1,178 @@
+"""
+Time the precompiled request templates against the lxml tree builders they
+replaced. The legacy builders and the grid of parcels and addresses here are
+also what tests/test_templates.py checks the templates are byte-identical to.
+
+    python -m benchmarks.templates [iterations]
+"""
+import itertools
+import sys
+import timeit
+
+from lxml import etree
+
+from canada_post import Auth, DEV, PROD
+from canada_post.service import Service
+from canada_post.service.contract_shipping import CreateShipment
+from canada_post.service.rating import GetRates
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+def legacy_rates_request(auth, parcel, origin, destination):
+    """
+    GetRates request as built before the templates
+    """
+    request_tree = etree.Element(
+        'mailing-scenario', xmlns="http://www.canadapost.ca/ws/ship/rate-v2")
+    def add_child(child_name, parent=request_tree):
+        return etree.SubElement(parent, child_name)
+    add_child("customer-number").text = text_type(auth.customer_number)
+    if auth.contract_number:
+        add_child("contract-id").text = text_type(auth.contract_number)
+    par_chars = add_child("parcel-characteristics")
+    add_child("weight", par_chars).text = text_type(parcel.weight)
+    if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+        dims = add_child("dimensions", par_chars)
+        add_child("length", dims).text = text_type(parcel.length)
+        add_child("width", dims).text = text_type(parcel.width)
+        add_child("height", dims).text = text_type(parcel.height)
+    add_child("origin-postal-code").text = origin.postal_code
+    dest = add_child("destination")
+    if destination.country_code == "CA":
+        doms = add_child("domestic", dest)
+        add_child("postal-code", doms).text = destination.postal_code
+    elif destination.country_code == "US":
+        us = add_child("united-states")
+        add_child("zip-code", us).text = destination.postal_code
+    else:
+        intr = add_child("international", dest)
+        add_child("country-code", intr).text = destination.country_code
+    return etree.tostring(request_tree, pretty_print=auth.debug)
+
+def _legacy_address_detail(parent, address, add_child):
+    addr_detail = add_child("address-details", parent)
+    add_child("address-line-1", addr_detail).text = address.address1
+    add_child("address-line-2", addr_detail).text = address.address2
+    add_child("city", addr_detail).text = address.city
+    if address.province:
+        add_child("prov-state", addr_detail).text = address.province
+    add_child("country-code", addr_detail).text = address.country_code
+    if address.postal_code:
+        add_child("postal-zip-code",
+                  addr_detail).text = text_type(address.postal_code)
+    return addr_detail
+
+def legacy_shipment_request(auth, parcel, origin, destination, service,
+                            group):
+    """
+    CreateShipment request as built before the templates (without the
+    validation asserts)
+    """
+    shipment = etree.Element(
+        "shipment", xmlns="http://www.canadapost.ca/ws/shipment")
+    def add_child(child_name, parent=shipment):
+        return etree.SubElement(parent, child_name)
+    add_child("group-id").text = group
+    add_child("requested-shipping-point").text = text_type(origin.postal_code)
+    delivery_spec = add_child("delivery-spec")
+    add_child("service-code", delivery_spec).text = service.code
+    sender = add_child("sender", delivery_spec)
+    if origin.name:
+        add_child("name", sender).text = origin.name
+    add_child("company", sender).text = origin.company
+    add_child("contact-phone", sender).text = origin.phone
+    _legacy_address_detail(sender, origin, add_child)
+    dest = add_child("destination", delivery_spec)
+    if destination.name:
+        add_child("name", dest).text = destination.name
+    if destination.company:
+        add_child("company", dest).text = destination.company
+    if destination.extra:
+        add_child("additional-address-info").text = destination.extra
+    if destination.phone:
+        add_child("client-voice-number", dest).text = destination.phone
+    _legacy_address_detail(dest, destination, add_child)
+    parcel_chars = add_child("parcel-characteristics", delivery_spec)
+    add_child("weight", parcel_chars).text = text_type(parcel.weight)
+    if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+        dims = add_child("dimensions", parcel_chars)
+        add_child("length", dims).text = text_type(parcel.length)
+        add_child("width", dims).text = text_type(parcel.width)
+        add_child("height", dims).text = text_type(parcel.height)
+    add_child("unpackaged", parcel_chars).text = ("true" if parcel.unpackaged
+                                                  else "false")
+    preferences = add_child("preferences", delivery_spec)
+    add_child("show-packing-instructions", preferences).text = "false"
+    add_child("show-postage-rate", preferences).text = "false"
+    add_child("show-insured-value", preferences).text = "false"
+    settlement = add_child("settlement-info", delivery_spec)
+    add_child("contract-id", settlement).text = auth.contract_number
+    add_child("intended-method-of-payment", settlement).text = "Account"
+    return etree.tostring(shipment, pretty_print=auth.debug)
+
+PARCELS = [
+    Parcel(weight=2, length=100, width=50, height=30),
+    Parcel(weight=0.75),
+    Parcel(weight="1.250", length=10, width=0, height=5, unpackaged=True),
+]
+ORIGINS = [
+    Origin(postal_code="h2b 1a0", name=u"Ren\xe9e & Co <shipping>",
+           company="ACME", phone="514 555 0101",
+           address="1234 Some Very Long Street Name, Building C, Unit 56",
+           city=u"Montr\xe9al", province="QC"),
+    Origin(postal_code="K1A0B1", company="Widgets\r\nInc", phone="6135550000",
+           address=("12 Main St", ""), city="Ottawa", province="ON"),
+]
+DESTINATIONS = [
+    Destination("CA", postal_code="v6b 1a1", name="Jo", phone="6045550100",
+                address="1 Granville St", city="Vancouver", province="BC",
+                extra="Leave at door"),
+    Destination("US", postal_code="90210", company="Stars & Co",
+                phone="3105550100", address="9 Rodeo Dr", city="Beverly Hills", province="CA"),
+    Destination("FR", postal_code="", name=u"\xc9lodie", phone="+33 1 00",
+                address="5 rue de Rivoli", city="Paris"),
+]
+AUTHS = [
+    Auth("1234567", "user", "pass", "42708517", dev=PROD),
+    Auth("1234567", "user", "pass", "", dev=DEV),
+]
+# a service that ships to each destination country
+SERVICES = {
+    'CA': Service(data={'code': "DOM.EP"}),
+    'US': Service(data={'code': "USA.EP"}),
+    'FR': Service(data={'code': "INT.XP"}),
+}
+SERVICE = SERVICES['CA']
+
+def scenarios():
+    return itertools.product(AUTHS, PARCELS, ORIGINS, DESTINATIONS)
+
+def bench(iterations):
+    auth, parcel, origin, destination = AUTHS[0], PARCELS[0], ORIGINS[0], \
+        DESTINATIONS[0]
+    get_rates = GetRates(auth)
+    create_shipment = CreateShipment(auth)
+    cases = [
+        ("rates legacy", lambda: legacy_rates_request(auth, parcel, origin,
+                                                      destination)),
+        ("rates template", lambda: get_rates.build_request(parcel, origin,
+                                                           destination)),
+        ("shipment legacy", lambda: legacy_shipment_request(
+            auth, parcel, origin, destination, SERVICE, "grp")),
+        ("shipment template", lambda: create_shipment.build_request(
+            parcel, origin, destination, SERVICE, "grp")),
+    ]
+    results = {}
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+        results[name] = seconds / iterations * 1e6
+        print("{0:<20} {1:8.2f} us/request".format(name, results[name]))
+    return results
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -8,34 +8,46 @@ DEV = "DEV"
 PROD = "PROD"
 
 class Auth(object):
-    USERNAME = {
-        DEV: "",
-        PROD: "",
-        }
-    PASSWORD = {
-        DEV: "",
-        PROD: "",
-        }
-
+    """
+    Credentials of a Canada Post account, for the development or production
+    environment. Each instance holds its own, so clients using different
+    accounts can run side by side in the same process
+    """
     def __init__(self, customer_number="", username="", password="",
                  contract_number="", dev=PROD):
         self.dev = dev
         self.debug = dev == DEV
         self.customer_number = customer_number
         self.contract_number = contract_number
-        self.USERNAME[dev] = username
-        self.PASSWORD[dev] = password
+        self.username = username
+        self.password = password
 
     @property
-    def username(self):
-        return self.USERNAME[self.dev]
+    def account(self):
+        """
+        What identifies the account: (dev, customer_number, username)
+        """
+        return (self.dev, self.customer_number, self.username)
 
-    @property
-    def password(self):
-        return self.PASSWORD[self.dev]
+    def __repr__(self):
+        return "Auth(customer_number={0!r}, username={1!r}, " \
+               "contract_number={2!r}, dev={3!r})".format(
+                   self.customer_number, self.username, self.contract_number,
+                   self.dev)
 
 _auth = None
 
-def set_credentials(customer_number, username, password, dev=PROD):
-    if _auth is None:
-        _auth = Auth(customer_number, username, password, dev)
+def set_credentials(customer_number, username, password, contract_number="",
+                    dev=PROD):
+    """
+    Set the process wide default credentials, returned by get_credentials
+    """
+    global _auth
+    _auth = Auth(customer_number, username, password, contract_number, dev)
+    return _auth
+
+def get_credentials():
+    """
+    The Auth set with set_credentials, None if there's none
+    """
+    return _auth
@@ -0,0 +1,111 @@
+"""
+Registry of Canada Post accounts, for processes that serve many merchants.
+
+Every account registered gets its own CanadaPostAPI, created once and reused
+for all its requests. So each account has
+  * its own Auth
+  * its own pooled HTTP session, so its connections aren't shared with the
+    others
+  * its own rate limiter budget (see canada_post.ratelimit.RateLimiterRegistry,
+    the limiters are per account)
+  * its own namespace in the shared rate cache
+
+    accounts = AccountRegistry(rate_cache=Cache(SQLiteBackend("rates.db")),
+                               rate_limit=10, timeout=10)
+    accounts.add("acme", customer_number, username, password, contract_number)
+    ...
+    services = accounts["acme"].get_rates(parcel, origin, destination)
+
+It can be shared between threads. As the clients create their session and
+services on first use, registering an account is cheap
+"""
+import threading
+from canada_post import PROD, ratelimit
+from canada_post.api import CanadaPostAPI
+
+class AccountRegistry(object):
+    """
+    Named CanadaPostAPI clients, one per account. `options` are the
+    CanadaPostAPI parameters shared by all the accounts (e.g. timeout,
+    rate_limit, retry_policy, pool_maxsize), rate_cache a
+    canada_post.cache.Cache whose namespace named after each account is
+    given to its client
+    """
+    def __init__(self, rate_cache=None, **options):
+        if 'session' in options:
+            raise TypeError("Every account has its own session")
+        self.rate_cache = rate_cache
+        self.options = options
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, customer_number, username, password,
+            contract_number="", dev=PROD, **options):
+        """
+        Register an account under `name` and return its CanadaPostAPI.
+        `options` override the registry's for this account. Raises a
+        ValueError if the name is taken
+        """
+        kwargs = dict(self.options)
+        kwargs.update(options)
+        if self.rate_cache is not None and 'rate_cache' not in options:
+            kwargs['rate_cache'] = self.rate_cache.namespace(name)
+        client = CanadaPostAPI(customer_number, username, password,
+                               contract_number, dev, **kwargs)
+        with self._lock:
+            if name in self._clients:
+                raise ValueError("Account {0!r} is already registered".format(
+                    name))
+            self._clients[name] = client
+        return client
+
+    def get(self, name, default=None):
+        """
+        The CanadaPostAPI of the account, `default` if it isn't registered
+        """
+        with self._lock:
+            return self._clients.get(name, default)
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._clients[name]
+
+    def remove(self, name):
+        """
+        Unregister an account, close its connections and forget its rate
+        limiters. Returns its CanadaPostAPI, None if it wasn't registered
+        """
+        with self._lock:
+            client = self._clients.pop(name, None)
+        if client is not None:
+            client.close()
+            ratelimit.registry.discard(client.auth)
+        return client
+
+    def names(self):
+        with self._lock:
+            return sorted(self._clients)
+
+    def close(self):
+        """
+        Close the connections of all the accounts. They're reopened on their
+        next request
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            client.close()
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._clients
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __repr__(self):
+        return "AccountRegistry(accounts={0!r})".format(self.names())
@@ -0,0 +1,436 @@
+"""
+asyncio counterpart of canada_post.api.CanadaPostAPI. The requests are built
+and the responses parsed by the same GetRates/CreateShipment/VoidShipment
+services, only the HTTP transport is different: a non-blocking aiohttp session.
+
+Requires Python 3 and aiohttp (pip install python-canada-post[async])
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from canada_post import PROD, Auth, ratelimit
+from canada_post.instrumentation import NULL_CALL
+from canada_post.ratelimit import parse_retry_after
+from canada_post.retry import SAFE_STATUSES, OutcomeUnknown
+from canada_post.service.contract_shipping import (CreateShipment, VoidShipment)
+from canada_post.service.parsing import (parse_shipment, parse_shipment_links,
+                                         parse_shipment_reference)
+from canada_post.service.rating import GetRates, scenario_key
+
+# maximum number of requests in flight at the same time for a client
+MAX_CONCURRENCY = 100
+
+class AsyncCanadaPostAPI(object):
+    """
+    Usage:
+
+        async with AsyncCanadaPostAPI(customer_number, username, password,
+                                      contract_number) as cpa:
+            services = await cpa.get_rates(parcel, origin, dest)
+            shipment = await cpa.create_shipment(parcel, origin, dest, service,
+                                                 group_name)
+            await cpa.void_shipment(shipment)
+    """
+    log = logging.getLogger('canada_post.aio.AsyncCanadaPostAPI')
+
+    def __init__(self, customer_number, username, password, contract_number="",
+                 dev=PROD, session=None, timeout=None,
+                 max_concurrency=MAX_CONCURRENCY, rate_cache=None,
+                 rate_limit=None, retry_policy=None, hedge=None,
+                 coalesce=False, instruments=None, shipment_store=None):
+        """
+        session -- an aiohttp.ClientSession to use. One is created on the first
+            request if not given, and closed by close()
+        timeout -- seconds to wait for each request. None waits forever
+        max_concurrency -- maximum number of requests in flight at once
+        rate_cache -- an optional canada_post.cache.Cache for get_rates. If
+            its backend blocks (e.g. SQLite), it's read and written from the
+            default executor
+        rate_limit -- requests per second limit, as for CanadaPostAPI. The
+            limiters are shared with the threaded clients using the same
+            credentials
+        retry_policy -- an optional canada_post.retry.RetryPolicy, as for
+            CanadaPostAPI. As there, create_shipment only retries failures
+            where the shipment may have been created anyway when it's given a
+            reference to look it up by
+        hedge -- an optional canada_post.hedging.HedgePolicy for get_rates.
+            The slower of the hedged requests is cancelled
+        coalesce -- if True, concurrent get_rates calls for the same scenario
+            share one request, see GetRates
+        instruments -- canada_post.instrumentation.Instrument objects every
+            call is reported to
+        shipment_store -- an optional canada_post.store.ShipmentStore, as
+            for CanadaPostAPI. It's written to from the default executor
+        """
+        self.auth = Auth(customer_number, username, password, contract_number,
+                         dev)
+        self._basic_auth = aiohttp.BasicAuth(username, password)
+        self._session = session
+        self._own_session = session is None
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # these only build requests and parse responses, they never send
+        #  anything themselves
+        def limiter(service_class):
+            return ratelimit.registry.for_service(service_class.__name__,
+                                                  self.auth, rate_limit)
+        self._get_rates = GetRates(self.auth, cache=rate_cache, hedge=hedge,
+                                   coalesce=coalesce,
+                                   rate_limiter=limiter(GetRates),
+                                   retry_policy=retry_policy,
+                                   instruments=instruments)
+        # scenario key -> task of the get_rates request in progress
+        self._flights = {}
+        self._create_shipment = CreateShipment(
+            self.auth, rate_limiter=limiter(CreateShipment),
+            retry_policy=retry_policy, instruments=instruments)
+        self._void_shipment = VoidShipment(self.auth,
+                                           rate_limiter=limiter(VoidShipment),
+                                           retry_policy=retry_policy,
+                                           instruments=instruments)
+        self.shipment_store = shipment_store
+
+    @property
+    def rate_cache(self):
+        return self._get_rates.cache
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request(self, service, method, url, headers, data=None,
+                       call=NULL_CALL, params=None):
+        """
+        Send a request for the given service, waiting for its rate limiter and
+        a concurrency slot first. Returns the response body, or raises
+        aiohttp.ClientResponseError for HTTP errors. The response is recorded
+        in `call`
+        """
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        limiter = service.rate_limiter
+        if limiter is not None:
+            delay = limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        async with self._semaphore:
+            async with self.session.request(method, url, data=data,
+                                            params=params, headers=headers,
+                                            auth=self._basic_auth,
+                                            timeout=timeout) as response:
+                self.log.info("Request returned with status %s",
+                              response.status)
+                if limiter is not None:
+                    limiter.update(response.status,
+                                   response.headers.get('Retry-After'))
+                content = await response.read()
+                call.response(response.status, len(content))
+                service._debug_xml("Request returned content: %s", content)
+                response.raise_for_status()
+                return content
+
+    async def _retry(self, service, send, recover=None):
+        """
+        Await send() as allowed by the service's RetryPolicy, if any: like
+        RetryPolicy.run, but the backoff doesn't block the loop. The failures
+        of a service that isn't idempotent are only retried if the request
+        surely wasn't processed, or if `recover` is given. It's awaited before
+        retrying those, and what it returns, unless it's None, is the result
+        of the call. If it raises, OutcomeUnknown is raised
+        """
+        policy = service.retry_policy
+        if policy is None:
+            return await send()
+        stats = service.retry_stats
+        start = time.monotonic()
+        stats.add(calls=1)
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_start = time.monotonic()
+            stats.add(attempts=1)
+            retry_after = None
+            try:
+                return await send()
+            except aiohttp.ClientResponseError as e:
+                if e.status not in policy.retry_statuses:
+                    raise
+                error = e
+                safe = e.status in SAFE_STATUSES
+                if e.headers is not None:
+                    retry_after = parse_retry_after(
+                        e.headers.get('Retry-After'))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+                # the connection couldn't even be opened
+                safe = isinstance(e, aiohttp.ClientConnectorError)
+
+            delay = policy.delay(attempt, retry_after)
+            elapsed = time.monotonic() - start
+            out_of_time = (policy.deadline is not None and
+                           elapsed + delay > policy.deadline)
+            safe = service.IDEMPOTENT or safe
+            if attempt >= policy.max_attempts or out_of_time or \
+                    not (safe or recover is not None):
+                self.log.info("Giving up after %d attempts: %r", attempt,
+                              error)
+                stats.add(gave_up=1,
+                          retry_time=time.monotonic() - attempt_start)
+                raise error
+            self.log.info("Attempt %d failed (%r), retrying in %.2fs",
+                          attempt, error, delay)
+            await asyncio.sleep(delay)
+            if not safe:
+                try:
+                    recovered = await recover()
+                except Exception as e:
+                    self.log.warning("Outcome unknown after %r, the lookup "
+                                     "failed: %r", error, e)
+                    stats.add(gave_up=1,
+                              retry_time=time.monotonic() - attempt_start)
+                    raise OutcomeUnknown(error, None, e)
+                if recovered is not None:
+                    self.log.info("Found the result of a previous attempt")
+                    stats.add(recovered=1,
+                              retry_time=time.monotonic() - attempt_start)
+                    return recovered
+            stats.add(retries=1, retry_time=time.monotonic() - attempt_start)
+
+    async def _hedged(self, service, send):
+        """
+        Await send(), hedged according to the service's HedgePolicy (see
+        HedgePolicy.run). The request that loses the race is cancelled
+        """
+        hedge = service.hedge
+
+        async def timed():
+            start = time.monotonic()
+            result = await send()
+            hedge.latencies.record(time.monotonic() - start)
+            return result
+
+        hedge.start()
+        primary = asyncio.ensure_future(timed())
+        pending = {primary}
+        delay = hedge.delay()
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and hedge.may_hedge(service.rate_limiter):
+            self.log.debug("No answer after %.3fs, hedging", delay)
+            pending.add(asyncio.ensure_future(timed()))
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    if future is not primary:
+                        hedge.won()
+                    return future.result()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def get_rates(self, parcel, origin, destination, services=None,
+                        options=None):
+        """
+        Awaitable version of GetRates.__call__
+        """
+        service = self._get_rates
+        filters = (services, options)
+        with service._begin() as call:
+            if service.cache is None:
+                key, cached = service._cached(parcel, origin, destination,
+                                              *filters)
+            else:
+                key = scenario_key(self.auth, parcel, origin, destination,
+                                   *filters)
+                cached = await self._cache(service.cache.get, key)
+            if cached is not None:
+                call.cached = True
+                return list(cached)
+            call.skip()
+            flight = service.singleflight
+            if flight is None:
+                services = await self._fetch_rates(call, key, parcel, origin,
+                                                   destination, *filters)
+                return list(services)
+            task = self._flights.get(key)
+            flight.count(coalesced=task is not None)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_rates(
+                    call, key, parcel, origin, destination, *filters))
+                self._flights[key] = task
+                task.add_done_callback(lambda _: self._flights.pop(key, None))
+            else:
+                call.coalesced = True
+            # a caller being cancelled mustn't cancel the request for the
+            #  others
+            services = await asyncio.shield(task)
+            return list(services)
+
+    async def _fetch_rates(self, call, key, parcel, origin, destination,
+                           services=None, options=None):
+        service = self._get_rates
+        values = service.request_values(parcel, origin, destination, services,
+                                        options)
+        call.phase("build")
+        request = service.render(values)
+        call.phase("serialize")
+        call.request(request)
+
+        def send():
+            return self._retry(service, lambda: self._request(
+                service, 'POST', service.get_url(), service.HEADERS,
+                data=request, call=call))
+        if service.hedge is None:
+            content = await send()
+        else:
+            content = await self._hedged(service, send)
+        call.phase("network")
+        services = service.parse_response(content)
+        call.phase("parse")
+        if service.cache is not None:
+            await self._cache(service.cache.set, key, services)
+        return services
+
+    async def create_shipment(self, parcel, origin, destination, service,
+                              group, reference=None):
+        """
+        Awaitable version of CreateShipment.__call__. With a retry policy and
+        a `reference`, failures where the shipment may have been created
+        anyway are retried after looking for it in the group, see
+        CreateShipment.send
+        """
+        create = self._create_shipment
+        with create._begin() as call:
+            values = create.request_values(parcel, origin, destination,
+                                           service, group, reference)
+            call.phase("build")
+            request = create.render(values)
+            call.phase("serialize")
+            call.request(request)
+
+            async def send():
+                content = await self._request(create, 'POST',
+                                              create.get_url(),
+                                              create.HEADERS, data=request,
+                                              call=call)
+                call.phase("network")
+                shipment = create.parse_response(content)
+                call.phase("parse")
+                return shipment
+            recover = None
+            if group and reference:
+                recover = lambda: self.find_shipment(group, reference)
+            shipment = await self._retry(create, send, recover)
+            await self._stored('add', shipment, group, reference)
+            return shipment
+
+    async def find_shipment(self, group, reference):
+        """
+        Awaitable version of CreateShipment.find_shipment
+        """
+        create = self._create_shipment
+        headers = create._get_headers()
+        content = await self._request(create, 'GET', create.get_url(),
+                                      headers, params={'groupId': group})
+        for href in parse_shipment_links(content):
+            details = await self._request(create, 'GET', href + "/details",
+                                          headers)
+            if parse_shipment_reference(details) == reference:
+                info = await self._request(create, 'GET', href, headers)
+                return create.parse_response(info)
+        return None
+
+    async def void_shipment(self, shipment):
+        """
+        Awaitable version of VoidShipment.__call__
+        """
+        void = self._void_shipment
+        with void._begin() as call:
+            url, headers = void.get_link(shipment)
+            attempts = []
+
+            def send():
+                attempts.append(url)
+                return self._request(void, void.method, url, headers,
+                                     call=call)
+            try:
+                await self._retry(void, send)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404 or len(attempts) == 1 or \
+                        not await self._voided(shipment):
+                    raise
+                # a previous attempt went through before failing
+                self.log.info("Already done by a previous attempt")
+            call.phase("network")
+            await self._stored('set_status', [shipment.id], void.VOIDED)
+            return True
+
+    async def _voided(self, shipment):
+        """
+        Awaitable version of VoidShipment.already_done
+        """
+        void = self._void_shipment
+        url, headers = void.get_link(shipment)
+        try:
+            content = await self._retry(void, lambda: self._request(
+                void, 'GET', url, headers))
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+            self.log.warning("Shipment %s is unknown to Canada Post",
+                             shipment.id)
+            return False
+        status = parse_shipment(content).get('status')
+        return status in void.VOIDED_STATUSES
+
+    async def _stored(self, method, *args):
+        """
+        Call a method of the shipment store, if any. The shipment was created
+        or voided whatever happens to the store, so a failure is only logged
+        """
+        if self.shipment_store is None:
+            return
+        try:
+            await self._blocking(getattr(self.shipment_store, method), *args)
+        except Exception:
+            self.log.exception("Couldn't write to the shipment store")
+
+    async def _cache(self, method, *args):
+        """
+        Call a method of the rate cache, from the default executor if its
+        backend blocks
+        """
+        if not self.rate_cache.blocking:
+            return method(*args)
+        return await self._blocking(method, *args)
+
+    async def _blocking(self, method, *args):
+        """
+        Call a blocking method (of the shipment store or a cache) without
+        blocking the loop
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, method, *args)
@@ -1,15 +1,219 @@
 """
 Central API module
+
+The services and the HTTP session are created on first use, and so are the
+modules they need (lxml, requests), so that importing this module and
+creating a CanadaPostAPI stay cheap for short-lived processes
 """
-from canada_post import PROD, Auth
-from canada_post.service.contract_shipping import (CreateShipment, VoidShipment)
-from canada_post.service.rating import (GetRates)
+import os
+import threading
+from canada_post import PROD, Auth, ratelimit
+from canada_post.batch import run_many, void_many, ShipmentPipeline, WORKERS
+from canada_post.session import POOL_CONNECTIONS, POOL_MAXSIZE
+
+class _lazy(object):
+    """
+    Attribute created by the decorated method on first access, and then kept
+    in the instance's __dict__
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance._lock:
+            try:
+                return instance.__dict__[self.name]
+            except KeyError:
+                value = instance.__dict__[self.name] = self.factory(instance)
+                return value
 
 class CanadaPostAPI(object):
+    # names of the service attributes
+    SERVICES = ('get_rates', 'create_shipment', 'void_shipment',
+                'get_artifact')
+
     def __init__(self, customer_number, username, password, contract_number="",
-                 dev=PROD):
+                 dev=PROD, session=None, timeout=None,
+                 pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 pool_block=False, keep_alive=True, rate_cache=None,
+                 rate_limit=None, retry_policy=None, hedge=None,
+                 coalesce=False, instruments=None, artifact_cache=None,
+                 shipment_store=None):
+        """
+        All the services share one connection-pooled HTTP session. Pass your
+        own requests.Session as `session`, or tune the one created here with
+        the pool_* and keep_alive parameters (see
+        canada_post.session.create_session). `timeout` is applied to every
+        request.
+
+        rate_cache is an optional canada_post.cache.Cache for get_rates results
+
+        artifact_cache is an optional
+        canada_post.service.artifacts.ArtifactCache for the labels and other
+        artifacts downloaded with get_artifact
+
+        shipment_store is an optional canada_post.store.ShipmentStore. The
+        shipments created are saved there, and marked as voided when voided
+
+        rate_limit caps the requests per second sent to Canada Post, adapting
+        to its throttling responses. It's a rate, a (rate, burst) tuple or a
+        dict of service class name ("GetRates", "CreateShipment",
+        "VoidShipment", "GetArtifact") -> rate. The limiters are shared by all the clients
+        using the same credentials in the process (see
+        canada_post.ratelimit.RateLimiterRegistry)
+
+        The session and the services are only created when first used
+        """
         self.auth = Auth(customer_number, username, password, contract_number,
                          dev)
-        self.get_rates = GetRates(self.auth)
-        self.create_shipment = CreateShipment(self.auth)
-        self.void_shipment = VoidShipment(self.auth)
+        self._lock = threading.RLock()
+        if session is not None:
+            self.session = session
+        self._pool = {
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+            'keep_alive': keep_alive,
+        }
+        self.timeout = timeout
+        self._rate_cache = rate_cache
+        self._rate_limit = rate_limit
+        self._retry_policy = retry_policy
+        self._hedge = hedge
+        self._coalesce = coalesce
+        self._instruments = list(instruments or ())
+        self._artifact_cache = artifact_cache
+        self._shipment_store = shipment_store
+
+    def _options(self, service_class):
+        return {
+            'session': self.session,
+            'timeout': self.timeout,
+            'rate_limiter': ratelimit.registry.for_service(
+                service_class.__name__, self.auth, self._rate_limit),
+            'retry_policy': self._retry_policy,
+            'instruments': self._instruments,
+        }
+
+    @_lazy
+    def session(self):
+        from canada_post.session import create_session
+        return create_session(**self._pool)
+
+    @_lazy
+    def get_rates(self):
+        from canada_post.service.rating import GetRates
+        return GetRates(self.auth, cache=self._rate_cache, hedge=self._hedge,
+                        coalesce=self._coalesce, **self._options(GetRates))
+
+    @_lazy
+    def create_shipment(self):
+        from canada_post.service.contract_shipping import CreateShipment
+        return CreateShipment(self.auth, store=self._shipment_store,
+                              **self._options(CreateShipment))
+
+    @_lazy
+    def void_shipment(self):
+        from canada_post.service.contract_shipping import VoidShipment
+        return VoidShipment(self.auth, store=self._shipment_store,
+                            **self._options(VoidShipment))
+
+    @_lazy
+    def get_artifact(self):
+        from canada_post.service.artifacts import GetArtifact
+        return GetArtifact(self.auth, cache=self._artifact_cache,
+                           **self._options(GetArtifact))
+
+    def services(self):
+        """
+        All the services, created if they weren't yet
+        """
+        return [getattr(self, name) for name in self.SERVICES]
+
+    def add_instrument(self, instrument):
+        """
+        Report the calls to all the services to the given
+        canada_post.instrumentation.Instrument, e.g. a PrometheusInstrument
+        """
+        with self._lock:
+            self._instruments.append(instrument)
+            for name in self.SERVICES:
+                service = self.__dict__.get(name)
+                if service is not None:
+                    service.add_instrument(instrument)
+
+    def get_rates_many(self, scenarios, workers=WORKERS, rate=None,
+                       ordered=True):
+        """
+        Get the rates for many (parcel, origin, destination) tuples
+        concurrently. Yields a canada_post.batch.BatchResult per scenario, whose
+        value is the list of Service objects get_rates returned for it, or
+        whose error is the exception it raised.
+
+        workers -- number of concurrent requests
+        rate -- if given, the maximum number of requests started per second
+        ordered -- yield results in the same order as the scenarios if True,
+            or as soon as they are available otherwise
+        """
+        return run_many(self.get_rates, scenarios, workers=workers, rate=rate,
+                        ordered=ordered)
+
+    def create_shipments(self, jobs, workers=WORKERS, rate=None, retries=2):
+        """
+        Create many shipments concurrently. `jobs` is an iterable of
+        (parcel, origin, destination, service, group[, reference]) tuples.
+        Returns a
+        canada_post.batch.PipelineResult, see ShipmentPipeline
+        """
+        pipeline = ShipmentPipeline(self.create_shipment, workers=workers,
+                                    rate=rate, retries=retries)
+        return pipeline(jobs)
+
+    def void_shipments(self, shipments=None, group=None, workers=WORKERS,
+                       rate=None):
+        """
+        Void many shipments concurrently: the given Shipment objects, or the
+        ones of `group`. Those are read from the shipment store if there's
+        one (the ones that haven't been voided), or listed by Canada Post
+        otherwise. Shipments that were already voided count as voided.
+        Returns a canada_post.batch.VoidResult
+        """
+        if shipments is None:
+            if group is None:
+                raise TypeError("Either shipments or group must be given")
+            store = self.void_shipment.store
+            if store is not None:
+                shipments = store.by_group(group, status="created")
+            else:
+                shipments = self.create_shipment.group_shipments(group)
+        return void_many(self.void_shipment, shipments, workers=workers,
+                         rate=rate)
+
+    def download_artifacts(self, shipments, directory, rel=None,
+                           workers=WORKERS, rate=None, ordered=True):
+        """
+        Download an artifact (the label by default, or the one linked as
+        `rel`) of many shipments concurrently, to files of `directory` named
+        after the shipment ids (see GetArtifact.filename). Yields a
+        canada_post.batch.BatchResult per shipment whose value is the path of
+        the file
+        """
+        def download(shipment):
+            path = os.path.join(directory,
+                                self.get_artifact.filename(shipment, rel))
+            self.get_artifact(shipment, path, rel)
+            return path
+        return run_many(download, ((shipment,) for shipment in shipments),
+                        workers=workers, rate=rate, ordered=ordered)
+
+    def close(self):
+        """
+        Close all the pooled connections
+        """
+        session = self.__dict__.get('session')
+        if session is not None:
+            session.close()
@@ -0,0 +1,321 @@
+"""
+Run many service calls concurrently over a thread pool
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from canada_post.ratelimit import TokenBucket
+from canada_post.util.compat import monotonic
+
+WORKERS = 8
+
+class BatchResult(object):
+    """
+    Outcome of one call in a batch.
+      * index is the position of the input in the batch
+      * input is the tuple of arguments the service was called with
+      * value is what the call returned (None if it failed)
+      * error is the exception the call raised (None if it succeeded)
+    """
+    def __init__(self, index, input, value=None, error=None):
+        self.index = index
+        self.input = input
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "BatchResult(index={index}, value={value}, error={error})" \
+            .format(index=self.index, value=repr(self.value),
+                    error=repr(self.error))
+
+def run_many(func, inputs, workers=WORKERS, rate=None, ordered=True):
+    """
+    Call func(*args) for each args tuple in `inputs` on a pool of `workers`
+    threads and yield a BatchResult for each of them. Exceptions are captured
+    in the results instead of stopping the batch.
+
+    rate -- if given, the maximum number of calls started per second
+    ordered -- yield the results in input order if True, otherwise as soon as
+        they complete
+    """
+    limiter = TokenBucket(rate, burst=workers) if rate else None
+
+    def call(index, args):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return BatchResult(index, args, value=func(*args))
+        except Exception as e:
+            return BatchResult(index, args, error=e)
+
+    # only keep a bounded amount of inputs in flight, so arbitrarily long
+    #  iterables can be streamed through
+    window = workers * 4
+    inputs = enumerate(inputs)
+    pending = set()
+    finished = {}
+    next_index = 0
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while not exhausted and len(pending) + len(finished) < window:
+                    try:
+                        index, args = next(inputs)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        pending.add(executor.submit(call, index, tuple(args)))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if not ordered:
+                        yield result
+                        continue
+                    finished[result.index] = result
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+        finally:
+            # the caller stopped iterating, don't start what's left
+            for future in pending:
+                future.cancel()
+
+class PipelineStats(object):
+    """
+    Timings of a ShipmentPipeline run, in seconds
+      * validate_time: building and checking every request up front
+      * submit_time: wall time of the concurrent submission stage
+      * total_time: the whole run
+      * latencies: time each submitted job took, including its retries
+    `retries` counts the retries the CreateShipment service made during the
+    run
+    """
+    def __init__(self):
+        self.jobs = 0
+        self.invalid = 0
+        self.created = 0
+        self.failed = 0
+        self.retries = 0
+        self.validate_time = 0.0
+        self.submit_time = 0.0
+        self.total_time = 0.0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        Record a submitted job (called from the worker threads)
+        """
+        with self._lock:
+            self.latencies.append(latency)
+
+    @property
+    def throughput(self):
+        """
+        Shipments created per second during the submission stage
+        """
+        if not self.submit_time:
+            return 0.0
+        return self.created / self.submit_time
+
+    def latency(self, percentile):
+        """
+        Submission latency of the given percentile (0-100) of jobs
+        """
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        index = int(round(percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def __repr__(self):
+        return "PipelineStats(jobs={jobs}, invalid={invalid}, " \
+               "created={created}, failed={failed}, retries={retries}, " \
+               "validate_time={validate:.3f}, submit_time={submit:.3f}, " \
+               "total_time={total:.3f}, throughput={throughput:.1f}/s)".format(
+                   jobs=self.jobs, invalid=self.invalid, created=self.created,
+                   failed=self.failed, retries=self.retries,
+                   validate=self.validate_time, submit=self.submit_time,
+                   total=self.total_time, throughput=self.throughput)
+
+class PipelineResult(object):
+    """
+    Results of a ShipmentPipeline run: a BatchResult per job, in job order,
+    whose value is the created Shipment or whose error is the exception that
+    prevented its creation. Also holds the run's PipelineStats
+    """
+    def __init__(self, results, stats):
+        self.results = results
+        self.stats = stats
+
+    @property
+    def shipments(self):
+        return [result.value for result in self.results if result.ok]
+
+    @property
+    def errors(self):
+        return [result for result in self.results if not result.ok]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def __repr__(self):
+        return "PipelineResult({stats})".format(stats=repr(self.stats))
+
+class ShipmentPipeline(object):
+    """
+    Bulk shipment creation. Takes (parcel, origin, destination, service,
+    group[, reference]) jobs, builds and validates every request before
+    sending anything, then submits the valid ones concurrently. Invalid jobs
+    never reach the network, their error is a
+    canada_post.validation.ValidationError listing what's wrong.
+
+    Failed submissions are only retried by the service's
+    canada_post.retry.RetryPolicy, so its max_attempts and deadline apply.
+    Failures where the shipment may have been created anyway (read timeouts,
+    dropped connections, 5xx) are only retried for jobs with a reference,
+    after checking that the failed attempt didn't create the shipment. If
+    that check fails too, the job fails with a
+    canada_post.retry.OutcomeUnknown and isn't sent again.
+    """
+    log = logging.getLogger('canada_post.batch.ShipmentPipeline')
+
+    def __init__(self, create_shipment, workers=WORKERS, rate=None, retries=2,
+                 backoff=0.5):
+        """
+        create_shipment -- the CreateShipment service to use
+        workers -- number of concurrent submissions
+        rate -- if given, the maximum number of submissions started per second
+        retries, backoff -- if the service has no RetryPolicy, a
+            RetryPolicy(max_attempts=retries + 1, backoff=backoff) is used.
+            Ignored otherwise
+        """
+        self.create_shipment = create_shipment
+        self.workers = workers
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+
+    def _submit(self, request, job, policy, stats):
+        start = monotonic()
+        try:
+            # group and reference, so that the service can retry safely
+            return self.create_shipment.send(request, *job[4:6],
+                                             retry_policy=policy)
+        finally:
+            stats.record(monotonic() - start)
+
+    def __call__(self, jobs):
+        """
+        Create a shipment for every job, return a PipelineResult
+        """
+        stats = PipelineStats()
+        start = monotonic()
+
+        # validation: build every request up front
+        results = []
+        requests_to_send = []
+        for index, job in enumerate(jobs):
+            job = tuple(job)
+            try:
+                request = self.create_shipment.build_request(*job)
+            except (ValueError, TypeError, AttributeError) as e:
+                results.append(BatchResult(index, job, error=e))
+                stats.invalid += 1
+            else:
+                results.append(None)
+                requests_to_send.append((index, job, request))
+        stats.jobs = len(results)
+        stats.validate_time = monotonic() - start
+
+        # submission
+        policy = None
+        if self.create_shipment.retry_policy is None and self.retries:
+            from canada_post.retry import RetryPolicy
+            policy = RetryPolicy(max_attempts=self.retries + 1,
+                                 backoff=self.backoff)
+        retry_stats = self.create_shipment.retry_stats
+        retries = retry_stats.retries
+        submit_start = monotonic()
+        submitted = run_many(lambda request, job: self._submit(request, job,
+                                                               policy, stats),
+                             ((request, job)
+                              for _, job, request in requests_to_send),
+                             workers=self.workers, rate=self.rate,
+                             ordered=False)
+        for result in submitted:
+            index, job, _ = requests_to_send[result.index]
+            results[index] = BatchResult(index, job, value=result.value,
+                                         error=result.error)
+            if result.ok:
+                stats.created += 1
+            else:
+                stats.failed += 1
+        stats.submit_time = monotonic() - submit_start
+        stats.retries = retry_stats.retries - retries
+        stats.total_time = monotonic() - start
+        self.log.info("Shipment pipeline done: %r", stats)
+        return PipelineResult(results, stats)
+
+class VoidResult(object):
+    """
+    Results of void_many: a BatchResult per shipment, in order, whose value
+    is True if the shipment was voided, False if it already was, or whose
+    error is the exception that prevented voiding it. `voided`,
+    `already_voided` and `failed` count them
+    """
+    def __init__(self, results):
+        self.results = results
+        self.voided = sum(1 for result in results if result.value is True)
+        self.already_voided = sum(1 for result in results
+                                  if result.value is False)
+        self.failed = sum(1 for result in results if not result.ok)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def errors(self):
+        return [result for result in self.results if not result.ok]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def __repr__(self):
+        return "VoidResult(voided={voided}, already_voided={already}, " \
+               "failed={failed})".format(voided=self.voided,
+                                         already=self.already_voided,
+                                         failed=self.failed)
+
+def void_many(void_shipment, shipments, workers=WORKERS, rate=None):
+    """
+    Void many shipments concurrently with the VoidShipment service (see
+    VoidShipment.void). Shipments that were already voided count as
+    successes, and failures don't stop the others. Returns a VoidResult
+    """
+    results = list(run_many(void_shipment.void,
+                            ((shipment,) for shipment in shipments),
+                            workers=workers, rate=rate))
+    result = VoidResult(results)
+    void_shipment.log.info("Bulk void done: %r", result)
+    return result
@@ -0,0 +1,264 @@
+"""
+Result caches. A Cache applies a per-entry time to live, counts hits and misses
+and delegates the storage to a backend:
+  * MemoryBackend keeps entries in-process, in a bounded LRU dict
+  * SQLiteBackend keeps them in a sqlite database file, so it can be shared by
+    several worker processes on the same host
+Backends just need get(key, now), set(key, value, expires), delete(key),
+clear() and __len__, so other stores can be plugged in. Their `blocking`
+attribute tells whether those do I/O, so that the asyncio client calls them
+from its executor; backends without one are assumed to block.
+
+Cache.namespace() gives a view of a cache whose keys are prefixed, so that
+several accounts can share a store without seeing each other's entries
+"""
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from canada_post.util.sqlite import LocalConnection
+
+class MemoryBackend(object):
+    """
+    In-process LRU store. Holds at most `maxsize` entries, the least recently
+    used ones are evicted first
+    """
+    blocking = False
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires <= now:
+                return None
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def clear_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def count_prefix(self, prefix):
+        with self._lock:
+            return sum(1 for key in self._data if key.startswith(prefix))
+
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteBackend(object):
+    """
+    sqlite store that can be shared between processes by pointing them to the
+    same database file. Values are pickled. Holds at most `maxsize` entries,
+    evicting the least recently used ones first
+    """
+    blocking = True
+
+    def __init__(self, path, maxsize=10000, table="cache", timeout=10):
+        self.path = path
+        self.maxsize = maxsize
+        self.table = table
+        self.timeout = timeout
+        self._connection = LocalConnection(path, timeout)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS {table} ("
+                         "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                         "expires REAL NOT NULL, accessed REAL NOT NULL)"
+                         .format(table=table))
+            conn.execute("CREATE INDEX IF NOT EXISTS {table}_accessed "
+                         "ON {table} (accessed)".format(table=table))
+
+    def get(self, key, now):
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, expires FROM {table} "
+                               "WHERE key = ?".format(table=self.table),
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires = row
+            if expires <= now:
+                conn.execute("DELETE FROM {table} WHERE key = ?"
+                             .format(table=self.table), (key,))
+                return None
+            conn.execute("UPDATE {table} SET accessed = ? WHERE key = ?"
+                         .format(table=self.table), (now, key))
+        return pickle.loads(bytes(value))
+
+    def set(self, key, value, expires):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO {table} "
+                         "(key, value, expires, accessed) VALUES (?, ?, ?, ?)"
+                         .format(table=self.table),
+                         (key, sqlite3.Binary(data), expires, time.time()))
+            conn.execute("DELETE FROM {table} WHERE key IN (SELECT key FROM "
+                         "{table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)"
+                         .format(table=self.table), (self.maxsize,))
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM {table} WHERE key = ?"
+                         .format(table=self.table), (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM {table}".format(table=self.table))
+
+    def clear_prefix(self, prefix):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM {table} WHERE substr(key, 1, ?) = ?"
+                         .format(table=self.table), (len(prefix), prefix))
+
+    def count_prefix(self, prefix):
+        with self._connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM {table} WHERE substr(key, 1, ?) = ?"
+                .format(table=self.table), (len(prefix), prefix)
+            ).fetchone()[0]
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM {table}".format(table=self.table)
+            ).fetchone()[0]
+
+class NamespaceBackend(object):
+    """
+    View of another backend where every key is prefixed with the namespace.
+    clear() and __len__ only see the entries of the namespace, which needs
+    the backend to have clear_prefix(prefix) and count_prefix(prefix)
+    """
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+        self.prefix = u"{0}:".format(namespace)
+
+    @property
+    def blocking(self):
+        return getattr(self.backend, 'blocking', True)
+
+    def get(self, key, now):
+        return self.backend.get(self.prefix + key, now)
+
+    def set(self, key, value, expires):
+        self.backend.set(self.prefix + key, value, expires)
+
+    def delete(self, key):
+        self.backend.delete(self.prefix + key)
+
+    def clear(self):
+        self.backend.clear_prefix(self.prefix)
+
+    def clear_prefix(self, prefix):
+        self.backend.clear_prefix(self.prefix + prefix)
+
+    def count_prefix(self, prefix):
+        return self.backend.count_prefix(self.prefix + prefix)
+
+    def __len__(self):
+        return self.backend.count_prefix(self.prefix)
+
+class Cache(object):
+    """
+    A cache with a per-entry time to live (in seconds) and hit/miss counters.
+    If no backend is given, a MemoryBackend of `maxsize` entries is used.
+    The backend failing doesn't fail the callers: the error is logged and
+    counted, and a failed lookup is a miss
+    """
+    log = logging.getLogger('canada_post.cache.Cache')
+
+    def __init__(self, backend=None, ttl=300, maxsize=1024):
+        self.backend = backend if backend is not None else MemoryBackend(
+            maxsize=maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value cached for key, or None if it's missing or expired
+        """
+        try:
+            value = self.backend.get(key, time.time())
+        except Exception:
+            self.log.exception("Cache lookup of %s failed", key)
+            value = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            self.backend.set(key, value, time.time() + ttl)
+        except Exception:
+            self.log.exception("Caching %s failed", key)
+            with self._lock:
+                self.errors += 1
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    @property
+    def blocking(self):
+        """
+        Whether get and set do I/O, see the backends
+        """
+        return getattr(self.backend, 'blocking', True)
+
+    def namespace(self, name):
+        """
+        A Cache with the same backend and ttl whose keys are prefixed with
+        `name`, and with its own hit/miss counters
+        """
+        return Cache(NamespaceBackend(self.backend, name), ttl=self.ttl)
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'size': len(self.backend),
+        }
+
+    def __repr__(self):
+        return "Cache(backend={backend}, ttl={ttl}, hits={hits}, " \
+               "misses={misses})".format(backend=self.backend.__class__
+                                         .__name__, ttl=self.ttl,
+                                         hits=self.hits, misses=self.misses)
@@ -0,0 +1,293 @@
+"""
+Catalogue of the Canada Post service codes: what each one is, where it ships
+to, how fast it is, what it requires and which options it takes, so services
+can be picked or filtered out without asking GetRates.
+
+    from canada_post import catalogue
+    catalogue.get("USA.XP").phone_required         # True
+    catalogue.select(destination="US", min_speed="express", tracked=True)
+    catalogue.candidates(parcel, destination, options=("SO",))
+
+candidates() also takes the parcel into account, so a GetRates call can ask
+for the candidates only, or be skipped altogether when they're all ruled out.
+prune() filters the Service objects GetRates returned with the same criteria.
+rates() does both.
+
+The data is what Canada Post documents for each service. Contracts can differ,
+Discover Services/Get Service has the details for a given account
+"""
+from collections import namedtuple
+
+# speed classes, slowest first
+SPEEDS = ("economy", "expedited", "express", "priority")
+
+# option codes
+SIGNATURE = "SO"
+COVERAGE = "COV"
+COLLECT_ON_DELIVERY = "COD"
+PROOF_OF_AGE_18 = "PA18"
+PROOF_OF_AGE_19 = "PA19"
+CARD_FOR_PICKUP = "HFP"
+DO_NOT_SAFE_DROP = "DNS"
+LEAVE_AT_DOOR = "LAD"
+DELIVER_TO_POST_OFFICE = "D2PO"
+RETURN_AT_SENDERS_EXPENSE = "RASE"
+RETURN_TO_SENDER = "RTS"
+ABANDON = "ABAN"
+
+_DOMESTIC_OPTIONS = frozenset((SIGNATURE, COVERAGE, COLLECT_ON_DELIVERY,
+                               PROOF_OF_AGE_18, PROOF_OF_AGE_19,
+                               CARD_FOR_PICKUP, DO_NOT_SAFE_DROP,
+                               LEAVE_AT_DOOR, DELIVER_TO_POST_OFFICE))
+_NON_DELIVERY = frozenset((RETURN_AT_SENDERS_EXPENSE, RETURN_TO_SENDER,
+                           ABANDON))
+_FOREIGN_OPTIONS = _NON_DELIVERY | frozenset((SIGNATURE, COVERAGE))
+
+class Limits(object):
+    """
+    Size limits of a service. max_weight is in kg and the rest in cm.
+    max_girth limits the length plus the girth (twice the width plus the
+    height), max_sum the length plus width plus height. None where there's no
+    limit
+    """
+    __slots__ = ('max_weight', 'max_length', 'max_girth', 'max_sum')
+
+    def __init__(self, max_weight, max_length=None, max_girth=None,
+                 max_sum=None):
+        self.max_weight = max_weight
+        self.max_length = max_length
+        self.max_girth = max_girth
+        self.max_sum = max_sum
+
+    def fits(self, weight, dimensions):
+        """
+        Whether a parcel of `weight` kg and `dimensions` (length, width,
+        height, largest first) is within the limits
+        """
+        length, width, height = dimensions
+        return not (
+            weight > self.max_weight or
+            (self.max_length is not None and length > self.max_length) or
+            (self.max_girth is not None and
+             length + 2 * (width + height) > self.max_girth) or
+            (self.max_sum is not None and
+             length + width + height > self.max_sum))
+
+    def __repr__(self):
+        return "Limits(max_weight={0}, max_length={1}, max_girth={2}, " \
+               "max_sum={3})".format(self.max_weight, self.max_length,
+                                     self.max_girth, self.max_sum)
+
+# limits of the services of each family that aren't listed below
+FAMILY_LIMITS = {
+    'DOM': Limits(30, max_length=200, max_girth=300),
+    'USA': Limits(30, max_length=200, max_girth=274),
+    'INT': Limits(30, max_length=150, max_girth=300),
+}
+_PACKET = Limits(2, max_length=60, max_sum=90)
+_PAK = Limits(1.5)
+_ENVELOPE = Limits(0.5)
+
+# destination country of each family, None for any but Canada and the US
+FAMILY_COUNTRIES = {
+    'DOM': "CA",
+    'USA': "US",
+    'INT': None,
+}
+
+class ServiceInfo(namedtuple('ServiceInfo', (
+        'code', 'name', 'family', 'speed', 'tracked', 'phone_required',
+        'limits', 'options'))):
+    """
+    What the catalogue knows about a service code.
+      * family: "DOM" (Canada), "USA" or "INT" (other countries)
+      * speed: one of SPEEDS
+      * tracked: whether the parcel can be tracked
+      * phone_required: whether the destination needs a phone number
+      * limits: its Limits
+      * options: frozenset of the option codes it takes
+    """
+    __slots__ = ()
+
+    def ships_to(self, country_code):
+        expected = FAMILY_COUNTRIES[self.family]
+        country = country_code.upper()
+        if expected is None:
+            return country not in ("CA", "US")
+        return country == expected
+
+    @property
+    def speed_rank(self):
+        return SPEEDS.index(self.speed)
+
+def _service(code, name, speed, tracked=True, phone_required=False,
+             limits=None, options=None):
+    family = code.split(".", 1)[0]
+    if options is None:
+        options = _DOMESTIC_OPTIONS if family == "DOM" else _FOREIGN_OPTIONS
+    return ServiceInfo(code, name, family, speed, tracked, phone_required,
+                       limits or FAMILY_LIMITS[family], frozenset(options))
+
+SERVICES = (
+    _service("DOM.RP", "Regular Parcel", "economy"),
+    _service("DOM.EP", "Expedited Parcel", "expedited"),
+    _service("DOM.XP", "Xpresspost", "express"),
+    _service("DOM.XP.CERT", "Xpresspost Certified", "express"),
+    _service("DOM.PC", "Priority", "priority"),
+    _service("DOM.LIB", "Library Books", "economy",
+             options=(SIGNATURE, COVERAGE)),
+    _service("USA.EP", "Expedited Parcel USA", "expedited",
+             phone_required=True),
+    _service("USA.XP", "Xpresspost USA", "express", phone_required=True),
+    _service("USA.PW.ENV", "Priority Worldwide Envelope USA", "priority",
+             limits=_ENVELOPE),
+    _service("USA.PW.PAK", "Priority Worldwide pak USA", "priority",
+             phone_required=True, limits=_PAK),
+    _service("USA.PW.PARCEL", "Priority Worldwide Parcel USA", "priority",
+             phone_required=True),
+    _service("USA.TP", "Tracked Packet - USA", "expedited", limits=_PACKET,
+             options=_NON_DELIVERY | set((SIGNATURE, COVERAGE))),
+    _service("USA.TP.LVM", "Tracked Packet - USA (LVM)", "expedited",
+             limits=_PACKET,
+             options=_NON_DELIVERY | set((SIGNATURE, COVERAGE))),
+    _service("USA.SP.AIR", "Small Packet USA Air", "economy", tracked=False,
+             limits=_PACKET, options=(RETURN_TO_SENDER, ABANDON)),
+    _service("INT.XP", "Xpresspost International", "express",
+             phone_required=True),
+    _service("INT.IP.AIR", "International Parcel Air", "expedited"),
+    _service("INT.IP.SURF", "International Parcel Surface", "economy"),
+    _service("INT.PW.ENV", "Priority Worldwide Envelope Int'l", "priority",
+             limits=_ENVELOPE),
+    _service("INT.PW.PAK", "Priority Worldwide pak Int'l", "priority",
+             phone_required=True, limits=_PAK),
+    _service("INT.PW.PARCEL", "Priority Worldwide parcel Int'l", "priority",
+             phone_required=True),
+    _service("INT.TP", "Tracked Packet - International", "expedited",
+             limits=_PACKET,
+             options=_NON_DELIVERY | set((SIGNATURE, COVERAGE))),
+    _service("INT.SP.AIR", "Small Packet International Air", "economy",
+             tracked=False, limits=_PACKET,
+             options=(RETURN_TO_SENDER, ABANDON)),
+    _service("INT.SP.SURF", "Small Packet International Surface", "economy",
+             tracked=False, limits=_PACKET,
+             options=(RETURN_TO_SENDER, ABANDON)),
+)
+
+_BY_CODE = dict((service.code, service) for service in SERVICES)
+_BY_FAMILY = dict((family, frozenset(service.code for service in SERVICES
+                                     if service.family == family))
+                  for family in FAMILY_COUNTRIES)
+_BY_SPEED = dict((speed, frozenset(service.code for service in SERVICES
+                                   if service.speed == speed))
+                 for speed in SPEEDS)
+_TRACKED = frozenset(service.code for service in SERVICES if service.tracked)
+_PHONE_REQUIRED = frozenset(service.code for service in SERVICES
+                            if service.phone_required)
+_ALL = frozenset(_BY_CODE)
+
+def get(code):
+    """
+    The ServiceInfo of a service code, None if it isn't in the catalogue
+    """
+    return _BY_CODE.get(code)
+
+def codes():
+    """
+    All the service codes in the catalogue
+    """
+    return _ALL
+
+def limits(code):
+    """
+    The Limits of a service code. Codes that aren't in the catalogue get the
+    limits of their family, None if that's unknown too
+    """
+    service = _BY_CODE.get(code)
+    if service is not None:
+        return service.limits
+    return FAMILY_LIMITS.get(code.split(".", 1)[0])
+
+def phone_required(code):
+    return code in _PHONE_REQUIRED
+
+def _family(country_code):
+    country = country_code.upper()
+    return "DOM" if country == "CA" else "USA" if country == "US" else "INT"
+
+def select(destination=None, min_speed=None, speeds=None, tracked=None,
+           phone=None, options=(), codes=None):
+    """
+    Codes of the services matching all the criteria given:
+      destination -- ship to this country code
+      min_speed -- at least this fast (one of SPEEDS)
+      speeds -- one of these speeds
+      tracked -- tracked (True) or not (False)
+      phone -- False if the destination has no phone: rules out the services
+        that require one
+      options -- take all these option codes
+      codes -- only among these codes
+    Returns a frozenset
+    """
+    selected = _ALL if codes is None else _ALL.intersection(codes)
+    if destination is not None:
+        selected = selected & _BY_FAMILY[_family(destination)]
+    if min_speed is not None:
+        rank = SPEEDS.index(min_speed)
+        selected = selected & frozenset().union(*(_BY_SPEED[speed]
+                                                  for speed in SPEEDS[rank:]))
+    if speeds is not None:
+        selected = selected & frozenset().union(*(_BY_SPEED[speed]
+                                                  for speed in speeds))
+    if tracked is not None:
+        selected = selected & _TRACKED if tracked else selected - _TRACKED
+    if phone is False:
+        selected = selected - _PHONE_REQUIRED
+    if options:
+        options = frozenset(options)
+        selected = frozenset(code for code in selected
+                             if options <= _BY_CODE[code].options)
+    return selected
+
+def _size(parcel):
+    weight = float(parcel.weight or 0)
+    dimensions = sorted((float(parcel.length or 0), float(parcel.width or 0),
+                         float(parcel.height or 0)), reverse=True)
+    return weight, dimensions
+
+def candidates(parcel, destination, **criteria):
+    """
+    Codes of the services that can ship the parcel to the destination (a
+    canada_post.util.address.Destination) and match the criteria of
+    select(). The destination's phone is taken into account. An empty set
+    means there's no need to ask GetRates
+    """
+    criteria.setdefault('destination', destination.country_code)
+    if not destination.phone:
+        criteria.setdefault('phone', False)
+    weight, dimensions = _size(parcel)
+    return frozenset(code for code in select(**criteria)
+                     if _BY_CODE[code].limits.fits(weight, dimensions))
+
+def prune(services, parcel=None, destination=None, **criteria):
+    """
+    The Service objects (as returned by GetRates) whose code is in the
+    catalogue and matches the criteria of select(), and candidates() if the
+    parcel and destination are given, in the same order
+    """
+    if parcel is not None and destination is not None:
+        allowed = candidates(parcel, destination, **criteria)
+    else:
+        allowed = select(**criteria)
+    return [service for service in services if service.code in allowed]
+
+def rates(get_rates, parcel, origin, destination, **criteria):
+    """
+    Call get_rates (a GetRates service) for the services that match the
+    criteria, unless there's none, and return them
+    """
+    allowed = candidates(parcel, destination, **criteria)
+    if not allowed:
+        return []
+    return [service for service in get_rates(parcel, origin, destination,
+                                             services=sorted(allowed))
+            if service.code in allowed]
@@ -0,0 +1,200 @@
+"""
+Hedged requests, to cut the latency tail of read-only calls.
+
+The request is sent, and if it hasn't been answered after a delay taken from
+a percentile of the recent latencies (the 95th by default), a duplicate is
+sent and whichever answers first is used. Since only the slowest few percent
+of requests get a duplicate, the extra load stays small, and it's capped by a
+budget and by the service's rate limiter.
+
+A blocking request can't be cancelled, so the one that loses keeps its
+thread until it's answered, and it took a token of the rate limiter like any
+other request. Duplicates are only sent when a thread of the pool is idle,
+so that a late duplicate never waits for a thread, and the threads held by
+losers are at most the hedging budget.
+
+Only safe for idempotent requests, it's used by GetRates
+"""
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from canada_post.util.compat import monotonic
+
+# latencies kept to compute the hedging delay
+WINDOW = 1000
+# threads sending the hedged requests
+WORKERS = 32
+
+class LatencyTracker(object):
+    """
+    Thread safe record of the last `window` latencies, in seconds
+    """
+    def __init__(self, window=WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, percent):
+        """
+        The given percentile (0-100) of the recorded latencies, None if there's
+        none
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+class HedgePolicy(object):
+    """
+    percentile -- percentile of the recent latencies to wait for before
+        sending the duplicate request
+    min_delay, max_delay -- bounds of that delay, in seconds
+    initial_delay -- delay used until `min_samples` latencies have been
+        recorded
+    budget -- maximum fraction of the requests that can be hedged
+    workers -- threads sending requests. Each hedged call takes up to two of
+        them while it's waiting, and the losing request keeps its thread
+        until it's answered
+    The counters requests, hedged (duplicates sent), wins (calls answered by
+    the duplicate first) and skipped (duplicates not sent because of the
+    budget, the rate limiter or a busy pool) keep track of how much hedging
+    is going on. running is the number of requests the pool is sending,
+    losers included
+    """
+    log = logging.getLogger('canada_post.hedging.HedgePolicy')
+
+    def __init__(self, percentile=95, min_delay=0.01, max_delay=None,
+                 initial_delay=1.0, min_samples=20, budget=0.1,
+                 window=WINDOW, workers=WORKERS):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.workers = workers
+        self.latencies = LatencyTracker(window)
+        self.requests = 0
+        self.hedged = 0
+        self.wins = 0
+        self.skipped = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def close(self):
+        """
+        Stop the worker threads, once the calls in progress are done
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def delay(self):
+        """
+        Seconds to wait for the first request before sending the duplicate
+        """
+        if len(self.latencies) < self.min_samples:
+            return self.initial_delay
+        delay = max(self.min_delay,
+                    self.latencies.percentile(self.percentile))
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def start(self):
+        """
+        Count a new call
+        """
+        with self._lock:
+            self.requests += 1
+
+    def may_hedge(self, limiter=None):
+        """
+        Whether a duplicate can be sent now: within the budget, by an idle
+        thread of the pool, and if a rate limiter is given, without having to
+        wait for it. Counts the duplicate if it can
+        """
+        with self._lock:
+            allowed = self.hedged < self.budget * self.requests and \
+                self.running < self.workers and \
+                (limiter is None or limiter.available() >= 1)
+            if allowed:
+                self.hedged += 1
+            else:
+                self.skipped += 1
+            return allowed
+
+    def won(self):
+        with self._lock:
+            self.wins += 1
+
+    def _timed(self, send):
+        start = monotonic()
+        result = send()
+        self.latencies.record(monotonic() - start)
+        return result
+
+    def _submit(self, send):
+        with self._lock:
+            self.running += 1
+        future = self.executor.submit(self._timed, send)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self.running -= 1
+
+    def run(self, send, limiter=None):
+        """
+        Call send(), and call it once more if the first call hasn't returned
+        within delay(). Returns the result of the first call to return, or
+        raises the error of the last one to fail if both fail. The other call
+        isn't waited for
+        """
+        self.start()
+        primary = self._submit(send)
+        delay = self.delay()
+        done, _ = wait([primary], timeout=delay)
+        pending = set([primary])
+        if not done and self.may_hedge(limiter):
+            self.log.debug("No answer after %.3fs, hedging", delay)
+            pending.add(self._submit(send))
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                else:
+                    if future is not primary:
+                        self.won()
+                    # the other request is left to finish on its own
+                    return result
+        raise error
+
+    def __repr__(self):
+        return "HedgePolicy(percentile={percentile}, requests={requests}, " \
+               "hedged={hedged}, wins={wins}, skipped={skipped})".format(
+                   percentile=self.percentile, requests=self.requests,
+                   hedged=self.hedged, wins=self.wins, skipped=self.skipped)
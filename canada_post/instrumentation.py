@@ -0,0 +1,250 @@
+"""
+Instrumentation of the service calls.
+
+Every call to a service (GetRates, CreateShipment, VoidShipment...) is
+described by a Call: how long each phase took (build: computing the request
+values, serialize: rendering the XML, network: sending it and waiting for the
+response, including retries, parse: reading the response), the request and
+response sizes, the HTTP status, the number of requests sent (attempts,
+including retries and hedged duplicates) and the error, if any.
+
+Instruments are notified when a call starts and finishes. Register them on a
+service (service.add_instrument) or on all the services of a client
+(CanadaPostAPI(..., instruments=[...])). Services without instruments use
+NULL_CALL, whose methods do nothing, so there's next to no overhead.
+
+Two adapters are provided: PrometheusInstrument, which exports metrics with
+prometheus_client, and OpenTelemetryInstrument, which makes a span of every
+call
+"""
+import logging
+try:
+    from time import perf_counter
+except ImportError:
+    # python 2
+    from time import time as perf_counter
+
+class Call(object):
+    """
+    A call to a service, in progress or finished
+    """
+    __slots__ = ('service', 'start', 'end', 'phases', 'request_size',
+                 'response_size', 'status', 'attempts', 'cached', 'coalesced',
+                 'error', 'context', '_last', '_instruments')
+
+    def __init__(self, service, instruments):
+        self.service = service
+        self.phases = {}
+        self.request_size = self.response_size = self.status = None
+        self.attempts = 0
+        self.cached = self.coalesced = False
+        self.error = None
+        self.end = None
+        # per instrument state, e.g. its span
+        self.context = {}
+        self._instruments = instruments
+        self.start = self._last = perf_counter()
+        for instrument in instruments:
+            instrument.start(self)
+
+    @property
+    def duration(self):
+        return (self.end or perf_counter()) - self.start
+
+    def phase(self, name):
+        """
+        End the phase `name`, which started when the previous one ended
+        """
+        now = perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._last
+        self._last = now
+
+    def skip(self):
+        """
+        Don't count the time since the previous phase ended in any phase
+        """
+        self._last = perf_counter()
+
+    def request(self, content):
+        self.request_size = len(content)
+
+    def response(self, status, size=None):
+        """
+        Record an HTTP response: its status and its size, if known (e.g.
+        its Content-Length)
+        """
+        self.attempts += 1
+        self.status = status
+        if size is not None:
+            self.response_size = int(size)
+
+    def finish(self, error=None):
+        self.end = perf_counter()
+        self.error = error
+        for instrument in self._instruments:
+            try:
+                instrument.finish(self)
+            except Exception:
+                logging.getLogger('canada_post.instrumentation').exception(
+                    "Instrument %r failed", instrument)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # not GeneratorExit or KeyboardInterrupt
+        self.finish(exc_value if isinstance(exc_value, Exception) else None)
+
+    def __repr__(self):
+        return "Call({service}, status={status}, attempts={attempts}, " \
+               "duration={duration:.4f}, phases={phases})".format(
+                   service=self.service, status=self.status,
+                   attempts=self.attempts, duration=self.duration,
+                   phases=self.phases)
+
+class _NullCall(object):
+    """
+    Stands for a Call when there are no instruments
+    """
+    __slots__ = ()
+    attempts = 0
+
+    def phase(self, name):
+        pass
+
+    def skip(self):
+        pass
+
+    def request(self, content):
+        pass
+
+    def response(self, status, size=None):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_CALL = _NullCall()
+
+class Instrument(object):
+    """
+    Base class of the instruments: override start and/or finish, which get
+    the Call. They're called from the thread making the call
+    """
+    def start(self, call):
+        pass
+
+    def finish(self, call):
+        pass
+
+class PrometheusInstrument(Instrument):
+    """
+    Exports, labelled by service:
+      * {namespace}_calls_total: calls, also labelled by HTTP status (or
+        "cached", "coalesced" or "error" when there was none)
+      * {namespace}_call_seconds: call durations
+      * {namespace}_phase_seconds: phase durations, labelled by phase
+      * {namespace}_payload_bytes: request and response sizes, labelled by
+        direction ("request"/"response")
+      * {namespace}_retries_total: requests sent after the first one, by
+        retries or hedging
+
+    Requires prometheus_client (pip install python-canada-post[prometheus])
+    """
+    SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+    def __init__(self, registry=None, namespace="canada_post"):
+        import prometheus_client
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        self.calls = prometheus_client.Counter(
+            namespace + "_calls", "Canada Post API calls",
+            ("service", "status"), registry=registry)
+        self.durations = prometheus_client.Histogram(
+            namespace + "_call_seconds", "Canada Post API call durations",
+            ("service",), registry=registry)
+        self.phases = prometheus_client.Histogram(
+            namespace + "_phase_seconds",
+            "Canada Post API call phase durations", ("service", "phase"),
+            registry=registry)
+        self.sizes = prometheus_client.Histogram(
+            namespace + "_payload_bytes", "Canada Post API payload sizes",
+            ("service", "direction"), buckets=self.SIZE_BUCKETS,
+            registry=registry)
+        self.retries = prometheus_client.Counter(
+            namespace + "_retries", "Canada Post API request retries",
+            ("service",), registry=registry)
+
+    def finish(self, call):
+        if call.status is not None:
+            status = str(call.status)
+        else:
+            status = "cached" if call.cached else \
+                "coalesced" if call.coalesced else "error"
+        self.calls.labels(call.service, status).inc()
+        self.durations.labels(call.service).observe(call.duration)
+        for phase, seconds in call.phases.items():
+            self.phases.labels(call.service, phase).observe(seconds)
+        if call.request_size is not None:
+            self.sizes.labels(call.service, "request").observe(
+                call.request_size)
+        if call.response_size is not None:
+            self.sizes.labels(call.service, "response").observe(
+                call.response_size)
+        if call.attempts > 1:
+            self.retries.labels(call.service).inc(call.attempts - 1)
+
+class OpenTelemetryInstrument(Instrument):
+    """
+    Makes a span named "canada_post.{service}" of every call, with the
+    phase timings, sizes, status and attempts as attributes. Failed calls
+    record their exception and get an error status.
+
+    `tracer` is any OpenTelemetry API compatible tracer. The "canada_post"
+    tracer of the global provider is used if not given, which requires
+    opentelemetry-api (pip install python-canada-post[opentelemetry])
+    """
+    def __init__(self, tracer=None):
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer("canada_post")
+        self.tracer = tracer
+
+    def start(self, call):
+        call.context[self] = self.tracer.start_span(
+            "canada_post." + call.service, attributes={
+                'canada_post.service': call.service})
+
+    def finish(self, call):
+        span = call.context.pop(self)
+        for phase, seconds in call.phases.items():
+            span.set_attribute("canada_post.{0}_seconds".format(phase),
+                               seconds)
+        if call.request_size is not None:
+            span.set_attribute("canada_post.request_size", call.request_size)
+        if call.response_size is not None:
+            span.set_attribute("canada_post.response_size",
+                               call.response_size)
+        if call.status is not None:
+            span.set_attribute("http.status_code", call.status)
+        span.set_attribute("canada_post.attempts", call.attempts)
+        span.set_attribute("canada_post.cached", call.cached)
+        span.set_attribute("canada_post.coalesced", call.coalesced)
+        if call.error is not None:
+            span.record_exception(call.error)
+            try:
+                from opentelemetry.trace import Status, StatusCode
+            except ImportError:
+                pass
+            else:
+                span.set_status(Status(StatusCode.ERROR, str(call.error)))
+        span.end()
@@ -0,0 +1,301 @@
+"""
+Choice of the cheapest or fastest way to ship an order, among several origins
+(warehouses) and ways of packing it into parcels.
+
+A plan is a sequence of (origin, parcel) legs going to the same destination.
+combine() gives one plan per origin and packing split, but the legs of a plan
+can come from different origins too. An Optimizer quotes every distinct
+(origin, parcel) of the plans once, concurrently, with GetRates (so through
+its cache if it has one), picks the service of each leg and ranks the plans
+  * by cost: the sum of the prices of their legs
+  * or by transit: the expected transit time of their slowest leg, then cost
+within a maximum transit time and cost, and the criteria of
+canada_post.catalogue.select (min_speed, tracked, options...).
+
+    optimizer = Optimizer(cpa.get_rates)
+    result = optimizer(destination, combine(warehouses, splits),
+                       objective=TRANSIT, max_cost=Decimal("40"))
+    for leg in result.best.legs:
+        cpa.create_shipment(leg.parcel, leg.origin, destination, leg.service,
+                            group)
+
+The cached quotes are read inline, only the others go through a thread pool,
+and picking the services takes a sort of the quotes of each distinct leg. So
+with a warm cache, a checkout with a dozen plans is done in well under a
+millisecond
+"""
+from collections import namedtuple
+from canada_post import catalogue
+from canada_post.batch import run_many, WORKERS
+from canada_post.service.rating import scenario_key
+
+# objectives
+COST = "cost"
+TRANSIT = "transit"
+
+# transit time of the services that don't say, slower than any other
+_UNKNOWN = float("inf")
+
+class Leg(namedtuple('Leg', ('origin', 'parcel', 'service'))):
+    """
+    A parcel of a plan, with the origin it's shipped from and the Service
+    picked for it
+    """
+    __slots__ = ()
+
+class Plan(object):
+    """
+    A plan with the services picked for it.
+      * index is its position in the plans given to the Optimizer
+      * legs is the list of Leg
+      * cost is the sum of the prices of the legs
+      * transit_time is the expected transit time of the slowest leg, None if
+        a service doesn't tell
+    """
+    __slots__ = ('index', 'legs', 'cost', 'transit_time')
+
+    def __init__(self, index, legs, cost, transit_time):
+        self.index = index
+        self.legs = legs
+        self.cost = cost
+        self.transit_time = transit_time
+
+    def __repr__(self):
+        return "Plan(index={index}, cost={cost}, transit_time={transit}, " \
+               "services={services})".format(
+                   index=self.index, cost=self.cost,
+                   transit=self.transit_time,
+                   services=[leg.service.code for leg in self.legs])
+
+class Result(object):
+    """
+    Outcome of an optimization.
+      * plans is the list of the Plans that meet the constraints, best first
+      * errors is the list of (origin, parcel, exception) of the quotes that
+        failed. The plans with those legs are left out
+    """
+    __slots__ = ('plans', 'errors')
+
+    def __init__(self, plans, errors):
+        self.plans = plans
+        self.errors = errors
+
+    @property
+    def best(self):
+        """
+        The best Plan, None if none meets the constraints
+        """
+        return self.plans[0] if self.plans else None
+
+    def __repr__(self):
+        return "Result(best={best!r}, plans={plans}, errors={errors})".format(
+            best=self.best, plans=len(self.plans), errors=len(self.errors))
+
+def combine(origins, splits):
+    """
+    One plan per origin and split, a split being the list of parcels an
+    order is packed into. Empty splits are left out
+    """
+    return [[(origin, parcel) for parcel in split]
+            for origin in origins for split in splits if split]
+
+def _transit(service):
+    # services unpickled from a cache written by older versions have none
+    transit = getattr(service, 'transit_time', None)
+    return _UNKNOWN if transit is None else transit
+
+def _plan_transit(plan):
+    return _UNKNOWN if plan.transit_time is None else plan.transit_time
+
+def _pick(options, limit):
+    """
+    The cheapest (cost, transit, service) of each leg's options (sorted by
+    cost) within the transit limit, None if a leg has none
+    """
+    picks = []
+    for leg_options in options:
+        for option in leg_options:
+            if option[1] <= limit:
+                picks.append(option)
+                break
+        else:
+            return None
+    return picks
+
+class Optimizer(object):
+    def __init__(self, get_rates, workers=WORKERS, rate=None, price="due"):
+        """
+        get_rates -- the GetRates service to quote with
+        workers -- number of concurrent quotes
+        rate -- if given, the maximum number of quotes started per second
+        price -- the Price attribute that's compared: "due" (with taxes) or
+            "total" (without)
+        """
+        self.get_rates = get_rates
+        self.workers = workers
+        self.rate = rate
+        self.price = price
+
+    def _rates(self, parcel, origin, destination, criteria, cached=None):
+        """
+        The services of the scenario that match the criteria. `cached` are
+        its services if they were found in the cache, otherwise they're
+        requested
+        """
+        if criteria:
+            allowed = catalogue.candidates(parcel, destination, **criteria)
+            if not allowed:
+                return []
+        # the unfiltered quote, so that cached ones are reused
+        if cached is None:
+            cached = self.get_rates.refresh(parcel, origin, destination)
+        if not criteria:
+            return list(cached)
+        return [service for service in cached if service.code in allowed]
+
+    def keys(self, destination, plans):
+        """
+        The canada_post.service.rating.scenario_key of every leg of the plans,
+        as a list per plan
+        """
+        auth = self.get_rates.auth
+        # plans usually share their origin and parcel objects
+        known = {}
+        keys = []
+        for plan in plans:
+            plan_keys = []
+            for origin, parcel in plan:
+                try:
+                    key = known[id(origin), id(parcel)]
+                except KeyError:
+                    key = known[id(origin), id(parcel)] = scenario_key(
+                        auth, parcel, origin, destination)
+                plan_keys.append(key)
+            keys.append(plan_keys)
+        return keys
+
+    def quote(self, destination, plans, keys=None, **criteria):
+        """
+        Quote every distinct (origin, parcel) of the plans. Returns a dict of
+        scenario key -> list of the Service objects that match the criteria
+        of catalogue.select, or the exception raised. `keys` are the plans'
+        keys if they were already computed with keys()
+        """
+        if keys is None:
+            keys = self.keys(destination, plans)
+        scenarios = {}
+        for plan, plan_keys in zip(plans, keys):
+            for (origin, parcel), key in zip(plan, plan_keys):
+                if key not in scenarios:
+                    scenarios[key] = (parcel, origin, destination, criteria)
+        quotes = {}
+        cache = self.get_rates.cache
+        misses = []
+        for key, args in scenarios.items():
+            # the only lookup of the scenario: the cached ones are quicker to
+            #  get inline than on a thread pool, the others are requested
+            #  without looking them up again
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None or len(scenarios) == 1:
+                try:
+                    quotes[key] = self._rates(*args, cached=cached)
+                except Exception as e:
+                    quotes[key] = e
+            else:
+                misses.append(key)
+        for result in run_many(self._rates, [scenarios[key] for key in misses],
+                               workers=self.workers, rate=self.rate):
+            quotes[misses[result.index]] = result.value if result.ok \
+                else result.error
+        return quotes
+
+    def rank(self, quotes, destination, plans, objective=COST,
+             max_transit=None, max_cost=None, keys=None):
+        """
+        Rank the plans with the quotes returned by quote(), see __call__
+        """
+        if keys is None:
+            keys = self.keys(destination, plans)
+        if objective not in (COST, TRANSIT):
+            raise ValueError("Unknown objective {0!r}".format(objective))
+        price = self.price
+        limit = _UNKNOWN if max_transit is None else max_transit
+        # key -> the (cost, transit, service) of the quotes, cheapest first
+        options = {}
+        ranked = []
+        errors = []
+        for index, (plan, plan_keys) in enumerate(zip(plans, keys)):
+            plan = list(plan)
+            if not plan:
+                # ships nothing, so it can't be picked
+                continue
+            plan_options = []
+            for (origin, parcel), key in zip(plan, plan_keys):
+                leg_options = options.get(key)
+                if leg_options is None:
+                    services = quotes[key]
+                    if isinstance(services, Exception):
+                        errors.append((origin, parcel, services))
+                        leg_options = ()
+                    else:
+                        leg_options = sorted(
+                            ((getattr(service.price, price),
+                              _transit(service), service)
+                             for service in services),
+                            key=lambda option: option[:2])
+                    options[key] = leg_options
+                plan_options.append(leg_options)
+            if not all(plan_options):
+                continue
+            if objective == COST:
+                limits = (limit,)
+            else:
+                # the fastest limit that every leg can meet first
+                limits = sorted(set(option[1] for leg_options in plan_options
+                                    for option in leg_options
+                                    if option[1] <= limit))
+            for transit_limit in limits:
+                picks = _pick(plan_options, transit_limit)
+                if picks is None:
+                    continue
+                cost = sum(pick[0] for pick in picks)
+                if max_cost is not None and cost > max_cost:
+                    # slower services can only be cheaper
+                    continue
+                transit = max(pick[1] for pick in picks)
+                ranked.append(Plan(index,
+                                   [Leg(origin, parcel, pick[2])
+                                    for (origin, parcel), pick in
+                                    zip(plan, picks)],
+                                   cost,
+                                   None if transit == _UNKNOWN else transit))
+                break
+        if objective == COST:
+            ranked.sort(key=lambda plan: (plan.cost, _plan_transit(plan),
+                                          plan.index))
+        else:
+            ranked.sort(key=lambda plan: (_plan_transit(plan), plan.cost,
+                                          plan.index))
+        return Result(ranked, errors)
+
+    def __call__(self, destination, plans, objective=COST, max_transit=None,
+                 max_cost=None, **criteria):
+        """
+        Quote the plans (sequences of (origin, parcel)) to the destination and
+        return a Result with those that meet the constraints, best first.
+        Empty plans never do
+
+        objective -- COST ranks by the sum of the prices of the legs, TRANSIT
+            by the transit time of the slowest leg and then cost
+        max_transit -- maximum expected transit time of every leg, in
+            business days. Services that don't tell theirs don't meet it
+        max_cost -- maximum cost of a plan
+        criteria -- any of catalogue.select's, the services of the legs must
+            meet them
+        """
+        plans = [list(plan) for plan in plans]
+        keys = self.keys(destination, plans)
+        quotes = self.quote(destination, plans, keys=keys, **criteria)
+        return self.rank(quotes, destination, plans, objective=objective,
+                         max_transit=max_transit, max_cost=max_cost,
+                         keys=keys)
@@ -0,0 +1,252 @@
+"""
+Client-side rate limiting.
+
+TokenBucket is a plain thread safe token bucket. RateLimiter adds adaptive
+throttling on top of it: when the server answers with a throttling response the
+rate is cut down and the bucket is held until the server's Retry-After has
+passed, then it grows back while responses succeed.
+
+Both work for threads (acquire() sleeps) and asyncio (reserve() takes the
+tokens without blocking and returns the delay, to be awaited with
+asyncio.sleep)
+"""
+import threading
+import time
+from canada_post.util.compat import monotonic
+
+# HTTP statuses that mean we're being throttled
+THROTTLE_STATUSES = (429, 503)
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: allows `rate` calls per second on average, with
+    bursts of up to `burst` calls
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Take `tokens` tokens from the bucket and return how many seconds the
+        caller has to wait before using them. The tokens are taken right away
+        even if the caller has to wait, so concurrent callers queue up in
+        order
+        """
+        with self._lock:
+            now = monotonic()
+            # the bucket only refills from _updated on, which a hold can
+            #  push into the future
+            if now > self._updated:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens -= tokens
+            delay = self._updated - now
+            if self._tokens < 0:
+                delay += -self._tokens / self.rate
+            return delay
+
+    def available(self):
+        """
+        Number of tokens that can be taken right now without waiting. Doesn't
+        take any
+        """
+        with self._lock:
+            return min(self.burst, self._tokens +
+                       max(0.0, monotonic() - self._updated) * self.rate)
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` tokens are available
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def __repr__(self):
+        return "TokenBucket(rate={rate}, burst={burst})".format(
+            rate=self.rate, burst=self.burst)
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a Retry-After header value, either a number
+    of seconds or an HTTP date. None if it can't be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+class RateLimiter(TokenBucket):
+    """
+    Adaptive token bucket. Allows up to `rate` calls per second (with bursts of
+    up to `burst`). A throttled response halves the current rate (down to
+    `min_rate`) and holds every caller until its Retry-After has passed, or
+    for `backoff` seconds if it has none. Further throttled responses while
+    held only extend the hold. The callers that queue up during the hold
+    are let through at the reduced rate once it ends, one after the other.
+    Each successful response then adds `rate * increase` back, up to the
+    configured rate
+    """
+    def __init__(self, rate, burst=1, min_rate=None, decrease=0.5,
+                 increase=0.05, backoff=1.0):
+        super(RateLimiter, self).__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = float(min_rate) if min_rate else self.rate / 20
+        self.decrease = decrease
+        self.increase = increase
+        self.backoff = backoff
+        self.throttled = 0
+        self._blocked_until = 0.0
+
+    def configure(self, rate, burst=1, min_rate=None, decrease=0.5,
+                  increase=0.05, backoff=1.0):
+        """
+        Change the parameters in place, so that the callers already using the
+        limiter follow them. A rate cut down by throttling stays cut down, to
+        the new rate at most
+        """
+        with self._lock:
+            rate = float(rate)
+            if self.rate >= self.max_rate:
+                self.rate = rate
+            else:
+                self.rate = min(self.rate, rate)
+            self.max_rate = rate
+            self.burst = burst
+            self._tokens = min(self._tokens, float(burst))
+            self.min_rate = float(min_rate) if min_rate else rate / 20
+            self.decrease = decrease
+            self.increase = increase
+            self.backoff = backoff
+
+    def available(self):
+        if monotonic() < self._blocked_until:
+            return 0.0
+        return super(RateLimiter, self).available()
+
+    def penalize(self, retry_after=None):
+        """
+        Record a throttling response. retry_after is the delay, in seconds,
+        the server asked for, if any
+        """
+        with self._lock:
+            self.throttled += 1
+            now = monotonic()
+            if now >= self._blocked_until:
+                # requests that were already in flight when we got throttled
+                #  will likely be throttled too, only slow down once for them
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            delay = self.backoff if retry_after is None else retry_after
+            self._blocked_until = max(self._blocked_until, now + delay)
+            # the bucket refills from the end of the block, so the callers
+            #  queued in the meantime are spaced at the new rate rather than
+            #  all let through when it ends. Don't let the tokens saved up
+            #  before let a burst through either
+            if now > self._updated:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = max(self._updated, self._blocked_until)
+
+    def reward(self):
+        """
+        Record a successful response
+        """
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate * self.increase)
+
+    def update(self, status_code, retry_after=None):
+        """
+        Adapt to a response with the given status code and Retry-After header
+        value
+        """
+        if status_code in THROTTLE_STATUSES:
+            self.penalize(parse_retry_after(retry_after))
+        else:
+            self.reward()
+
+    def __repr__(self):
+        return "RateLimiter(rate={rate}, max_rate={max_rate}, burst={burst}, " \
+               "throttled={throttled})".format(rate=self.rate,
+                                               max_rate=self.max_rate,
+                                               burst=self.burst,
+                                               throttled=self.throttled)
+
+class RateLimiterRegistry(object):
+    """
+    Shares RateLimiters between services. There's one limiter per service
+    name and set of credentials, since Canada Post enforces its quotas per
+    account, so every client using the same account draws from the same
+    budget
+    """
+    def __init__(self):
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, service, auth, rate, burst=1, **kwargs):
+        """
+        Return the limiter for the service name (e.g. "GetRates") and
+        canada_post.Auth, creating it with the given parameters (see
+        RateLimiter) if it doesn't exist yet. If it was created with different
+        ones, it's reconfigured in place: every client of the account keeps
+        drawing from the same budget
+        """
+        key = (service,) + auth.account
+        config = (rate, burst, sorted(kwargs.items()))
+        with self._lock:
+            entry = self._limiters.get(key)
+            if entry is None:
+                entry = self._limiters[key] = (config, RateLimiter(
+                    rate, burst, **kwargs))
+            elif entry[0] != config:
+                entry[1].configure(rate, burst, **kwargs)
+                entry = self._limiters[key] = (config, entry[1])
+            return entry[1]
+
+    def for_service(self, service, auth, limit):
+        """
+        Return the limiter for the service name and Auth according to `limit`,
+        which can be
+          * None, for no limit
+          * a number of calls per second, or a (rate, burst) tuple
+          * a RateLimiter, returned as is
+          * a dict of service name -> any of the above
+        """
+        if isinstance(limit, dict):
+            limit = limit.get(service)
+        if limit is None or isinstance(limit, TokenBucket):
+            return limit
+        if isinstance(limit, (tuple, list)):
+            return self.get(service, auth, *limit)
+        return self.get(service, auth, limit)
+
+    def discard(self, auth):
+        """
+        Forget the limiters of the credentials, e.g. once their account is
+        removed. The next clients using them get new ones
+        """
+        with self._lock:
+            for key in [key for key in self._limiters
+                        if key[1:] == auth.account]:
+                del self._limiters[key]
+
+    def clear(self):
+        with self._lock:
+            self._limiters.clear()
+
+# process wide registry used by CanadaPostAPI
+registry = RateLimiterRegistry()
@@ -0,0 +1,330 @@
+"""
+Precomputed rate tables, for estimates that don't need a live quote (cart
+previews and the like).
+
+A RateGrid describes the mailing scenarios to sweep: origin postal codes (one
+per forward sortation area, the first three characters), destinations (one per
+Canadian FSA, US zip prefix or country), weight breakpoints and optionally
+parcel dimension brackets. RateTable.build quotes every scenario with GetRates
+and keeps the prices in a NumPy array indexed by
+(origin, destination, bracket, weight, service, price field).
+
+Lookups are a few dict lookups and a vectorized linear interpolation between
+the two weight breakpoints around the parcel's weight, for all the services at
+once. refresh() only quotes the cells that are missing or older than a given
+age, and save()/load() keep the table in a compressed .npz file.
+
+    grid = RateGrid(origins=["H2B1A0"],
+                    destinations=[Destination("CA", postal_code="K1A0B1"),
+                                  Destination("US", postal_code="10001"),
+                                  Destination("FR", postal_code="")],
+                    weights=[0.5, 1, 2, 5, 10, 20, 30],
+                    dimensions=[(20, 15, 10), (40, 30, 20), (100, 50, 50)])
+    table = RateTable.build(cpa.get_rates, grid)
+    services = table.estimate(parcel, origin, destination)
+
+Requires numpy (pip install python-canada-post[ratetable])
+"""
+import bisect
+import json
+import logging
+import time
+from decimal import Decimal
+
+import numpy
+
+from canada_post.batch import run_many, WORKERS
+from canada_post.service import Service
+from canada_post.util.address import Origin, Destination
+from canada_post.util.money import Price
+from canada_post.util.parcel import Parcel
+
+# the Price attributes kept in the table, in the order of its last axis
+PRICE_FIELDS = ("base", "gst", "pst", "hst", "due")
+_DUE = PRICE_FIELDS.index("due")
+
+def origin_key(postal_code):
+    """
+    Key of an origin postal code in a table: its forward sortation area
+    """
+    return postal_code.replace(" ", "").upper()[:3]
+
+def destination_key(country_code, postal_code=None):
+    """
+    Key of a destination in a table: the FSA of Canadian postal codes, the
+    first three digits of US zip codes, the country for everything else
+    """
+    country = country_code.upper()
+    if country in ("CA", "US") and postal_code:
+        return "{0}:{1}".format(country,
+                                postal_code.replace(" ", "").upper()[:3])
+    return country
+
+def _dimensions(parcel):
+    """
+    The parcel's dimensions, largest first
+    """
+    return sorted((float(parcel.length or 0), float(parcel.width or 0),
+                   float(parcel.height or 0)), reverse=True)
+
+class RateGrid(object):
+    """
+    The scenarios a RateTable is built from.
+
+    origins -- origin postal codes, one per FSA they represent
+    destinations -- Destination objects, one per destination key (see
+        destination_key). The first one of each country is also used for the
+        postal codes of that country that aren't in the grid
+    weights -- weight breakpoints, in kg
+    dimensions -- (length, width, height) brackets in cm. A parcel is rated
+        with the smallest bracket it fits in, so estimates for parcels
+        charged by volumetric weight err on the high side. None to quote
+        without dimensions
+    """
+    def __init__(self, origins, destinations, weights, dimensions=None):
+        self.origins = [origin.replace(" ", "").upper() for origin in origins]
+        self.destinations = list(destinations)
+        self.weights = sorted(float(weight) for weight in weights)
+        if dimensions:
+            self.dimensions = sorted(
+                (tuple(sorted((float(dim) for dim in bracket), reverse=True))
+                 for bracket in dimensions),
+                key=lambda bracket: bracket[0] * bracket[1] * bracket[2])
+        else:
+            self.dimensions = [(0.0, 0.0, 0.0)]
+
+    @property
+    def shape(self):
+        return (len(self.origins), len(self.destinations),
+                len(self.dimensions), len(self.weights))
+
+    def scenario(self, cell):
+        """
+        The (parcel, origin, destination) to quote for a cell, an (origin,
+        destination, bracket, weight) index tuple
+        """
+        origin, destination, bracket, weight = cell
+        length, width, height = self.dimensions[bracket]
+        parcel = Parcel(weight=self.weights[weight], length=length,
+                        width=width, height=height)
+        return (parcel, Origin(postal_code=self.origins[origin]),
+                self.destinations[destination])
+
+    def as_dict(self):
+        return {
+            'origins': self.origins,
+            'destinations': [(destination.country_code,
+                              destination.postal_code)
+                             for destination in self.destinations],
+            'weights': self.weights,
+            'dimensions': self.dimensions,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['origins'],
+                   [Destination(country, postal_code=postal_code or "")
+                    for country, postal_code in data['destinations']],
+                   data['weights'], data['dimensions'])
+
+class RateTable(object):
+    """
+    Prices for every scenario of a RateGrid and every service quoted for any
+    of them. `prices` is a float32 array of shape
+    grid.shape + (len(services), len(PRICE_FIELDS)), NaN where a service
+    wasn't offered or the scenario hasn't been quoted yet. `updated` has the
+    time each scenario was last quoted, 0 if never
+    """
+    log = logging.getLogger('canada_post.ratetable.RateTable')
+
+    def __init__(self, grid, services=(), names=None, prices=None,
+                 updated=None):
+        self.grid = grid
+        self.services = list(services)
+        self.names = dict(names or {})
+        if prices is None:
+            prices = numpy.full(grid.shape + (len(self.services),
+                                              len(PRICE_FIELDS)),
+                                numpy.nan, dtype=numpy.float32)
+        self.prices = prices
+        self.updated = updated if updated is not None else \
+            numpy.zeros(grid.shape)
+        self._index()
+
+    def _index(self):
+        self._origins = dict((origin_key(origin), index)
+                             for index, origin in enumerate(self.grid.origins))
+        self._destinations = {}
+        for index, destination in enumerate(self.grid.destinations):
+            self._destinations.setdefault(
+                destination_key(destination.country_code,
+                                destination.postal_code), index)
+            self._destinations.setdefault(
+                destination.country_code.upper(), index)
+        self._services = dict((code, index)
+                              for index, code in enumerate(self.services))
+        self._sized = any(any(bracket) for bracket in self.grid.dimensions)
+
+    @classmethod
+    def build(cls, get_rates, grid, workers=WORKERS, rate=None):
+        """
+        Quote every scenario of the grid with the GetRates service and return
+        the table
+        """
+        table = cls(grid)
+        table.refresh(get_rates, workers=workers, rate=rate)
+        return table
+
+    def stale(self, max_age=None, origins=None, destinations=None):
+        """
+        The cells that were never quoted or were quoted more than max_age
+        seconds ago (all of them if max_age is None), optionally only for
+        the given origin and destination keys
+        """
+        mask = numpy.ones(self.updated.shape, dtype=bool)
+        if max_age is not None:
+            mask &= (self.updated == 0) | \
+                (self.updated < time.time() - max_age)
+        if origins is not None:
+            selected = numpy.zeros(mask.shape[0], dtype=bool)
+            selected[[self._origins[origin_key(origin)]
+                      for origin in origins]] = True
+            mask &= selected[:, None, None, None]
+        if destinations is not None:
+            selected = numpy.zeros(mask.shape[1], dtype=bool)
+            selected[[self._destinations[key] for key in destinations]] = True
+            mask &= selected[None, :, None, None]
+        return [tuple(int(index) for index in cell)
+                for cell in numpy.argwhere(mask)]
+
+    def refresh(self, get_rates, max_age=None, origins=None,
+                destinations=None, workers=WORKERS, rate=None):
+        """
+        Quote again the cells returned by stale() for the same arguments.
+        Returns the (updated, failed) number of cells. Failed cells keep
+        their previous prices
+        """
+        cells = self.stale(max_age, origins, destinations)
+        updated = failed = 0
+        scenarios = (self.grid.scenario(cell) for cell in cells)
+        for result in run_many(get_rates, scenarios, workers=workers,
+                               rate=rate, ordered=False):
+            if result.ok:
+                self._store(cells[result.index], result.value)
+                updated += 1
+            else:
+                self.log.warning("Couldn't quote %s: %r", result.input,
+                                 result.error)
+                failed += 1
+        self.log.info("Refreshed %d cells, %d failed", updated, failed)
+        return updated, failed
+
+    def _service_index(self, service):
+        index = self._services.get(service.code)
+        if index is None:
+            index = self._services[service.code] = len(self.services)
+            self.services.append(service.code)
+            missing = numpy.full(self.prices.shape[:-2] +
+                                 (1, len(PRICE_FIELDS)),
+                                 numpy.nan, dtype=numpy.float32)
+            self.prices = numpy.concatenate((self.prices, missing), axis=-2)
+        self.names[service.code] = service.name
+        return index
+
+    def _store(self, cell, services):
+        indexes = [self._service_index(service) for service in services]
+        row = numpy.full((len(self.services), len(PRICE_FIELDS)), numpy.nan,
+                         dtype=numpy.float32)
+        for index, service in zip(indexes, services):
+            row[index] = [float(getattr(service.price, field))
+                          for field in PRICE_FIELDS]
+        self.prices[cell] = row
+        self.updated[cell] = time.time()
+
+    def lookup(self, parcel, origin, destination):
+        """
+        Estimated prices of all the services for the parcel: an array of
+        shape (len(services), len(PRICE_FIELDS)), NaN for the services that
+        aren't offered. Raises KeyError if the scenario isn't covered by the
+        table
+        """
+        try:
+            o = self._origins[origin_key(origin.postal_code)]
+        except KeyError:
+            raise KeyError("No rates from {0}".format(origin.postal_code))
+        d = self._destinations.get(destination_key(destination.country_code,
+                                                   destination.postal_code))
+        if d is None:
+            d = self._destinations.get(destination.country_code.upper())
+            if d is None:
+                raise KeyError("No rates to {0} {1}".format(
+                    destination.country_code, destination.postal_code))
+        b = 0
+        if self._sized:
+            dimensions = _dimensions(parcel)
+            # few brackets, plain python beats numpy here
+            for b, bracket in enumerate(self.grid.dimensions):
+                if bracket[0] >= dimensions[0] and \
+                        bracket[1] >= dimensions[1] and \
+                        bracket[2] >= dimensions[2]:
+                    break
+            else:
+                raise KeyError("No dimension bracket fits {0}".format(
+                    dimensions))
+
+        weights = self.grid.weights
+        weight = float(parcel.weight)
+        w = bisect.bisect_left(weights, weight)
+        prices = self.prices[o, d, b]
+        if w == 0:
+            return prices[0]
+        if w == len(weights):
+            raise KeyError("No rates over {0}kg".format(weights[-1]))
+        low, high = weights[w - 1], weights[w]
+        fraction = (weight - low) / (high - low)
+        return prices[w - 1] + (prices[w] - prices[w - 1]) * fraction
+
+    def estimate(self, parcel, origin, destination):
+        """
+        Estimated Service objects for the parcel, cheapest first, like the
+        ones GetRates returns but without adjustments and links. Building
+        the objects takes longer than the lookup itself, use lookup() when
+        the array is enough
+        """
+        prices = self.lookup(parcel, origin, destination).tolist()
+        services = []
+        for code, values in zip(self.services, prices):
+            if values[_DUE] != values[_DUE]:
+                # NaN, not offered
+                continue
+            price = Price(**dict(
+                (field, Decimal("{0:.2f}".format(value)))
+                for field, value in zip(PRICE_FIELDS, values)))
+            services.append(Service(data={'code': code,
+                                          'name': self.names.get(code),
+                                          'price': price}))
+        services.sort(key=lambda service: service.price.due)
+        return services
+
+    def save(self, path):
+        """
+        Write the table to a compressed .npz file
+        """
+        meta = {
+            'grid': self.grid.as_dict(),
+            'services': self.services,
+            'names': self.names,
+        }
+        numpy.savez_compressed(path, prices=self.prices,
+                               updated=self.updated,
+                               meta=numpy.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a table written by save()
+        """
+        with numpy.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(RateGrid.from_dict(meta['grid']), meta['services'],
+                       meta['names'], data['prices'], data['updated'])
@@ -0,0 +1,220 @@
+"""
+Retries of failed requests, with exponential backoff and jitter.
+
+Whether a failure can be retried depends on the operation: idempotent ones
+(GetRates, VoidShipment) are retried on any retryable status or exception, but
+a CreateShipment that failed after the request may have reached Canada Post
+could create a duplicate shipment. Those ambiguous failures are only retried
+if the service provides a way to check whether the first attempt went through
+(see CreateShipment's reference parameter)
+"""
+import logging
+import random
+import threading
+import time
+
+from canada_post.ratelimit import parse_retry_after
+from canada_post.util.compat import monotonic
+
+# statuses for which a request is retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# statuses that guarantee the request wasn't processed, so that even
+#  non-idempotent requests can be retried
+SAFE_STATUSES = (429, 503)
+
+class OutcomeUnknown(Exception):
+    """
+    A request that may have been processed failed, and looking up its result
+    failed too, so whether it went through is unknown. It mustn't be sent
+    again before checking, e.g. by looking for the shipment's reference in
+    its group.
+      * error is the exception of the failed attempt, None if it was an HTTP
+        error response
+      * response is that response, None otherwise
+      * lookup_error is the exception the lookup raised
+    """
+    def __init__(self, error, response, lookup_error):
+        self.error = error
+        self.response = response
+        self.lookup_error = lookup_error
+        failure = error if error is not None else \
+            "HTTP {0}".format(response.status_code)
+        super(OutcomeUnknown, self).__init__(
+            "Outcome unknown after {0!r}, the lookup of its result failed "
+            "with {1!r}".format(failure, lookup_error))
+
+class RetryStats(object):
+    """
+    Retry metrics of a service
+      * calls: requests made through the policy
+      * attempts: requests actually sent, including retries
+      * retries: attempts - first attempts
+      * recovered: ambiguous failures resolved by finding the result of a
+        previous attempt
+      * gave_up: calls that failed after retrying, or that weren't retried
+        because it wasn't safe
+      * retry_time: seconds spent in failed attempts and backoff waits
+    """
+    def __init__(self):
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.recovered = 0
+        self.gave_up = 0
+        self.retry_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'recovered': self.recovered,
+            'gave_up': self.gave_up,
+            'retry_time': self.retry_time,
+        }
+
+    def __repr__(self):
+        return "RetryStats({0})".format(", ".join(
+            "{0}={1}".format(name, value)
+            for name, value in sorted(self.as_dict().items())))
+
+class RetryPolicy(object):
+    """
+    max_attempts -- attempts per call, including the first one
+    backoff -- base delay before the first retry, in seconds. Doubles with
+        each retry, up to max_backoff
+    jitter -- fraction of the delay that's randomized: 1 waits anything between
+        0 and the delay ("full jitter"), 0 always waits the full delay
+    retry_statuses -- HTTP statuses that are retried
+    retry_exceptions -- exception types that are retried. requests'
+        ConnectionError and Timeout by default
+    deadline -- if set, no retry is attempted when it would end more than
+        this many seconds after the call started
+    A Retry-After header in the response is always honoured as the minimum
+    delay
+    """
+    log = logging.getLogger('canada_post.retry.RetryPolicy')
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=10.0,
+                 jitter=1.0, retry_statuses=RETRY_STATUSES,
+                 retry_exceptions=None,
+                 deadline=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self._retry_exceptions = retry_exceptions
+        self.deadline = deadline
+        self._random = random.Random()
+
+    @property
+    def retry_exceptions(self):
+        # requests is only imported once a request is sent
+        if self._retry_exceptions is None:
+            import requests
+            self._retry_exceptions = (requests.ConnectionError,
+                                      requests.Timeout)
+        return self._retry_exceptions
+
+    @retry_exceptions.setter
+    def retry_exceptions(self, value):
+        self._retry_exceptions = value
+
+    def delay(self, retry, retry_after=None):
+        """
+        Seconds to wait before the given retry (1 for the first one)
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        delay -= delay * self.jitter * self._random.random()
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _is_safe(self, response, error):
+        """
+        Whether the failed attempt surely didn't reach the server
+        """
+        if error is not None:
+            import requests
+            return isinstance(error, requests.ConnectTimeout)
+        return response.status_code in SAFE_STATUSES
+
+    def run(self, send, idempotent=True, recover=None, stats=None):
+        """
+        Call send() until it returns a response that isn't retryable, raises a
+        non-retryable exception, or attempts run out. Returns the last response
+        or raises the last exception.
+
+        If the operation isn't idempotent, failures where the request may have
+        been processed are only retried if `recover` is given: it's called
+        before retrying and if it returns anything but None, that's returned
+        as the result of the call. If it raises, the request isn't sent again
+        and an OutcomeUnknown is raised
+        """
+        stats = stats if stats is not None else RetryStats()
+        start = monotonic()
+        stats.add(calls=1)
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_start = monotonic()
+            stats.add(attempts=1)
+            response = error = None
+            try:
+                response = send()
+            except self.retry_exceptions as e:
+                error = e
+            else:
+                if response.status_code not in self.retry_statuses:
+                    return response
+            failure = error if error is not None else \
+                "HTTP {0}".format(response.status_code)
+
+            retry_after = None
+            if response is not None:
+                retry_after = parse_retry_after(
+                    response.headers.get('Retry-After'))
+            delay = self.delay(attempt, retry_after)
+            elapsed = monotonic() - start
+            out_of_time = (self.deadline is not None and
+                           elapsed + delay > self.deadline)
+            safe = idempotent or self._is_safe(response, error)
+            if attempt >= self.max_attempts or out_of_time or \
+                    not (safe or recover is not None):
+                self.log.info("Giving up after %d attempts: %s", attempt,
+                              failure)
+                stats.add(gave_up=1,
+                          retry_time=monotonic() - attempt_start)
+                if error is not None:
+                    raise error
+                return response
+
+            self.log.info("Attempt %d failed (%s), retrying in %.2fs",
+                          attempt, failure, delay)
+            if response is not None:
+                # give its connection back to the pool, it isn't read when
+                #  the request is streamed
+                response.close()
+            time.sleep(delay)
+            if not safe:
+                try:
+                    recovered = recover()
+                except Exception as e:
+                    self.log.warning("Outcome unknown after %s, the lookup "
+                                     "failed: %r", failure, e)
+                    stats.add(gave_up=1,
+                              retry_time=monotonic() - attempt_start)
+                    raise OutcomeUnknown(error, response, e)
+                if recovered is not None:
+                    self.log.info("Found the result of a previous attempt")
+                    stats.add(recovered=1,
+                              retry_time=monotonic() - attempt_start)
+                    return recovered
+            stats.add(retries=1, retry_time=monotonic() - attempt_start)
@@ -3,8 +3,10 @@ Different Canada Post Developer Program services
 """
 import logging
 from canada_post import DEV, PROD
-from canada_post.util.money import Price, get_decimal, Adjustment
-import requests
+from canada_post.util.money import Price
+from canada_post.ratelimit import THROTTLE_STATUSES
+from canada_post.retry import RetryStats
+from canada_post.instrumentation import Call, NULL_CALL
 
 class ServiceBase(object):
     """
@@ -14,9 +16,44 @@ class ServiceBase(object):
         DEV: "ct.soa-gw.canadapost.ca",
         PROD: "soa-gw.canadapost.ca",
     }
+    SCHEME = "https"
+    # canada_post.service.template.Template of the request body, if any
+    TEMPLATE = None
+    # whether sending the same request twice has the same effect as sending
+    #  it once, so that any failure can be retried
+    IDEMPOTENT = True
 
-    def __init__(self, auth):
+    def __init__(self, auth, session=None, timeout=None, rate_limiter=None,
+                 retry_policy=None, instruments=None):
+        """
+        auth -- the canada_post.Auth credentials object
+        session -- a requests.Session to send requests through. Services
+            created by the same CanadaPostAPI share one, so that they share
+            its connection pool. A new one is created if none is given
+        timeout -- seconds (or a (connect, read) tuple) to wait for the server
+            on each request. None waits forever
+        rate_limiter -- a canada_post.ratelimit.RateLimiter every request
+            has to go through. It adapts to the throttling responses
+        retry_policy -- a canada_post.retry.RetryPolicy for failed requests.
+            Requests aren't retried if None. retry_stats holds the service's
+            retry metrics
+        instruments -- canada_post.instrumentation.Instrument objects to
+            report every call to
+        """
         self.auth = auth
+        self._session = session
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.retry_stats = RetryStats()
+        self.instruments = list(instruments or ())
+
+    @property
+    def session(self):
+        if self._session is None:
+            from canada_post.session import create_session
+            self._session = create_session()
+        return self._session
 
     def get_server(self):
         return self.SERVER[self.auth.dev]
@@ -24,83 +61,166 @@ class ServiceBase(object):
     def get_url(self):
         raise NotImplementedError
 
+    def render(self, values):
+        """
+        Render the request body from the template values
+        """
+        request = self.TEMPLATE.render(values)
+        if self.auth.debug:
+            from canada_post.service.template import pretty
+            request = pretty(request)
+        return request
+
+    def add_instrument(self, instrument):
+        self.instruments.append(instrument)
+
+    def _begin(self):
+        """
+        Start the canada_post.instrumentation.Call of a call to this service.
+        Use it as a context manager, so that it's finished when the call
+        returns or raises
+        """
+        if not self.instruments:
+            return NULL_CALL
+        return Call(self.__class__.__name__, self.instruments)
+
+    def _debug_xml(self, message, content):
+        """
+        Log an XML payload at debug level. It's only decoded if the message
+        is going to be emitted
+        """
+        if self.log.isEnabledFor(logging.DEBUG):
+            if isinstance(content, bytes):
+                content = content.decode("utf-8", "replace")
+            self.log.debug(message, content)
+
     def userpass(self):
         return self.auth.username, self.auth.password
 
+    def _request(self, method, url, recover=None, call=NULL_CALL,
+                 retry_policy=None, **kwargs):
+        """
+        Send a request through this service's session, authenticated and with
+        the configured timeout, retrying it as allowed by the retry policy
+        (`retry_policy` if given, the service's otherwise). `recover` is
+        passed to RetryPolicy.run. The responses are recorded in `call`
+        """
+        return self._retry(lambda: self._send_once(method, url, call,
+                                                   **kwargs),
+                           recover=recover, retry_policy=retry_policy)
+
+    def _retry(self, send, recover=None, retry_policy=None):
+        """
+        Call send() through the retry policy, if any
+        """
+        policy = retry_policy or self.retry_policy
+        if policy is None:
+            return send()
+        return policy.run(send, idempotent=self.IDEMPOTENT, recover=recover,
+                          stats=self.retry_stats)
+
+    def _send_once(self, method, url, call=NULL_CALL, **kwargs):
+        """
+        Send a single request, waiting for the rate limiter first, if any
+        """
+        kwargs.setdefault('auth', self.userpass())
+        kwargs.setdefault('timeout', self.timeout)
+        limiter = self.rate_limiter
+        if limiter is None:
+            response = self.session.request(method, url, **kwargs)
+            call.response(response.status_code,
+                          response.headers.get('Content-Length'))
+            return response
+        limiter.acquire()
+        response = self.session.request(method, url, **kwargs)
+        call.response(response.status_code,
+                      response.headers.get('Content-Length'))
+        limiter.update(response.status_code,
+                       response.headers.get('Retry-After'))
+        if response.status_code in THROTTLE_STATUSES:
+            self.log.warning("Throttled by the server: %s", limiter)
+        return response
+
 class CallLinkService(ServiceBase):
     """
     Services that are called from link details returned by a prior call
     """
     log = logging.getLogger('canada_post.service.CallLinkService')
     link_rel = 'BAD_NAME'
-    def __call__(self, shipment):
+    method = 'DELETE'
+
+    def get_link(self, shipment):
         """
-        Void the Shipment object passed as parameter, using it's 'void' link
+        Return the url to call and the headers to call it with for the given
+        shipment
         """
-        self.log.info("Calling %s on shipment %s", self.__class__.__name__,
-                      shipment)
         link = shipment.links[self.link_rel]
-        url = link['href']
-        self.log.info("Calling url %s", url)
         headers = {
             'Accept': link['media-type'],
             'Accept-language': 'en-CA',
             }
-        res = requests.delete(url, headers=headers, auth=(self.userpass()))
-        self.log.info("Response status code: %d", res.status_code)
-        if not res.ok:
-            res.raise_for_status()
+        return link['href'], headers
+
+    def __call__(self, shipment):
+        """
+        Void the Shipment object passed as parameter, using it's 'void' link
+        """
+        self.log.info("Calling %s on shipment %s", self.__class__.__name__,
+                      shipment)
+        url, headers = self.get_link(shipment)
+        self.log.info("Calling url %s", url)
+        with self._begin() as call:
+            attempts = []
+            def send():
+                attempts.append(url)
+                return self._send_once(self.method, url, call,
+                                       headers=headers)
+            res = self._retry(send)
+            call.phase("network")
+            self.log.info("Response status code: %d", res.status_code)
+            if res.status_code == 404 and len(attempts) > 1 and \
+                    self.already_done(shipment):
+                # a previous attempt went through before failing
+                self.log.info("Already done by a previous attempt")
+                return True
+            if not res.ok:
+                res.raise_for_status()
+            return True
+
+    def already_done(self, shipment):
+        """
+        Whether the call was already done on the shipment, asked when a
+        retried call answers 404 to tell a previous attempt that went through
+        from a link that was never valid. There's no way to know in general,
+        so it's assumed to be done: services that can check override this
+        """
         return True
 
 class Service(object):
     """
     Represents each of the service options returned from a call to GetRates for
-    a given parcel. Serves as parameter to call GetService
+    a given parcel. Serves as parameter to call GetService. transit_time is
+    the expected number of business days in transit, None if unknown
     """
+    __slots__ = ('code', 'link', 'name', 'price', 'transit_time')
+
     log = logging.getLogger('canada_post.service.rating.Service')
     def __init__(self, xml_subtree=None, data={}):
+        """
+        xml_subtree is an lxml.etree.Element representing one of CP's
+        response's <price-quote> elements. Otherwise the attributes are taken
+        from the data dict
+        """
         if xml_subtree is not None:
-            self._from_xml(xml_subtree)
-        else:
-            self.code = data.get('code', 'BAD.CODE')
-            self.link = data.get('link', {})
-            self.name = data.get('name', 'UNDEFINED')
-            self.price = data.get('price', Price())
+            from canada_post.service.parsing import service_data
+            data = service_data(xml_subtree)
+        self.code = data.get('code', 'BAD.CODE')
+        self.link = data.get('link', {})
+        self.name = data.get('name', 'UNDEFINED')
+        self.price = data.get('price', Price())
+        self.transit_time = data.get('transit_time')
 
     def __repr__(self):
         return "Service(data={{ code='{code}', link='{link}', name='{name}', " \
                "price={price} }})".format(code=self.code, link=repr(self.link),
                                          name=self.name, price=repr(self.price))
-
-    def _from_xml(self, xml):
-        """
-        Initialize instance from the provided XML. It should be an object of
-        lxml.etree.Element representing one of CP's response's <price-quote>
-        elements
-        """
-        self.code = xml.find("service-code").text
-        self.link = dict(xml.find("service-link").attrib)
-        self.name = xml.find("service-name").text
-        self.price = self._price_from_xml(xml.find("price-details"))
-
-    def _price_from_xml(self, xml):
-        """
-        Create a Price detail object from a <price-details> XML element as
-        returned from the CP API
-        """
-        due = get_decimal(xml.find("due").text)
-        base = get_decimal(xml.find("base").text)
-        tax = xml.find("taxes/gst")
-        gst = get_decimal(tax.text)
-        gst_percent = get_decimal(tax.get("percent"))
-        tax = xml.find("taxes/pst")
-        pst = get_decimal(tax.text)
-        pst_percent = get_decimal(tax.get("percent"))
-        tax = xml.find("taxes/hst")
-        hst = get_decimal(tax.text)
-        hst_percent = get_decimal(tax.get("percent"))
-        adjustments = [Adjustment(xml_source=adj)
-                       for adj in xml.findall("adjustments/adjustment")]
-        return Price(due=due, base=base, gst=gst, gst_pc=gst_percent,
-                     pst=pst, pst_pc=pst_percent, hst=hst, hst_pc=hst_percent,
-                     adjustments=adjustments)
@@ -0,0 +1,277 @@
+"""
+Download of the artifacts (labels, manifests...) linked from a Shipment or
+returned by other calls.
+
+Artifacts are streamed to their destination in chunks instead of being read
+into memory. Downloads to a file go through a partial file first, so an
+interrupted download is resumed with a Range request, by a retry or by the
+next call. An ArtifactCache keeps the downloaded artifacts on disk, so
+reprinting a label doesn't hit the network
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import requests
+from canada_post.service import CallLinkService
+
+# bytes read from the response and written at a time
+CHUNK_SIZE = 64 * 1024
+
+_CONTENT_RANGE = re.compile(r"^bytes (\d+)-\d+/(?:\d+|\*)$")
+# os.replace overwrites the destination on every platform, not in python 2
+_replace = getattr(os, 'replace', os.rename)
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _copy(path, out):
+    """
+    Copy the file at `path` to `out`, a path or a writable binary file object.
+    Returns the number of bytes copied
+    """
+    with open(path, 'rb') as source:
+        if hasattr(out, 'write'):
+            shutil.copyfileobj(source, out, CHUNK_SIZE)
+        else:
+            with open(out, 'wb') as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+    return os.path.getsize(path)
+
+class ArtifactCache(object):
+    """
+    Content addressed on-disk store of downloaded artifacts, keyed by their
+    link href. The content is stored once under its sha256 digest
+    (objects/), and each href refers to it (refs/, named after the digest of
+    the href). Downloads in progress are kept in partial/ so that they can be
+    resumed by a retry or the next download in the same process.
+
+    Several processes can share the directory: each one downloads to its own
+    partial files, and the complete ones are moved into objects/ and refs/
+    with atomic renames. Within a process, one thread at a time downloads a
+    given href (see lock())
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        for name in ('objects', 'refs', 'partial'):
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another process meanwhile
+                    if not os.path.isdir(path):
+                        raise
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _path(self, kind, digest):
+        return os.path.join(self.directory, kind, digest)
+
+    def lock(self, href):
+        """
+        Lock held by the thread downloading `href`
+        """
+        with self._lock:
+            return self._locks.setdefault(href, threading.Lock())
+
+    def get(self, href):
+        """
+        Path of the cached content of `href`, None if it isn't cached
+        """
+        try:
+            with open(self._path('refs', _sha256(href.encode('utf-8')))) as f:
+                digest = f.read().strip()
+        except (IOError, OSError):
+            return None
+        path = self._path('objects', digest)
+        return path if os.path.exists(path) else None
+
+    def partial(self, href):
+        """
+        Path for this process to download `href` to
+        """
+        return self._path('partial', "{0}.{1}".format(
+            _sha256(href.encode('utf-8')), os.getpid()))
+
+    def commit(self, href):
+        """
+        Move the complete download of `href` from its partial file into the
+        cache and return the path of the content
+        """
+        partial = self.partial(href)
+        digest = _file_sha256(partial)
+        path = self._path('objects', digest)
+        if os.path.exists(path):
+            os.remove(partial)
+        else:
+            _replace(partial, path)
+        ref = self._path('refs', _sha256(href.encode('utf-8')))
+        temporary = "{0}.{1}.tmp".format(ref, os.getpid())
+        with open(temporary, 'w') as f:
+            f.write(digest)
+        _replace(temporary, ref)
+        return path
+
+    def discard(self, href):
+        """
+        Forget `href`. The content stays, other hrefs may refer to it
+        """
+        for path in (self._path('refs', _sha256(href.encode('utf-8'))),
+                     self.partial(href)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __contains__(self, href):
+        return self.get(href) is not None
+
+class GetArtifact(CallLinkService):
+    """
+    Download an artifact of a Shipment (its label by default) or from an
+    artifact href
+    """
+    log = logging.getLogger('canada_post.service.artifacts.GetArtifact')
+    link_rel = 'label'
+    method = 'GET'
+
+    def __init__(self, auth, cache=None, chunk_size=CHUNK_SIZE, **kwargs):
+        """
+        cache -- an optional ArtifactCache. Artifacts found there aren't
+            downloaded again
+        chunk_size -- bytes read from the network at a time
+        """
+        self.cache = cache
+        self.chunk_size = chunk_size
+        super(GetArtifact, self).__init__(auth, **kwargs)
+
+    def filename(self, shipment, rel=None):
+        """
+        File name for the artifact of a shipment: its id and the extension of
+        the artifact's media type, e.g. 347881315405043891.pdf
+        """
+        link = shipment.links[rel or self.link_rel]
+        media_type = link.get('media-type', "")
+        extension = ".pdf" if media_type == "application/pdf" else \
+            mimetypes.guess_extension(media_type) or ""
+        return "{id}{extension}".format(id=shipment.id, extension=extension)
+
+    def __call__(self, shipment, out, rel=None):
+        """
+        Download the artifact of the shipment whose link is `rel` (the label
+        if not given) to `out`, a file path or a writable binary file object.
+        Returns the size of the artifact
+        """
+        link = shipment.links[rel or self.link_rel]
+        self.log.info("Downloading %s of shipment %s", rel or self.link_rel,
+                      shipment)
+        return self.download(link['href'], out, link.get('media-type'))
+
+    def download(self, href, out, media_type=None):
+        """
+        Download the artifact at `href` to `out`, a file path or a writable
+        binary file object. Returns its size
+        """
+        headers = {
+            'Accept': media_type or "*/*",
+            'Accept-language': 'en-CA',
+        }
+        with self._begin() as call:
+            if self.cache is not None:
+                with self.cache.lock(href):
+                    path = self.cache.get(href)
+                    if path is None:
+                        self._fetch(call, href, headers,
+                                    path=self.cache.partial(href))
+                        path = self.cache.commit(href)
+                    else:
+                        self.log.info("Using cached %s", href)
+                        call.cached = True
+                    call.skip()
+                    return _copy(path, out)
+            if hasattr(out, 'write'):
+                return self._fetch(call, href, headers, fileobj=out)
+            partial = out + ".part"
+            size = self._fetch(call, href, headers, path=partial)
+            _replace(partial, out)
+            return size
+
+    def _fetch(self, call, url, headers, path=None, fileobj=None):
+        """
+        Stream the artifact at `url` to the end of the file at `path`, or to
+        `fileobj`. Whatever the file already holds is taken to be the start of
+        the artifact and only the rest is requested. Returns the size
+        """
+        self.log.info("Calling url %s", url)
+        written = [0]
+        if path is not None and os.path.exists(path):
+            written[0] = os.path.getsize(path)
+            self.log.info("Resuming download at byte %d", written[0])
+
+        def attempt():
+            request_headers = dict(headers)
+            if written[0]:
+                request_headers['Range'] = "bytes={0}-".format(written[0])
+            response = self._send_once('GET', url, call,
+                                       headers=request_headers, stream=True)
+            try:
+                if response.ok:
+                    self._write(response, written, path, fileobj)
+            except requests.exceptions.ChunkedEncodingError as e:
+                # the connection was cut during the transfer, the retry
+                #  resumes it
+                raise requests.ConnectionError(e)
+            finally:
+                response.close()
+            return response
+
+        response = self._retry(attempt)
+        call.phase("network")
+        self.log.info("Response status code: %d", response.status_code)
+        # 416: the partial file was complete already
+        if not response.ok and not (response.status_code == 416 and
+                                    written[0]):
+            response.raise_for_status()
+        call.response_size = written[0]
+        return written[0]
+
+    def _write(self, response, written, path, fileobj):
+        """
+        Append the content of the response to the artifact, skipping what's
+        already been written if the server sent more than was asked for
+        """
+        offset = 0
+        if response.status_code == 206:
+            match = _CONTENT_RANGE.match(
+                response.headers.get('Content-Range', ""))
+            if match is None:
+                raise IOError("Bad Content-Range: {0}".format(
+                    response.headers.get('Content-Range')))
+            offset = int(match.group(1))
+        skip = written[0] - offset
+        if skip < 0:
+            raise IOError("Got bytes from {0}, {1} were asked for".format(
+                offset, written[0]))
+        target = fileobj if fileobj is not None else open(path, 'ab')
+        try:
+            for chunk in response.iter_content(self.chunk_size):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk = chunk[skip:]
+                    skip = 0
+                target.write(chunk)
+                written[0] += len(chunk)
+        finally:
+            if fileobj is None:
+                target.close()
@@ -3,10 +3,70 @@ ContractShipping Canada Post API
 https://www.canadapost.ca/cpo/mc/business/productsservices/developers/services/shippingmanifest/default.jsf
 """
 import logging
-from lxml import etree
 import requests
 from canada_post.service import ServiceBase, CallLinkService
+from canada_post.service.parsing import (shipment_data, parse_shipment,
+                                         parse_shipment_links,
+                                         parse_shipment_reference)
+from canada_post.service.template import (Template, Element, Text, Const, If,
+                                          text_type)
 from canada_post.util import InfoObject
+from canada_post.validation import validate_shipment, check
+
+def _address_details(prefix):
+    return Element("address-details",
+                   Text("address-line-1", prefix + "address1"),
+                   Text("address-line-2", prefix + "address2"),
+                   Text("city", prefix + "city"),
+                   If(prefix + "province",
+                      Text("prov-state", prefix + "province")),
+                   Text("country-code", prefix + "country_code"),
+                   If(prefix + "postal_code",
+                      Text("postal-zip-code", prefix + "postal_code")))
+
+SHIPMENT_TEMPLATE = Template(Element(
+    "shipment",
+    Text("group-id", "group"),
+    Text("requested-shipping-point", "shipping_point"),
+    Element("delivery-spec",
+            Text("service-code", "service_code"),
+            Element("sender",
+                    If("sender_name", Text("name", "sender_name")),
+                    Text("company", "sender_company"),
+                    Text("contact-phone", "sender_phone"),
+                    _address_details("sender_")),
+            Element("destination",
+                    If("destination_name", Text("name", "destination_name")),
+                    If("destination_company",
+                       Text("company", "destination_company")),
+                    If("destination_phone",
+                       Text("client-voice-number", "destination_phone")),
+                    _address_details("destination_")),
+            Element("parcel-characteristics",
+                    Text("weight", "weight"),
+                    If("dimensions", Element("dimensions",
+                                             Text("length", "length"),
+                                             Text("width", "width"),
+                                             Text("height", "height"))),
+                    Text("unpackaged", "unpackaged")),
+            Element("preferences",
+                    Const("show-packing-instructions", "false"),
+                    # TODO: these two are actually optional (may be "false")
+                    # for CA shippings
+                    Const("show-postage-rate", "false"),
+                    Const("show-insured-value", "false")),
+            If("reference", Element("references",
+                                    Text("customer-ref-1", "reference"))),
+            Element("settlement-info",
+                    # TODO: set paid-by-customer if a different customer is
+                    # paying for this
+                    Text("contract-id", "contract_id"),
+                    # TODO: can be CreditCard as well
+                    Const("intended-method-of-payment", "Account"))),
+    # the tree builder this replaces added additional-address-info to the
+    #  root, keep the requests unchanged
+    If("extra", Text("additional-address-info", "extra")),
+    xmlns="http://www.canadapost.ca/ws/shipment"))
 
 class Shipment(InfoObject):
     """
@@ -28,23 +88,10 @@ class Shipment(InfoObject):
         super(Shipment, self).__init__(**kwargs)
 
     def _from_xml(self, xml):
-        # I do this this way because I can't expect all return codes to have all
-        #  values, I just fill in every Simple element in self
-        for child in xml.getchildren():
-            if child.tag == "shipment-id":
-                self.id = child.text
-            elif child.tag == "shipment-status":
-                self.status = child.text
-            elif child.tag == "links":
-                # I can't make these into InfoObjects because there's a `self`
-                #  rel object
-                self.links = dict((link['rel'], link)
-                    for link in map(lambda l: dict(l.attrib),
-                                    child.findall("link")))
-            else:
-                # expected "tracking-pin" "return-tracking-pin"
-                attrname = child.tag.replace("-", "_")
-                setattr(self, attrname, child.text)
+        # I can't expect all return codes to have all values, every simple
+        #  element ends up in self
+        for name, value in shipment_data(xml).items():
+            setattr(self, name, value)
 
 
 class CreateShipment(ServiceBase):
@@ -52,13 +99,21 @@ class CreateShipment(ServiceBase):
     CreateShipment Canada Post API (for ContractShipping)
     https://www.canadapost.ca/cpo/mc/business/productsservices/developers/services/shippingmanifest/createshipment.jsf
     """
-    URL ="https://{server}/rs/{customer}/{mobo}/shipment"
+    URL ="{scheme}://{server}/rs/{customer}/{mobo}/shipment"
     log = logging.getLogger('canada_post.service.contract_shipping'
                             '.CreateShipment')
-    def __init__(self, auth, url=None):
+    # a retried request may create a second shipment, see send()
+    IDEMPOTENT = False
+
+    def __init__(self, auth, url=None, store=None, **kwargs):
+        """
+        store -- an optional canada_post.store.ShipmentStore every created
+            Shipment is saved to
+        """
         if url:
             self.URL = url
-        super(CreateShipment, self).__init__(auth)
+        self.store = store
+        super(CreateShipment, self).__init__(auth, **kwargs)
 
     def set_link(self, url):
         """
@@ -67,33 +122,85 @@ class CreateShipment(ServiceBase):
         self.URL = url
 
     def get_url(self):
-        return self.URL.format(server=self.get_server(),
+        return self.URL.format(scheme=self.SCHEME, server=self.get_server(),
                                customer=self.auth.customer_number,
                                mobo=self.auth.customer_number)
 
-    def _create_address_detail(self, parent, address, add_child):
+    def _address_values(self, prefix, address):
+        """
+        Template values for the address-details of the given address
+        """
+        return {
+            prefix + 'address1': address.address1,
+            prefix + 'address2': address.address2,
+            prefix + 'city': address.city,
+            prefix + 'province': address.province,
+            prefix + 'country_code': address.country_code,
+            prefix + 'postal_code': (text_type(address.postal_code)
+                                     if address.postal_code else None),
+        }
+
+    HEADERS = {
+        'Accept': "application/vnd.cpc.shipment-v2+xml",
+        'Content-type': "application/vnd.cpc.shipment-v2+xml",
+        'Accept-language': "en-CA",
+    }
+
+    TEMPLATE = SHIPMENT_TEMPLATE
+
+    def build_request(self, parcel, origin, destination, service, group,
+                      reference=None):
+        """
+        Return the serialized shipment request for the given parcel. The
+        parameters are the same as for __call__
+        """
+        return self.render(self.request_values(parcel, origin, destination,
+                                               service, group, reference))
+
+    def request_values(self, parcel, origin, destination, service, group,
+                       reference=None):
         """
-        Creates the address detail part of the request. You need to do any
-        checks outside of this call
+        Check the shipment data and return the template values of its
+        request. Raises a canada_post.validation.ValidationError if it isn't
+        valid
         """
-        addr_detail = add_child("address-details", parent)
-        add_child("address-line-1", addr_detail).text = address.address1
-        add_child("address-line-2", addr_detail).text = address.address2
-        add_child("city", addr_detail).text = address.city
-        if address.province:
-            add_child("prov-state", addr_detail).text = address.province
-        add_child("country-code", addr_detail).text = address.country_code
-        if address.postal_code:
-            add_child("postal-zip-code",
-                      addr_detail).text = unicode(address.postal_code)
-        else:
-            assert address.country_code not in ("US", "CA"), (
-                "Addresses within {} require "
-                "a postal code").format(address.country_code)
+        check(validate_shipment(parcel, origin, destination, service,
+                                self.auth.contract_number or ""))
+        # TODO: options, notification, print-preferences
 
-        return addr_detail
+        values = {
+            'group': group,
+            'shipping_point': text_type(origin.postal_code),
+            'service_code': service.code,
+            'sender_name': origin.name or None,
+            'sender_company': origin.company,
+            'sender_phone': origin.phone,
+            'destination_name': destination.name or None,
+            'destination_company': destination.company or None,
+            'destination_phone': destination.phone or None,
+            'extra': destination.extra or None,
+            'weight': text_type(parcel.weight),
+            'dimensions': all((parcel.length > 0, parcel.width > 0,
+                               parcel.height > 0)),
+            'length': text_type(parcel.length),
+            'width': text_type(parcel.width),
+            'height': text_type(parcel.height),
+            'unpackaged': "true" if parcel.unpackaged else "false",
+            'contract_id': self.auth.contract_number,
+            'reference': reference,
+        }
+        values.update(self._address_values("sender_", origin))
+        values.update(self._address_values("destination_", destination))
+        return values
 
-    def __call__(self, parcel, origin, destination, service, group):
+    def parse_response(self, content):
+        """
+        Return the Shipment object in a CreateShipment response body
+        """
+        return Shipment(**parse_shipment(content))
+
+    def __call__(self, parcel, origin, destination, service, group,
+                 reference=None):
         """
         Create a shipping order for the given parcels
 
@@ -104,136 +211,122 @@ class CreateShipment(ServiceBase):
             the code parameter set up
         group: must be a string or unicode defining the parcel group that this
             parcel should be added to
+        reference: optional customer reference of the shipment
+            (customer-ref-1), unique within the group. With a retry policy,
+            it's how failures where the shipment may have been created anyway
+            are retried without creating it twice
         """
         debug = "( DEBUG )" if self.auth.debug else ""
         self.log.info(("Create shipping for parcel %s, from %s to %s{debug}"
                        .format(debug=debug)), parcel, origin, destination)
 
-        # shipment
-        shipment = etree.Element(
-            "shipment", xmlns="http://www.canadapost.ca/ws/shipment")
-        def add_child(child_name, parent=shipment):
-            return etree.SubElement(parent, child_name)
-        add_child("group-id").text = group
-        add_child("requested-shipping-point").text = unicode(origin.postal_code)
-        delivery_spec = add_child("delivery-spec")
-        add_child("service-code", delivery_spec).text = service.code
-
-        # sender
-        sender = add_child("sender", delivery_spec)
-        if origin.name:
-            add_child("name", sender).text = origin.name
-        assert origin.company, ("The sender needs a company name for "
-                                "Contract Shipping service")
-        add_child("company", sender).text = origin.company
-        assert origin.phone, ("The sender needs a phone for "
-                              "Contact Shipping Service")
-        add_child("contact-phone", sender).text = origin.phone
-
-        #destination details, first assertions
-        assert any((origin.address1, origin.address2)), (
-            "The sender needs an address to Create Shipping")
-        assert origin.city, "Need the sender's city to Create Shipping"
-        assert origin.province, "Need the sender's province to Create Shipping"
-        sender_details = self._create_address_detail(sender, origin, add_child)
-        # done sender
-
-        # destination
-        dest = add_child("destination", delivery_spec)
-        if destination.name:
-            add_child("name", dest).text = destination.name
-        else:
-            # TODO: if the Deliver to Post Office option is used, the name
-            #  element must be present for the destination.
-            pass
-        if destination.company:
-            add_child("company", dest).text = destination.company
-        if destination.extra:
-            add_child("additional-address-info").text = destination.extra
-        if destination.phone:
-            add_child("client-voice-number", dest).text = destination.phone
-        else:
-            # Required for destination when service is one of
-            #  Expedited Parcel-USA, Xpresspost-USA, Xpresspost-International,
-            #  Priority Worldwide Parcel or Pak
-            #  (USA.EP, USA.XP, INT.XP, USA.PW.PARCEL, USA.PW.PAK,
-            #   INT.PW.PARCEL, INT.PW.PAK)
-            if service.code in ("USA.EP", "USA.XP", "INT.XP", "USA.PW.PARCEL",
-                                "USA.PW.PAK", "INT.PW.PARCEL", "INT.PK.PAK"):
-                assert False, ("Service {code} requires destination to have a "
-                               "phone number").format(code=service.code)
-
-        # destination details, first assertions
-        assert any((destination.address1, destination.address2)), (
-            "Must have address to Create Shipping")
-        if not destination.province:
-            assert destination.country_code not in ("CA", "US"), (
-                "Country code is required for international shippings")
-        # and then creation
-        dest_details = self._create_address_detail(dest, destination, add_child)
-        # done destination
-
-        # TODO: options
-        #options = add_child("options", delivery_spec)
-
-        # parcel
-        parcel_chars = add_child("parcel-characteristics", delivery_spec)
-        add_child("weight", parcel_chars).text = unicode(parcel.weight)
-        if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
-            dims = add_child("dimensions", parcel_chars)
-            add_child("length", dims).text = unicode(parcel.length)
-            add_child("width", dims).text = unicode(parcel.width)
-            add_child("height", dims).text = unicode(parcel.height)
-        add_child("unpackaged", parcel_chars).text = ("true"
-                                                      if parcel.unpackaged
-                                                      else "false")
-
-        # TODO: notification
-        #notification = add_child("notification", delivery_spec)
-
-        # TODO: print-preferences
-        #print_preferences = add_child("print-preferences", delivery_spec)
-
-        # preferences
-        preferences = add_child("preferences", delivery_spec)
-        add_child("show-packing-instructions", preferences).text = "false"
-        # TODO: these two are actually optional (may be "false") for CA
-        # shippings
-        add_child("show-postage-rate", preferences).text = "false"
-        add_child("show-insured-value", preferences).text = "false"
-
-        # settlement-info
-        settlement = add_child("settlement-info", delivery_spec)
-        # TODO: set paid-by-customer if a different customer is paying for this
-        #add_child("paid-by-customer", settlement).text = FOOBAR
-        assert self.auth.contract_number, ("Must have a contract number for "
-                                           "contract shipping")
-        add_child("contract-id", settlement).text = self.auth.contract_number
-        # TODO: can be CreditCard as well
-        add_child("intended-method-of-payment", settlement).text = "Account"
-
-        headers = {
-            'Accept': "application/vnd.cpc.shipment-v2+xml",
-            'Content-type': "application/vnd.cpc.shipment-v2+xml",
-            'Accept-language': "en-CA",
-        }
+        with self._begin() as call:
+            values = self.request_values(parcel, origin, destination, service,
+                                         group, reference)
+            call.phase("build")
+            request = self.render(values)
+            call.phase("serialize")
+            return self._send(call, request, group, reference)
+
+    def send(self, request, group=None, reference=None, retry_policy=None):
+        """
+        Send a request built by build_request and return the created Shipment.
+
+        With a retry policy (`retry_policy`, or the service's), throttled
+        requests and connection timeouts are always retried, since those
+        never reach Canada Post. Other failures are only retried if the group
+        and reference of the request are given: the group is searched first
+        for a shipment with that reference created by the failed attempt,
+        which is returned if found. If that search fails, the request isn't
+        sent again and canada_post.retry.OutcomeUnknown is raised
+        """
+        with self._begin() as call:
+            return self._send(call, request, group, reference, retry_policy)
+
+    def _send(self, call, request, group, reference, retry_policy=None):
         url = self.get_url()
         self.log.info("Using url %s", url)
-        request = etree.tostring(shipment, pretty_print=self.auth.debug)
-        self.log.debug("Request xml: %s", request)
-        response = requests.post(url=url, data=request, headers=headers,
-                                 auth=self.userpass())
+        self._debug_xml("Request xml: %s", request)
+        call.request(request)
+        recover = None
+        if group and reference:
+            recover = lambda: self.find_shipment(group, reference)
+        response = self._request('POST', url, recover=recover, call=call,
+                                 retry_policy=retry_policy, data=request,
+                                 headers=self.HEADERS)
+        call.phase("network")
+        if isinstance(response, Shipment):
+            return self._stored(response, group, reference)
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
+        content = response.content
+        call.response_size = len(content)
+        self._debug_xml("Request returned content: %s", content)
 
         if not response.ok:
             response.raise_for_status()
 
-        # this is a hack to remove the namespace from the response, since this
-        #breaks xpath lookup in lxml
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
-        return Shipment(xml=restree)
+        shipment = self.parse_response(content)
+        call.phase("parse")
+        return self._stored(shipment, group, reference)
+
+    def _stored(self, shipment, group=None, reference=None):
+        """
+        Save the created shipment to the store, if any, and return it. The
+        shipment exists whatever happens to the store, so a failure to save
+        it is only logged: raising would get it created again
+        """
+        if self.store is not None:
+            try:
+                self.store.add(shipment, group, reference)
+            except Exception:
+                self.log.exception("Couldn't save shipment %s to the store",
+                                   shipment.id)
+        return shipment
+
+    def _get_headers(self):
+        return {
+            'Accept': self.HEADERS['Accept'],
+            'Accept-language': self.HEADERS['Accept-language'],
+        }
+
+    def group_links(self, group):
+        """
+        Return the href of every shipment of the group that hasn't been
+        transmitted. Raises requests.HTTPError if the lookup fails
+        """
+        response = self._send_once('GET', self.get_url(),
+                                   params={'groupId': group},
+                                   headers=self._get_headers())
+        response.raise_for_status()
+        return parse_shipment_links(response.content)
+
+    def group_shipments(self, group):
+        """
+        Shipment objects for the shipments of the group, with just their id
+        and 'self' link: enough to void them
+        """
+        return [Shipment(id=href.rstrip("/").rsplit("/", 1)[-1],
+                         links={'self': {
+                             'rel': "self", 'href': href,
+                             'media-type': self.HEADERS['Accept']}})
+                for href in self.group_links(group)]
+
+    def find_shipment(self, group, reference):
+        """
+        Return the Shipment of the group whose customer reference is
+        `reference`, or None if there's none. Raises requests.HTTPError if
+        the lookup fails
+        """
+        headers = self._get_headers()
+        for href in self.group_links(group):
+            details = self._send_once('GET', href + "/details",
+                                      headers=headers)
+            details.raise_for_status()
+            if parse_shipment_reference(details.content) == reference:
+                info = self._send_once('GET', href, headers=headers)
+                info.raise_for_status()
+                return self.parse_response(info.content)
+        return None
 
 class VoidShipment(CallLinkService):
     """
@@ -242,3 +335,66 @@ class VoidShipment(CallLinkService):
     log = logging.getLogger("canada_post.service.contract_shipping"
                             ".VoidShipment")
     link_rel = 'self'
+    # status of the voided shipments in the store
+    VOIDED = "voided"
+    # shipment-status of a voided shipment at Canada Post
+    VOIDED_STATUSES = ("cancelled", "voided")
+
+    def __init__(self, auth, store=None, **kwargs):
+        """
+        store -- an optional canada_post.store.ShipmentStore where the voided
+            shipments are marked as such
+        """
+        self.store = store
+        super(VoidShipment, self).__init__(auth, **kwargs)
+
+    def __call__(self, shipment):
+        result = super(VoidShipment, self).__call__(shipment)
+        self._mark_voided(shipment)
+        return result
+
+    def _mark_voided(self, shipment):
+        """
+        Mark the shipment as voided in the store, if any. It's voided whatever
+        happens to the store, so a failure is only logged
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.set_status([shipment.id], self.VOIDED)
+        except Exception:
+            self.log.exception("Couldn't mark shipment %s as voided in the "
+                               "store", shipment.id)
+
+    def already_done(self, shipment):
+        """
+        Whether Canada Post has the shipment as voided. Voiding answers 404
+        both for a shipment that was already voided and for one it doesn't
+        know, so the shipment is looked up: only one that's still there,
+        with a voided status, was voided
+        """
+        url, headers = self.get_link(shipment)
+        response = self._request('GET', url, headers=headers)
+        if response.status_code == 404:
+            self.log.warning("Shipment %s is unknown to Canada Post",
+                             shipment.id)
+            return False
+        response.raise_for_status()
+        status = parse_shipment(response.content).get('status')
+        return status in self.VOIDED_STATUSES
+
+    def void(self, shipment):
+        """
+        Like calling the service, but a shipment that was already voided (so
+        that Canada Post answers 404 when voiding it again) isn't an error.
+        Returns True if it was voided by this call, False if it already was
+        """
+        try:
+            return self(shipment)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404 or \
+                    not self.already_done(shipment):
+                raise
+        self.log.info("Shipment %s was already voided", shipment.id)
+        self._mark_voided(shipment)
+        return False
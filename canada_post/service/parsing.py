@@ -0,0 +1,212 @@
+"""
+Parsing of the Canada Post API responses.
+
+Responses are parsed straight from the received bytes, namespace aware, so the
+body doesn't need to be copied to strip its xmlns. Elements are matched against
+precomputed fully qualified tag names and precompiled XPath expressions, and
+each element's children are read in a single pass instead of one path lookup
+per field.
+
+iter_rates parses a GetRates response incrementally, yielding each quote as
+soon as its <price-quote> element is closed
+"""
+from lxml import etree
+from canada_post.util.money import Price, Adjustment, get_decimal
+
+RATE_NAMESPACE = "http://www.canadapost.ca/ws/ship/rate-v2"
+SHIPMENT_NAMESPACE = "http://www.canadapost.ca/ws/shipment"
+
+_TAG_NAMES = (
+    # rating
+    "price-quote", "service-code", "service-link", "service-name",
+    "price-details", "base", "due", "taxes", "gst", "pst", "hst",
+    "service-standard", "expected-transit-time",
+    "adjustments", "adjustment", "adjustment-code", "adjustment-name",
+    "adjustment-cost", "qualifier", "percent",
+    # shipping
+    "shipment-id", "shipment-status", "links", "link", "customer-ref-1",
+)
+
+class _Tags(object):
+    """
+    Fully qualified tag names for a namespace, as attributes named after the
+    tag with dashes replaced by underscores. `local` maps them back to the
+    local names
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        prefix = "{{{0}}}".format(namespace) if namespace else ""
+        self.local = {}
+        for name in _TAG_NAMES:
+            setattr(self, name.replace("-", "_"), prefix + name)
+            self.local[prefix + name] = name
+        namespaces = {'cp': namespace} if namespace else None
+        step = "cp:" if namespace else ""
+        self.price_quotes = etree.XPath("{0}price-quote".format(step),
+                                        namespaces=namespaces)
+
+_tags = {}
+
+def _tags_of(namespace):
+    tags = _tags.get(namespace)
+    if tags is None:
+        tags = _tags.setdefault(namespace, _Tags(namespace))
+    return tags
+
+def _tags_for(element):
+    """
+    The _Tags of the namespace the element is in
+    """
+    tag = element.tag
+    return _tags_of(tag[1:tag.index("}")] if tag[0] == "{" else None)
+
+_TAXES = ("gst", "pst", "hst")
+
+def adjustment_from_xml(element, tags=None):
+    """
+    Create an Adjustment from an <adjustment> element
+    """
+    tags = tags or _tags_for(element)
+    values = {}
+    for child in element:
+        tag = child.tag
+        if tag == tags.adjustment_code:
+            values['code'] = child.text
+        elif tag == tags.adjustment_name:
+            values['name'] = child.text
+        elif tag == tags.adjustment_cost:
+            values['cost'] = get_decimal(child.text)
+        elif tag == tags.qualifier:
+            for qualifier in child:
+                if qualifier.tag == tags.percent:
+                    values['percent'] = qualifier.text
+    return Adjustment(**values)
+
+def price_from_xml(element, tags=None):
+    """
+    Create a Price from a <price-details> element
+    """
+    tags = tags or _tags_for(element)
+    values = {}
+    adjustments = []
+    for child in element:
+        tag = child.tag
+        if tag == tags.due:
+            values['due'] = get_decimal(child.text)
+        elif tag == tags.base:
+            values['base'] = get_decimal(child.text)
+        elif tag == tags.taxes:
+            for tax in child:
+                name = tags.local.get(tax.tag)
+                if name in _TAXES:
+                    values[name] = get_decimal(tax.text)
+                    values[name + "_pc"] = get_decimal(tax.get("percent"))
+        elif tag == tags.adjustments:
+            adjustments = [adjustment_from_xml(adjustment, tags)
+                           for adjustment in child
+                           if adjustment.tag == tags.adjustment]
+    return Price(adjustments=adjustments, **values)
+
+def service_data(element, tags=None):
+    """
+    Data dict of a <price-quote> element, as taken by Service(data=...)
+    """
+    tags = tags or _tags_for(element)
+    data = {}
+    for child in element:
+        tag = child.tag
+        if tag == tags.service_code:
+            data['code'] = child.text
+        elif tag == tags.service_link:
+            data['link'] = dict(child.attrib)
+        elif tag == tags.service_name:
+            data['name'] = child.text
+        elif tag == tags.price_details:
+            data['price'] = price_from_xml(child, tags)
+        elif tag == tags.service_standard:
+            for standard in child:
+                if standard.tag == tags.expected_transit_time and \
+                        standard.text:
+                    data['transit_time'] = int(standard.text)
+    return data
+
+def parse_rates(content):
+    """
+    Return the data dicts (see service_data) of all the quotes in a GetRates
+    response body
+    """
+    root = etree.fromstring(content)
+    tags = _tags_for(root)
+    return [service_data(quote, tags) for quote in tags.price_quotes(root)]
+
+def iter_rates(source, namespace=RATE_NAMESPACE):
+    """
+    Incrementally parse a GetRates response from `source`, a file-like object
+    or file name, yielding the data dict of each quote as soon as it has been
+    read. Parsed elements are discarded as we go, so memory use doesn't grow
+    with the size of the response
+    """
+    tags = _tags_of(namespace)
+    for _, element in etree.iterparse(source, events=("end",),
+                                      tag=tags.price_quote):
+        yield service_data(element, tags)
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+def shipment_data(element):
+    """
+    Attributes of a Shipment from a <shipment-info> element. Every simple
+    child element becomes an attribute, named after its tag with dashes
+    replaced by underscores ("tracking-pin" -> tracking_pin), except for the
+    shipment-id and shipment-status which become id and status. links is a
+    dict of rel -> link attributes
+    """
+    tags = _tags_for(element)
+    data = {}
+    for child in element:
+        tag = child.tag
+        if not isinstance(tag, str):
+            # comments and processing instructions
+            continue
+        if tag == tags.shipment_id:
+            data['id'] = child.text
+        elif tag == tags.shipment_status:
+            data['status'] = child.text
+        elif tag == tags.links:
+            data['links'] = dict((link.get('rel'), dict(link.attrib))
+                                 for link in child
+                                 if link.tag == tags.link)
+        else:
+            name = etree.QName(child).localname
+            data[name.replace("-", "_")] = child.text
+    return data
+
+def parse_shipment(content):
+    """
+    Return the Shipment attributes (see shipment_data) in a CreateShipment
+    response body
+    """
+    return shipment_data(etree.fromstring(content))
+
+def parse_shipment_links(content):
+    """
+    Return the href of every shipment listed in a response to a GET of the
+    shipments of a group (a <shipments> element)
+    """
+    root = etree.fromstring(content)
+    tags = _tags_for(root)
+    return [link.get('href') for link in root
+            if link.tag == tags.link and link.get('rel') == "shipment"]
+
+def parse_shipment_reference(content):
+    """
+    Return the customer-ref-1 of the shipment in a shipment details response
+    (a <shipment-details> element), or None if it has none
+    """
+    root = etree.fromstring(content)
+    for reference in root.iter(_tags_for(root).customer_ref_1):
+        return reference.text
+    return None
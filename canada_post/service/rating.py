@@ -3,82 +3,381 @@ GetRates Canada Post API
 https://www.canadapost.ca/cpo/mc/business/productsservices/developers/services/rating/default.jsf
 """
 import logging
+import threading
+from decimal import Decimal
 from canada_post.service import ServiceBase, Service
-from lxml import etree
-import requests
+from canada_post.service.template import (Template, Element, Text, If, Each,
+                                          text_type)
+from canada_post.service.parsing import parse_rates, iter_rates
+from canada_post.instrumentation import NULL_CALL
 from canada_post import (DEV, PROD)
 
+RATES_TEMPLATE = Template(Element(
+    "mailing-scenario",
+    Text("customer-number", "customer_number"),
+    If("contract_id", Text("contract-id", "contract_id")),
+    If("options", Element("options", Each("options", Element(
+        "option",
+        Text("option-code", "code"),
+        If("amount", Text("option-amount", "amount")))))),
+    Element("parcel-characteristics",
+            Text("weight", "weight"),
+            If("dimensions", Element("dimensions",
+                                     Text("length", "length"),
+                                     Text("width", "width"),
+                                     Text("height", "height")))),
+    If("services", Element("services", Each("services",
+                                            Text("service-code", "code")))),
+    Text("origin-postal-code", "origin_postal_code"),
+    Element("destination",
+            If("domestic", Element("domestic",
+                                   Text("postal-code", "postal_code"))),
+            If("international", Element("international",
+                                        Text("country-code", "country_code")))),
+    # the tree builder this replaces added united-states to the root, keep the
+    #  requests unchanged
+    If("united_states", Element("united-states",
+                                Text("zip-code", "postal_code"))),
+    xmlns="http://www.canadapost.ca/ws/ship/rate-v2"))
+
+def _normalize_number(value):
+    """
+    Canonical string for a weight or dimension, so that 2, 2.0 and "2.00" are
+    the same key
+    """
+    return "{0:f}".format(Decimal(str(value)).normalize())
+
+def rate_options(options):
+    """
+    (code, amount) pairs of the options to quote. `options` is a dict of
+    option code -> amount (None for options without one) or an iterable of
+    codes and (code, amount) tuples
+    """
+    if not options:
+        return []
+    if isinstance(options, dict):
+        options = options.items()
+    return [option if isinstance(option, tuple) else (option, None)
+            for option in options]
+
+def scenario_key(auth, parcel, origin, destination, services=None,
+                 options=None):
+    """
+    Cache key for a mailing scenario: all the inputs that go into the
+    GetRates request, in canonical form
+    """
+    if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
+        dimensions = "x".join(_normalize_number(dim) for dim in
+                              (parcel.length, parcel.width, parcel.height))
+    else:
+        dimensions = ""
+    country = destination.country_code.upper()
+    if country in ("CA", "US"):
+        postal_code = destination.postal_code
+    else:
+        # only the country goes in the request for international shipping
+        postal_code = ""
+    key = "|".join((
+        "rates", auth.dev, text_type(auth.customer_number),
+        text_type(auth.contract_number or ""),
+        _normalize_number(parcel.weight), dimensions,
+        origin.postal_code, country, postal_code,
+    ))
+    if services or options:
+        # only then, so that the keys of unfiltered quotes stay the same
+        key += "|" + ",".join(sorted(services or ())) + "|" + ",".join(
+            code if amount is None else
+            "{0}={1}".format(code, _normalize_number(amount))
+            for code, amount in sorted(rate_options(options)))
+    return key
+
+class _Flight(object):
+    """
+    A call in progress in a SingleFlight
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls: while a call for a key is in progress, other
+    callers asking for the same key wait for it and share its result (or its
+    exception) instead of making their own call.
+
+    `calls` counts the calls made, `coalesced` the callers that shared one.
+    The asyncio client keeps its own in-flight calls but counts them here too
+    """
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def count(self, coalesced):
+        with self._lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.calls += 1
+
+    def do(self, key, func):
+        """
+        Return func(), or the result of the call in progress for `key`
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def __repr__(self):
+        return "SingleFlight(calls={calls}, coalesced={coalesced})".format(
+            calls=self.calls, coalesced=self.coalesced)
+
 class GetRates(ServiceBase):
-    URL = "https://{server}/rs/ship/price"
+    URL = "{scheme}://{server}/rs/ship/price"
 
     log = logging.getLogger('canada_post.service.rating.GetRates')
 
+    def __init__(self, auth, cache=None, hedge=None, coalesce=False,
+                 **kwargs):
+        """
+        cache -- an optional canada_post.cache.Cache. When set, the list of
+            services for a mailing scenario is kept there, and repeated quotes
+            for the same scenario don't hit the network until it expires
+        hedge -- an optional canada_post.hedging.HedgePolicy. When set, a
+            request that's slower than most gets sent a second time and the
+            first answer is used (stream() doesn't hedge)
+        coalesce -- if True, concurrent calls for the same mailing scenario
+            (see scenario_key) share one request and its list of services
+            (stream() doesn't coalesce). `singleflight` counts how many were
+            coalesced
+        """
+        self.cache = cache
+        self.hedge = hedge
+        self.singleflight = SingleFlight() if coalesce else None
+        super(GetRates, self).__init__(auth, **kwargs)
+
     def get_url(self):
-        return self.URL.format(server=self.get_server())
+        return self.URL.format(scheme=self.SCHEME, server=self.get_server())
+
+    HEADERS = {
+        'Accept': "application/vnd.cpc.ship.rate-v2+xml",
+        'Content-type': "application/vnd.cpc.ship.rate-v2+xml",
+        "Accept-language": "en-CA",
+    }
 
-    def __call__(self, parcel, origin, destination):
+    TEMPLATE = RATES_TEMPLATE
+
+    def build_request(self, parcel, origin, destination, services=None,
+                      options=None):
         """
-        Call the GetRates service
+        Return the serialized mailing-scenario request for the given parcel
         """
-        self.log.info("Getting rates for parcel: %s, from %s to %s", parcel,
-                      origin, destination)
-        request_tree = etree.Element(
-            'mailing-scenario', xmlns="http://www.canadapost.ca/ws/ship/rate-v2")
-        def add_child(child_name, parent=request_tree):
-            return etree.SubElement(parent, child_name)
-        add_child("customer-number").text = unicode(self.auth.customer_number)
-        if self.auth.contract_number:
-            add_child("contract-id").text = unicode(self.auth.contract_number)
-
-        # parcel characteristics
-        par_chars = add_child("parcel-characteristics")
-        add_child("weight", par_chars).text = unicode(parcel.weight)
-
-        # par_chars/dimensions
-        if all((parcel.length > 0, parcel.width > 0, parcel.height > 0)):
-            dims = add_child("dimensions", par_chars)
-            add_child("length", dims).text = unicode(parcel.length)
-            add_child("width", dims).text = unicode(parcel.width)
-            add_child("height", dims).text = unicode(parcel.height)
-
-        add_child("origin-postal-code").text = origin.postal_code
-
-        # destination
-        dest = add_child("destination")
-        if destination.country_code == "CA":
-            doms = add_child("domestic", dest)
-            add_child("postal-code", doms).text = destination.postal_code
-        elif destination.country_code == "US":
-            us = add_child("united-states")
-            add_child("zip-code", us).text = destination.postal_code
-        else:
-            # international shipping
-            intr = add_child("international", dest)
-            add_child("country-code", intr).text = destination.country_code
-
-        # our XML tree is complete. On to the request
-        headers = {
-            'Accept': "application/vnd.cpc.ship.rate-v2+xml",
-            'Content-type': "application/vnd.cpc.ship.rate-v2+xml",
-            "Accept-language": "en-CA",
+        return self.render(self.request_values(parcel, origin, destination,
+                                               services, options))
+
+    def request_values(self, parcel, origin, destination, services=None,
+                       options=None):
+        """
+        Template values of the mailing-scenario request for the given parcel
+        """
+        return {
+            'customer_number': text_type(self.auth.customer_number),
+            'contract_id': (text_type(self.auth.contract_number)
+                            if self.auth.contract_number else None),
+            'weight': text_type(parcel.weight),
+            'dimensions': all((parcel.length > 0, parcel.width > 0,
+                               parcel.height > 0)),
+            'length': text_type(parcel.length),
+            'width': text_type(parcel.width),
+            'height': text_type(parcel.height),
+            'origin_postal_code': origin.postal_code,
+            'domestic': destination.country_code == "CA",
+            'united_states': destination.country_code == "US",
+            'international': destination.country_code not in ("CA", "US"),
+            'postal_code': destination.postal_code,
+            'country_code': destination.country_code,
+            'services': [{'code': code} for code in services or ()],
+            'options': [{'code': code, 'amount': (None if amount is None else
+                                                  text_type(amount))}
+                        for code, amount in rate_options(options)],
         }
 
+    def parse_response(self, content):
+        """
+        Return the list of Service objects in a GetRates response body
+        """
+        return [Service(data=data) for data in parse_rates(content)]
+
+    def _cached(self, parcel, origin, destination, services=None,
+                options=None):
+        """
+        Return the key of the scenario and the services cached for it, if
+        any. The key is None when there's neither a cache nor coalescing
+        """
+        if self.cache is None:
+            if self.singleflight is None:
+                return None, None
+            return scenario_key(self.auth, parcel, origin, destination,
+                                services, options), None
+        key = scenario_key(self.auth, parcel, origin, destination, services,
+                           options)
+        return key, self.cache.get(key)
+
+    def _send(self, request, stream=False, call=NULL_CALL):
         url = self.get_url()
         self.log.info("Using url %s", url)
-        request = str(etree.tostring(request_tree, pretty_print=self.auth.debug))
-        self.log.debug("Request xml: %s", request)
-        response = requests.post(url, data=request, headers=headers,
-                                 auth=self.userpass())
+        self._debug_xml("Request xml: %s", request)
+        response = self._request('POST', url, call=call, data=request,
+                                 headers=self.HEADERS, stream=stream)
         self.log.info("Request returned with status %s", response.status_code)
-        self.log.debug("Request returned content: %s", response.content)
         if not response.ok:
             response.raise_for_status()
+        return response
 
-        # this is a hack to remove the namespace from the response, since this
-        #breaks xpath lookup in lxml
-        restree = etree.XML(response.content.replace(' xmlns="',
-                                                     ' xmlnamespace="'))
-        services = [Service(xml_subtree=price)
-                    for price in restree.findall("price-quote")]
+    def __call__(self, parcel, origin, destination, services=None,
+                 options=None):
+        """
+        Call the GetRates service
 
+        services -- codes of the services to quote, instead of all the
+            available ones. The response only has those, so it's smaller and
+            quicker to parse (see canada_post.catalogue to pick them)
+        options -- options to include in the prices: a dict of option code
+            (e.g. "SO", "COV") -> amount (the coverage amount, None for
+            options without one), or a list of option codes
+        """
+        self.log.info("Getting rates for parcel: %s, from %s to %s", parcel,
+                      origin, destination)
+        filters = (services, options)
+        with self._begin() as call:
+            key, cached = self._cached(parcel, origin, destination, *filters)
+            if cached is not None:
+                self.log.info("Using cached rates")
+                call.cached = True
+                return list(cached)
+            call.skip()
+            return self._quote(call, key, parcel, origin, destination,
+                               *filters)
+
+    def refresh(self, parcel, origin, destination, services=None,
+                options=None):
+        """
+        Call the GetRates service without looking the scenario up in the
+        cache first, for callers that already did. The services are still
+        cached, and concurrent calls still coalesced
+        """
+        filters = (services, options)
+        key = None
+        if self.cache is not None or self.singleflight is not None:
+            key = scenario_key(self.auth, parcel, origin, destination,
+                               *filters)
+        with self._begin() as call:
+            return self._quote(call, key, parcel, origin, destination,
+                               *filters)
+
+    def _quote(self, call, key, parcel, origin, destination, services=None,
+               options=None):
+        filters = (services, options)
+        if self.singleflight is None:
+            services = self._fetch(call, key, parcel, origin, destination,
+                                   *filters)
+        else:
+            services = self.singleflight.do(
+                key, lambda: self._fetch(call, key, parcel, origin,
+                                         destination, *filters))
+            # the call of another caller got them
+            call.coalesced = call.attempts == 0
+        return list(services)
+
+    def _fetch(self, call, key, parcel, origin, destination, services=None,
+               options=None):
+        """
+        Request the services for the scenario and cache them
+        """
+        values = self.request_values(parcel, origin, destination, services,
+                                     options)
+        call.phase("build")
+        request = self.render(values)
+        call.phase("serialize")
+        call.request(request)
+        if self.hedge is None:
+            response = self._send(request, call=call)
+        else:
+            response = self.hedge.run(lambda: self._send(request, call=call),
+                                      self.rate_limiter)
+        content = response.content
+        call.phase("network")
+        call.response_size = len(content)
+        self._debug_xml("Request returned content: %s", content)
+
+        services = self.parse_response(content)
+        call.phase("parse")
+        if self.cache is not None:
+            self.cache.set(key, services)
         return services
+
+    def stream(self, parcel, origin, destination, services=None,
+               options=None):
+        """
+        Like calling the service, but the response is parsed as it's received
+        and each Service is yielded as soon as it has been read
+        """
+        self.log.info("Streaming rates for parcel: %s, from %s to %s", parcel,
+                      origin, destination)
+        with self._begin() as call:
+            key, cached = self._cached(parcel, origin, destination, services,
+                                       options)
+            if cached is not None:
+                self.log.info("Using cached rates")
+                call.cached = True
+                for service in cached:
+                    yield service
+                return
+            call.skip()
+
+            values = self.request_values(parcel, origin, destination,
+                                         services, options)
+            call.phase("build")
+            request = self.render(values)
+            call.phase("serialize")
+            call.request(request)
+            response = self._send(request, stream=True, call=call)
+            call.phase("network")
+            services = []
+            try:
+                # let urllib3 undo any content-encoding
+                response.raw.decode_content = True
+                for data in iter_rates(response.raw):
+                    service = Service(data=data)
+                    services.append(service)
+                    call.phase("parse")
+                    yield service
+                    # the time the consumer takes isn't parsing
+                    call.skip()
+            finally:
+                response.close()
+            if self.cache is not None:
+                self.cache.set(key, services)
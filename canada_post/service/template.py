@@ -0,0 +1,181 @@
+"""
+Precompiled XML request templates.
+
+A request shape is described once with Element/Text/If/Each nodes and
+compiled into a flat list of operations where all the static markup is merged
+into literal strings. Rendering a request then only escapes and concatenates the values,
+instead of building an lxml tree node by node and serializing it.
+
+The output is byte for byte what lxml.etree.tostring produces for the
+equivalent tree (ASCII encoded, non-ASCII characters as character references,
+text-less elements self-closed)
+"""
+import re
+
+try:
+    text_type = unicode
+except NameError:
+    # python 3
+    text_type = str
+
+# characters lxml refuses in text content
+_INVALID_XML = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_ESCAPE = re.compile(u"[&<>\r]")
+_SPECIAL = re.compile(u"[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_ENTITIES = {u"&": u"&amp;", u"<": u"&lt;", u">": u"&gt;", u"\r": u"&#13;"}
+
+def escape(value):
+    """
+    Escape text content the way lxml does
+    """
+    value = text_type(value)
+    if _SPECIAL.search(value) is None:
+        return value
+    if _INVALID_XML.search(value):
+        raise ValueError("All strings must be XML compatible: Unicode or "
+                         "ASCII, no NULL bytes or control characters")
+    return _ESCAPE.sub(lambda match: _ENTITIES[match.group()], value)
+
+def _attributes(attrib):
+    return u"".join(u' {0}="{1}"'.format(name, value)
+                    for name, value in sorted(attrib.items()))
+
+class Element(object):
+    """
+    An element with children. If all its children are conditional it's
+    self-closed when none of them is rendered
+    """
+    def __init__(self, tag, *children, **attrib):
+        self.tag = tag
+        self.children = children
+        self.attrib = attrib
+
+    def compile(self):
+        start = u"<{tag}{attrib}".format(tag=self.tag,
+                                         attrib=_attributes(self.attrib))
+        body = _compile_nodes(self.children)
+        if not self.children:
+            return [(_LITERAL, start + u"/>")]
+        if all(isinstance(child, If) for child in self.children):
+            return [(_ELEMENT, start, body, u"</{0}>".format(self.tag))]
+        return _merge([(_LITERAL, start + u">")] + body +
+                      [(_LITERAL, u"</{0}>".format(self.tag))])
+
+class Text(object):
+    """
+    A text-only element whose content is the value of `field`. A None value
+    renders as a self-closed element
+    """
+    def __init__(self, tag, field):
+        self.tag = tag
+        self.field = field
+
+    def compile(self):
+        return [(_TEXT, self.field, u"<{0}>".format(self.tag),
+                 u"</{0}>".format(self.tag), u"<{0}/>".format(self.tag))]
+
+class Const(object):
+    """
+    A text-only element with fixed content
+    """
+    def __init__(self, tag, text):
+        self.tag = tag
+        self.text = text
+
+    def compile(self):
+        return [(_LITERAL, u"<{tag}>{text}</{tag}>".format(
+            tag=self.tag, text=escape(self.text)))]
+
+class If(object):
+    """
+    Nodes only rendered when the value of `field` is true
+    """
+    def __init__(self, field, *children):
+        self.field = field
+        self.children = children
+
+    def compile(self):
+        return [(_IF, self.field, _compile_nodes(self.children))]
+
+class Each(object):
+    """
+    Nodes rendered once per item of the value of `field`, a sequence of
+    dicts with the values of each item
+    """
+    def __init__(self, field, *children):
+        self.field = field
+        self.children = children
+
+    def compile(self):
+        return [(_EACH, self.field, _compile_nodes(self.children))]
+
+_LITERAL, _TEXT, _IF, _ELEMENT, _EACH = range(5)
+
+def _merge(ops):
+    """
+    Join consecutive literal operations
+    """
+    merged = []
+    for op in ops:
+        if op[0] == _LITERAL and merged and merged[-1][0] == _LITERAL:
+            merged[-1] = (_LITERAL, merged[-1][1] + op[1])
+        else:
+            merged.append(op)
+    return merged
+
+def _compile_nodes(nodes):
+    ops = []
+    for node in nodes:
+        ops.extend(node.compile())
+    return _merge(ops)
+
+def _render(ops, values, out):
+    append = out.append
+    for op in ops:
+        kind = op[0]
+        if kind == _LITERAL:
+            append(op[1])
+        elif kind == _TEXT:
+            value = values[op[1]]
+            if value is None:
+                append(op[4])
+            else:
+                append(op[2])
+                append(escape(value))
+                append(op[3])
+        elif kind == _IF:
+            if values[op[1]]:
+                _render(op[2], values, out)
+        elif kind == _EACH:
+            for item in values[op[1]] or ():
+                _render(op[2], item, out)
+        else:
+            children = []
+            _render(op[2], values, children)
+            if children:
+                append(op[1] + u">")
+                out.extend(children)
+                append(op[3])
+            else:
+                append(op[1] + u"/>")
+
+class Template(object):
+    """
+    A compiled request shape. render() takes a dict with a value for every
+    Text, If and Each field
+    """
+    def __init__(self, root):
+        self.root = root
+        self.ops = root.compile()
+
+    def render(self, values):
+        out = []
+        _render(self.ops, values, out)
+        return u"".join(out).encode("ascii", "xmlcharrefreplace")
+
+def pretty(xml):
+    """
+    Pretty print a rendered request, for debugging
+    """
+    from lxml import etree
+    return etree.tostring(etree.XML(xml), pretty_print=True)
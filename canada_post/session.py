@@ -0,0 +1,68 @@
+"""
+HTTP session handling. A CanadaPostAPI owns a single pooled, keep-alive
+requests.Session that is handed to all of its services, so consecutive calls to
+the Canada Post servers reuse the same TCP/TLS connections instead of doing a
+new handshake each time
+
+requests is imported when the first session is created
+"""
+
+# number of per-host connection pools to cache (one per server we talk to)
+POOL_CONNECTIONS = 4
+# maximum number of connections kept alive for each host
+POOL_MAXSIZE = 10
+
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                   pool_block=False, keep_alive=True):
+    """
+    Create a connection-pooled requests.Session
+
+    pool_connections -- number of host pools to keep around
+    pool_maxsize -- connections kept alive per host
+    pool_block -- if True, never open more than pool_maxsize connections to
+        a given host, and wait for a free one instead
+    keep_alive -- if False, every connection is closed once its response is
+        read, and the server is asked to close it too (disables connection
+        reuse)
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter_class = HTTPAdapter if keep_alive else _closing_adapter()
+    adapter = adapter_class(pool_connections=pool_connections,
+                            pool_maxsize=pool_maxsize, pool_block=pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers['Connection'] = "close"
+    return session
+
+def _closing_adapter():
+    """
+    An HTTPAdapter class whose connections are closed when they're given back
+    to their pool, instead of being kept for the next request. So a socket
+    the server closed is never reused, whether or not it said so
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def closing(pool_class):
+        class ClosingPool(pool_class):
+            def _put_conn(self, conn):
+                if conn is not None:
+                    conn.close()
+                # frees the pool slot, a new connection is opened for it
+                super(ClosingPool, self)._put_conn(None)
+        return ClosingPool
+
+    pool_classes = {
+        'http': closing(HTTPConnectionPool),
+        'https': closing(HTTPSConnectionPool),
+    }
+
+    class ClosingAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super(ClosingAdapter, self).init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    return ClosingAdapter
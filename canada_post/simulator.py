@@ -0,0 +1,539 @@
+"""
+Local simulator of the Canada Post Developer Program API, for offline and load
+testing.
+
+It runs an HTTP server on localhost, in a background thread, implementing
+  * POST /rs/ship/price (GetRates)
+  * POST /rs/{customer}/{mobo}/shipment (CreateShipment)
+  * DELETE /rs/{customer}/{mobo}/shipment/{id} (VoidShipment, the shipment's
+    'self' link)
+  * GET /rs/{customer}/{mobo}/shipment?groupId={group}, GET of a shipment's
+    'self' and 'details' links (looking up shipments)
+  * GET of a shipment's label link, returning a fake PDF (of
+    `artifact_size` bytes, if given), with support for Range requests
+with realistic price-quotes/shipment-info XML, plus configurable latency, error
+rate and throttling.
+
+    with Simulator(latency=(0.05, 0.2), error_rate=0.01) as simulator:
+        cpa = CanadaPostAPI(customer_number, username, password,
+                            contract_number)
+        simulator.install(cpa)
+        services = cpa.get_rates(parcel, origin, destination)
+"""
+import errno
+import itertools
+import logging
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from decimal import Decimal
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+from canada_post import DEV, PROD
+from canada_post.service import ServiceBase
+from canada_post.service.parsing import RATE_NAMESPACE, SHIPMENT_NAMESPACE
+
+MESSAGES_NAMESPACE = "http://www.canadapost.ca/ws/messages"
+RATE_MEDIA_TYPE = "application/vnd.cpc.ship.rate-v2+xml"
+SHIPMENT_MEDIA_TYPE = "application/vnd.cpc.shipment-v2+xml"
+
+# (code, name, price factor, expected transit days) offered for each kind of
+#  destination
+SERVICES = {
+    'domestic': (
+        ("DOM.RP", "Regular Parcel", "1.00", 4),
+        ("DOM.EP", "Expedited Parcel", "1.15", 2),
+        ("DOM.XP", "Xpresspost", "1.60", 1),
+        ("DOM.PC", "Priority", "2.40", 1),
+    ),
+    'united-states': (
+        ("USA.TP", "Tracked Packet - USA", "1.80", 6),
+        ("USA.EP", "Expedited Parcel USA", "2.00", 4),
+        ("USA.XP", "Xpresspost USA", "2.70", 2),
+        ("USA.PW.PARCEL", "Priority Worldwide parcel USA", "4.20", 1),
+    ),
+    'international': (
+        ("INT.IP.SURF", "International Parcel Surface", "2.50", 40),
+        ("INT.IP.AIR", "International Parcel Air", "3.80", 8),
+        ("INT.XP", "Xpresspost International", "4.60", 5),
+        ("INT.PW.PARCEL", "Priority Worldwide parcel INTL", "6.50", 3),
+    ),
+}
+FUEL_SURCHARGE = Decimal("0.1775")
+GST = Decimal("0.05")
+CENT = Decimal("0.01")
+# a single byte range, the only kind of Range the simulator supports
+_RANGE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+# a minimal valid PDF, served as the label of every shipment
+LABEL = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+         b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+         b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 288 432]>>endobj\n"
+         b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+def _text(root, path):
+    """
+    Text of the first element with the given local name under root, if any
+    """
+    found = root.xpath("//*[local-name()=$name]", name=path)
+    return found[0].text if found else None
+
+def _messages(code, description):
+    return (u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<messages xmlns="{ns}"><message><code>{code}</code>'
+            u'<description>{description}</description></message></messages>'
+            .format(ns=MESSAGES_NAMESPACE, code=code,
+                    description=description)).encode("utf-8")
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up before the response is sent (cancelled or
+        #  hedged requests) aren't server errors
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) and \
+                error.errno in (errno.EPIPE, errno.ECONNRESET):
+            self.simulator.log.debug("%s hung up", client_address)
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # whether the response to the current request is replaced by an error
+    lost = False
+    # headers and body are written separately, don't let Nagle's algorithm
+    #  delay the body
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.simulator._count('connections')
+
+    def log_message(self, format, *args):
+        self.server.simulator.log.debug(format, *args)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _respond(self, status, body=b"", content_type=SHIPMENT_MEDIA_TYPE,
+                 headers=None):
+        if self.lost and status < 400:
+            # processed, but the client doesn't get to know
+            status, body = 500, _messages("9999", "Internal error")
+        self.send_response(status)
+        if body:
+            self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            # the client asked for it, say the socket is closed after this
+            self.send_header('Connection', "close")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.simulator._count(status)
+
+    def _handle(self):
+        simulator = self.server.simulator
+        body = self._body()
+        simulator._count('requests')
+        simulator._sleep(self.path)
+        if not self.headers.get('Authorization'):
+            return self._respond(401, _messages("E002", "Unauthorized"))
+        throttled = simulator._throttled()
+        if throttled:
+            return self._respond(throttled, _messages(
+                "AA004", "You cannot exceed your allowed rate of requests"),
+                headers={'Retry-After': str(simulator.retry_after)})
+        if simulator.error_rate and \
+                simulator._random.random() < simulator.error_rate:
+            return self._respond(500, _messages("9999", "Internal error"))
+        self.lost = bool(simulator.lost_rate and self.command != 'GET' and
+                         simulator._random.random() < simulator.lost_rate)
+        for method, pattern, handler in simulator.routes:
+            if method != self.command:
+                continue
+            match = pattern.match(self.path)
+            if match:
+                return handler(self, body, **match.groupdict())
+        return self._respond(404, _messages("9999", "Not found"))
+
+    do_GET = do_POST = do_DELETE = _handle
+
+class Simulator(object):
+    """
+    Simulated Canada Post server.
+
+    latency -- seconds to wait before answering each request: a number, a
+        (min, max) tuple for a uniformly distributed delay, or a callable
+        taking the request path
+    error_rate -- fraction of the requests answered with an HTTP 500
+    lost_rate -- fraction of the POST and DELETE requests that are processed
+        but answered with an HTTP 500 anyway, as when the response is lost on
+        its way back
+    throttle_rate -- fraction of the requests answered with a throttling
+        response (`throttle_status`, 429 by default, with a Retry-After of
+        `retry_after` seconds)
+    max_rate -- if set, requests over this many per second get a throttling
+        response too
+    seed -- seed for the random latencies/errors, for reproducible runs
+    ranges -- if False, the Range header of artifact downloads is ignored
+        and the whole label is sent, as some servers do
+    artifact_size -- size of the labels served, padded with PDF comments.
+        They're a few hundred bytes by default
+    """
+    log = logging.getLogger('canada_post.simulator.Simulator')
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_rate=0,
+                 throttle_rate=0, max_rate=None, throttle_status=429,
+                 retry_after=1, seed=None, lost_rate=0, artifact_size=None,
+                 ranges=True):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lost_rate = lost_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.throttle_status = throttle_status
+        self.retry_after = retry_after
+        self.ranges = ranges
+        self.label = LABEL
+        if artifact_size and artifact_size > len(LABEL):
+            padding = b"%" * (artifact_size - len(LABEL) - 1) + b"\n"
+            self.label = LABEL.replace(b"trailer", padding + b"trailer")
+        self.shipments = {}
+        self.stats = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(347881315405043891)
+        self._window = (0, 0)
+        self._server = None
+        self._thread = None
+        self.routes = [
+            ('POST', re.compile(r"^/rs/ship/price/?$"), self._price),
+            ('POST', re.compile(r"^/rs/(?P<customer>[^/]+)/(?P<mobo>[^/]+)"
+                                r"/shipment/?$"), self._create_shipment),
+            ('DELETE', re.compile(r"^/rs/(?P<customer>[^/]+)/(?P<mobo>[^/]+)"
+                                  r"/shipment/(?P<id>\d+)/?$"),
+             self._void_shipment),
+            ('GET', re.compile(r"^/rs/(?P<customer>[^/]+)/(?P<mobo>[^/]+)"
+                               r"/shipment\?groupId=(?P<group>[^&]*)$"),
+             self._group_shipments),
+            ('GET', re.compile(r"^/rs/(?P<customer>[^/]+)/(?P<mobo>[^/]+)"
+                               r"/shipment/(?P<id>\d+)/?$"),
+             self._get_shipment),
+            ('GET', re.compile(r"^/rs/(?P<customer>[^/]+)/(?P<mobo>[^/]+)"
+                               r"/shipment/(?P<id>\d+)/details/?$"),
+             self._shipment_details),
+            ('GET', re.compile(r"^/ers/artifact/(?P<customer>[^/]+)/"
+                               r"(?P<id>\d+)/(?P<index>\d+)/?$"),
+             self._artifact),
+        ]
+
+    @property
+    def server(self):
+        """
+        host:port the simulator is listening on, as used in
+        ServiceBase.SERVER
+        """
+        return "{0}:{1}".format(self.host, self.port)
+
+    @property
+    def base_url(self):
+        return "http://{0}".format(self.server)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.simulator = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="canada-post-simulator")
+        self._thread.daemon = True
+        self._thread.start()
+        self.log.info("Simulator listening on %s", self.base_url)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def install(self, api):
+        """
+        Point every service of `api` (a CanadaPostAPI, AsyncCanadaPostAPI or
+        a single service) at this simulator
+        """
+        if isinstance(api, ServiceBase):
+            services = [api]
+        elif hasattr(api, 'services'):
+            # CanadaPostAPI creates its services on first use
+            services = api.services()
+        else:
+            services = [service for service in vars(api).values()
+                        if isinstance(service, ServiceBase)]
+        for service in services:
+            service.SERVER = {DEV: self.server, PROD: self.server}
+            service.SCHEME = "http"
+        return api
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def _sleep(self, path):
+        latency = self.latency
+        if callable(latency):
+            latency = latency(path)
+        elif isinstance(latency, (tuple, list)):
+            latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _throttled(self):
+        """
+        Return the throttling status if this request should be throttled
+        """
+        if self.throttle_rate and \
+                self._random.random() < self.throttle_rate:
+            return self.throttle_status
+        if self.max_rate:
+            with self._lock:
+                second = int(time.time())
+                window, count = self._window
+                if window != second:
+                    window, count = second, 0
+                count += 1
+                self._window = (window, count)
+            if count > self.max_rate:
+                return self.throttle_status
+        return None
+
+    def quote(self, kind, weight):
+        """
+        Return the (code, name, base, fuel, gst, due, transit) tuples quoted for
+        a parcel of the given billable weight to the given kind of
+        destination
+        """
+        quotes = []
+        for code, name, factor, transit in SERVICES[kind]:
+            base = ((Decimal("7.25") + Decimal("2.10") * weight) *
+                    Decimal(factor)).quantize(CENT)
+            fuel = (base * FUEL_SURCHARGE).quantize(CENT)
+            gst = ((base + fuel) * GST).quantize(CENT) \
+                if kind == 'domestic' else Decimal("0.00")
+            quotes.append((code, name, base, fuel, gst, base + fuel + gst,
+                           transit))
+        return quotes
+
+    def _price(self, handler, body):
+        try:
+            root = etree.fromstring(body)
+            weight = Decimal(_text(root, "weight"))
+        except Exception:
+            return handler._respond(400, _messages("Server", "Bad request"))
+        dimensions = [_text(root, name) for name in
+                      ("length", "width", "height")]
+        if all(dimensions):
+            # volumetric weight
+            length, width, height = (Decimal(dim) for dim in dimensions)
+            weight = max(weight, length * width * height / 6000)
+        if root.xpath("//*[local-name()='domestic']"):
+            kind, country = 'domestic', "CA"
+        elif root.xpath("//*[local-name()='united-states']"):
+            kind, country = 'united-states', "US"
+        else:
+            kind, country = 'international', _text(root, "country-code")
+        # the services asked for, if any
+        wanted = set(root.xpath("//*[local-name()='services']"
+                                "/*[local-name()='service-code']/text()"))
+        quotes = []
+        for code, name, base, fuel, gst, due, transit in self.quote(kind,
+                                                                    weight):
+            if wanted and code not in wanted:
+                continue
+            quotes.append(
+                u"<price-quote>"
+                u"<service-code>{code}</service-code>"
+                u'<service-link rel="service" href="{url}/rs/ship/service/'
+                u'{code}?country={country}" media-type="{media}"/>'
+                u"<service-name>{name}</service-name>"
+                u"<price-details><base>{base}</base><taxes>"
+                u'<gst percent="{gst_pc}">{gst}</gst>'
+                u'<pst percent="0">0.00</pst><hst percent="0">0.00</hst>'
+                u"</taxes><due>{due}</due><adjustments><adjustment>"
+                u"<adjustment-code>FUELSC</adjustment-code>"
+                u"<adjustment-name>Fuel surcharge</adjustment-name>"
+                u"<adjustment-cost>{fuel}</adjustment-cost>"
+                u"<qualifier><percent>17.75</percent></qualifier>"
+                u"</adjustment></adjustments></price-details>"
+                u"<weight-details/>"
+                u"<service-standard><am-delivery>false</am-delivery>"
+                u"<guaranteed-delivery>true</guaranteed-delivery>"
+                u"<expected-transit-time>{transit}</expected-transit-time>"
+                u"</service-standard>"
+                u"</price-quote>".format(
+                    code=code, url=self.base_url, country=country,
+                    media=RATE_MEDIA_TYPE, name=name, base=base, gst=gst,
+                    gst_pc="5.00" if gst else "0", due=due, fuel=fuel,
+                    transit=transit))
+        content = (u'<?xml version="1.0" encoding="UTF-8"?>'
+                   u'<price-quotes xmlns="{ns}">{quotes}</price-quotes>'
+                   .format(ns=RATE_NAMESPACE, quotes=u"".join(quotes)))
+        return handler._respond(200, content.encode("utf-8"),
+                                content_type=RATE_MEDIA_TYPE)
+
+    def _shipment_url(self, customer, mobo, shipment_id):
+        return "{url}/rs/{customer}/{mobo}/shipment/{id}".format(
+            url=self.base_url, customer=customer, mobo=mobo, id=shipment_id)
+
+    def _create_shipment(self, handler, body, customer, mobo):
+        try:
+            root = etree.fromstring(body)
+        except Exception:
+            return handler._respond(400, _messages("Server", "Bad request"))
+        if not _text(root, "service-code") or not _text(root, "contract-id"):
+            return handler._respond(400, _messages(
+                "8512", "Missing service code or contract id"))
+        shipment_id = str(next(self._ids))
+        group = _text(root, "group-id") or ""
+        tracking_pin = shipment_id[-12:]
+        with self._lock:
+            self.shipments[shipment_id] = {
+                'id': shipment_id,
+                'group': group,
+                'status': "created",
+                'tracking_pin': tracking_pin,
+                'reference': _text(root, "customer-ref-1"),
+            }
+        return handler._respond(200, self._shipment_info(customer, mobo,
+                                                         shipment_id))
+
+    def _shipment_info(self, customer, mobo, shipment_id):
+        """
+        <shipment-info> response body of a shipment
+        """
+        shipment = self.shipments[shipment_id]
+        url = self._shipment_url(customer, mobo, shipment_id)
+        return (
+            u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<shipment-info xmlns="{ns}">'
+            u"<shipment-id>{id}</shipment-id>"
+            u"<shipment-status>{status}</shipment-status>"
+            u"<tracking-pin>{pin}</tracking-pin>"
+            u"<links>"
+            u'<link rel="self" href="{url}" media-type="{media}"/>'
+            u'<link rel="details" href="{url}/details" media-type="{media}"/>'
+            u'<link rel="group" href="{base}/rs/{customer}/{mobo}/shipment?'
+            u'groupId={group}" media-type="{media}"/>'
+            u'<link rel="price" href="{url}/price" media-type="{media}"/>'
+            u'<link rel="label" href="{base}/ers/artifact/{customer}/{id}/0" '
+            u'media-type="application/pdf" index="0"/>'
+            u"</links>"
+            u"</shipment-info>".format(
+                ns=SHIPMENT_NAMESPACE, id=shipment_id,
+                status=shipment['status'], pin=shipment['tracking_pin'],
+                url=url, media=SHIPMENT_MEDIA_TYPE, base=self.base_url,
+                customer=customer, mobo=mobo, group=shipment['group'])
+        ).encode("utf-8")
+
+    def _get_shipment(self, handler, body, customer, mobo, id):
+        if id not in self.shipments:
+            return handler._respond(404, _messages("9999", "Not found"))
+        return handler._respond(200, self._shipment_info(customer, mobo, id))
+
+    def _shipment_details(self, handler, body, customer, mobo, id):
+        shipment = self.shipments.get(id)
+        if shipment is None:
+            return handler._respond(404, _messages("9999", "Not found"))
+        reference = u""
+        if shipment['reference'] is not None:
+            reference = (u"<references><customer-ref-1>{0}</customer-ref-1>"
+                         u"</references>").format(shipment['reference'])
+        content = (
+            u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<shipment-details xmlns="{ns}">'
+            u"<shipment-status>{status}</shipment-status>"
+            u"<tracking-pin>{pin}</tracking-pin>"
+            u"<shipment-detail><group-id>{group}</group-id>"
+            u"<delivery-spec>{reference}</delivery-spec></shipment-detail>"
+            u"</shipment-details>".format(
+                ns=SHIPMENT_NAMESPACE, status=shipment['status'],
+                pin=shipment['tracking_pin'], group=shipment['group'],
+                reference=reference))
+        return handler._respond(200, content.encode("utf-8"))
+
+    def _group_shipments(self, handler, body, customer, mobo, group):
+        with self._lock:
+            # voided shipments are gone from Canada Post
+            ids = [shipment['id'] for shipment in self.shipments.values()
+                   if shipment['group'] == group and
+                   shipment['status'] != "cancelled"]
+        links = u"".join(
+            u'<link rel="shipment" href="{url}" media-type="{media}"/>'.format(
+                url=self._shipment_url(customer, mobo, shipment_id),
+                media=SHIPMENT_MEDIA_TYPE)
+            for shipment_id in sorted(ids))
+        content = (u'<?xml version="1.0" encoding="UTF-8"?>'
+                   u'<shipments xmlns="{ns}">{links}</shipments>'
+                   .format(ns=SHIPMENT_NAMESPACE, links=links))
+        return handler._respond(200, content.encode("utf-8"))
+
+    def _void_shipment(self, handler, body, customer, mobo, id):
+        with self._lock:
+            shipment = self.shipments.get(id)
+            if shipment is not None and shipment['status'] == "created":
+                shipment['status'] = "cancelled"
+                voided = True
+            else:
+                voided = False
+        if not voided:
+            return handler._respond(404, _messages(
+                "8062", "No shipment found or shipment already voided"))
+        return handler._respond(204)
+
+    def _artifact(self, handler, body, customer, id, index):
+        if id not in self.shipments:
+            return handler._respond(404, _messages("9999", "Not found"))
+        label = self.label
+        match = _RANGE.match(handler.headers.get('Range') or "")
+        if match is None or not self.ranges:
+            return handler._respond(200, label,
+                                    content_type="application/pdf")
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(label) - 1), len(label) - 1)
+        if start >= len(label) or start > end:
+            return handler._respond(416, headers={
+                'Content-Range': "bytes */{0}".format(len(label))})
+        return handler._respond(206, label[start:end + 1],
+                                content_type="application/pdf", headers={
+                                    'Content-Range': "bytes {0}-{1}/{2}"
+                                    .format(start, end, len(label))})
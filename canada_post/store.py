@@ -0,0 +1,186 @@
+"""
+Persistent store of the created shipments, so that they can be voided or
+their labels reprinted later, from another process or after a restart.
+
+A ShipmentStore keeps every Shipment in a sqlite database file, indexed by
+shipment id, tracking pin and group. Give it to the CreateShipment and
+VoidShipment services (CanadaPostAPI(..., shipment_store=store)) and the
+shipments they create are saved, and marked as voided (status "voided")
+when voided.
+
+    store = ShipmentStore("shipments.db")
+    cpa = CanadaPostAPI(..., shipment_store=store)
+    cpa.create_shipments(jobs)
+    ...
+    for shipment in store.by_group("20240501", status="created"):
+        cpa.void_shipment(shipment)
+"""
+import json
+import time
+from canada_post.service.contract_shipping import Shipment
+from canada_post.util.sqlite import LocalConnection
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # python 2
+    from urlparse import urlparse, parse_qs
+
+# the most variables sqlite accepts in a statement by default
+_MAX_VARIABLES = 999
+
+def shipment_group(shipment):
+    """
+    The group of a Shipment, from the groupId of its 'group' link. None if it
+    has none
+    """
+    link = (getattr(shipment, 'links', None) or {}).get('group')
+    if not link:
+        return None
+    values = parse_qs(urlparse(link['href']).query).get('groupId')
+    return values[0] if values else None
+
+class ShipmentStore(object):
+    """
+    sqlite store of Shipment objects. It can be shared between threads, and
+    between processes by pointing them to the same database file. Every
+    Shipment attribute is kept, as JSON, so the Shipment objects read back
+    have their links and can be voided
+    """
+    def __init__(self, path, table="shipments", timeout=10):
+        self.path = path
+        self.table = table
+        self.timeout = timeout
+        self._connection = LocalConnection(path, timeout)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS {table} ("
+                         "id TEXT PRIMARY KEY, status TEXT, "
+                         "tracking_pin TEXT, group_id TEXT, reference TEXT, "
+                         "data TEXT NOT NULL, created REAL NOT NULL, "
+                         "updated REAL NOT NULL)".format(table=table))
+            conn.execute("CREATE INDEX IF NOT EXISTS {table}_tracking_pin "
+                         "ON {table} (tracking_pin)".format(table=table))
+            conn.execute("CREATE INDEX IF NOT EXISTS {table}_group "
+                         "ON {table} (group_id, status)".format(table=table))
+
+    def _row(self, shipment, group, reference, now):
+        data = shipment._asdict()
+        if group is None:
+            group = data.get('group_id') or shipment_group(shipment)
+        if reference is None:
+            reference = data.get('reference')
+        data['group_id'] = group
+        data['reference'] = reference
+        return (data['id'], data.get('status'), data.get('tracking_pin'),
+                group, reference, json.dumps(data), now, now)
+
+    def add(self, shipment, group=None, reference=None):
+        """
+        Save a Shipment, replacing any with the same id. The group is taken
+        from its 'group' link if not given
+        """
+        self.add_many([(shipment, group, reference)])
+
+    def add_many(self, shipments):
+        """
+        Save many Shipment objects, or (shipment, group, reference) tuples,
+        in a single transaction
+        """
+        now = time.time()
+        rows = []
+        for item in shipments:
+            if not isinstance(item, tuple):
+                item = (item,)
+            shipment, group, reference = (item + (None, None))[:3]
+            rows.append(self._row(shipment, group, reference, now))
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO {table} (id, status, "
+                             "tracking_pin, group_id, reference, data, "
+                             "created, updated) VALUES (?, ?, ?, ?, ?, ?, "
+                             "COALESCE((SELECT created FROM {table} WHERE "
+                             "id = ?), ?), ?)".format(table=self.table),
+                             [row[:6] + (row[0],) + row[6:]
+                              for row in rows])
+        return len(rows)
+
+    def _shipments(self, where, args):
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT data, status FROM {table} WHERE {where} "
+                "ORDER BY created".format(table=self.table, where=where),
+                args).fetchall()
+        shipments = []
+        for data, status in rows:
+            data = json.loads(data)
+            data['status'] = status
+            shipments.append(Shipment(**data))
+        return shipments
+
+    def get(self, shipment_id):
+        """
+        The Shipment with the given id, None if it isn't in the store
+        """
+        shipments = self._shipments("id = ?", (shipment_id,))
+        return shipments[0] if shipments else None
+
+    def get_many(self, shipment_ids):
+        """
+        The Shipment objects with the given ids that are in the store
+        """
+        shipment_ids = list(shipment_ids)
+        shipments = []
+        for start in range(0, len(shipment_ids), _MAX_VARIABLES):
+            chunk = shipment_ids[start:start + _MAX_VARIABLES]
+            shipments.extend(self._shipments(
+                "id IN ({0})".format(", ".join("?" * len(chunk))), chunk))
+        return shipments
+
+    def by_tracking_pin(self, tracking_pin):
+        """
+        The Shipment with the given tracking pin, None if there's none
+        """
+        shipments = self._shipments("tracking_pin = ?", (tracking_pin,))
+        return shipments[0] if shipments else None
+
+    def by_group(self, group, status=None):
+        """
+        The Shipment objects of a group, optionally only the ones with the
+        given status (e.g. "created"), oldest first
+        """
+        if status is None:
+            return self._shipments("group_id = ?", (group,))
+        return self._shipments("group_id = ? AND status = ?", (group, status))
+
+    def set_status(self, shipment_ids, status):
+        """
+        Change the status of the shipments with the given ids. Returns how
+        many were found
+        """
+        now = time.time()
+        with self._connection() as conn:
+            return conn.executemany(
+                "UPDATE {table} SET status = ?, updated = ? WHERE id = ?"
+                .format(table=self.table),
+                [(status, now, shipment_id)
+                 for shipment_id in shipment_ids]).rowcount
+
+    def delete(self, shipment_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM {table} WHERE id = ?"
+                         .format(table=self.table), (shipment_id,))
+
+    def __contains__(self, shipment_id):
+        with self._connection() as conn:
+            return conn.execute(
+                "SELECT 1 FROM {table} WHERE id = ?".format(table=self.table),
+                (shipment_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM {table}".format(table=self.table)
+            ).fetchone()[0]
+
+    def __repr__(self):
+        return "ShipmentStore(path={path!r}, table={table!r})".format(
+            path=self.path, table=self.table)
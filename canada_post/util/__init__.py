@@ -1,9 +1,75 @@
+from collections import OrderedDict
+
 class InfoObject(object):
+    """
+    Base class for the value objects. Subclasses declare their attributes in
+    __slots__ so instances don't carry a __dict__. Extra keyword arguments
+    that aren't slots are kept in a dict that's only created when there's any
+    (subclasses that don't declare __slots__ get a regular __dict__ instead)
+    """
+    __slots__ = ('_extra',)
+
+    _slot_names = {}
+
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
         # set any extra kwargs we got
-            setattr(self, k, v)
+            try:
+                setattr(self, k, v)
+            except AttributeError:
+                try:
+                    extra = object.__getattribute__(self, '_extra')
+                except AttributeError:
+                    extra = self._extra = OrderedDict()
+                extra[k] = v
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails, look in the extra kwargs
+        try:
+            extra = object.__getattribute__(self, '_extra')
+        except AttributeError:
+            extra = {}
+        try:
+            return extra[name]
+        except KeyError:
+            raise AttributeError("{klass!r} object has no attribute {name!r}"
+                                 .format(klass=self.__class__.__name__,
+                                         name=name))
+
+    @classmethod
+    def _slots(cls):
+        """
+        Names of the slots of the class, most derived class first
+        """
+        try:
+            return cls._slot_names[cls]
+        except KeyError:
+            names = []
+            for klass in cls.__mro__:
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in ('_extra', '__dict__', '__weakref__') and \
+                            name not in names:
+                        names.append(name)
+            cls._slot_names[cls] = names
+            return names
+
+    def _asdict(self):
+        """
+        The attributes that have been set, as a dict
+        """
+        contents = OrderedDict()
+        for name in self._slots():
+            try:
+                contents[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        try:
+            contents.update(object.__getattribute__(self, '_extra'))
+        except AttributeError:
+            pass
+        contents.update(getattr(self, '__dict__', {}))
+        return contents
 
     def __repr__(self):
         return "{klass}.{contents}".format(klass=self.__class__.__name__,
-                                           contents=repr(self.__dict__))
+                                           contents=repr(dict(self._asdict())))
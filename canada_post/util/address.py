@@ -1,6 +1,33 @@
 from canada_post.util import InfoObject
+from canada_post.validation import ADDRESS_LINE_LENGTH
+
+def split_address(address):
+    """
+    Split a street address in its two address lines. `address` is a string,
+    split at the last space that leaves a first line of up to
+    ADDRESS_LINE_LENGTH characters, or a tuple of the two lines. A line can
+    be left longer than that if the address doesn't fit:
+    canada_post.validation reports it
+    """
+    if isinstance(address, tuple):
+        return address[0], address[1]
+    if len(address) <= ADDRESS_LINE_LENGTH:
+        return address.strip(), ""
+    split = address.rfind(" ", 0, ADDRESS_LINE_LENGTH + 1)
+    if split <= 0:
+        # no space to split at
+        split = ADDRESS_LINE_LENGTH
+    return address[:split].strip(), address[split:].strip()
 
 class AddressBase(InfoObject):
+    """
+    The fields aren't checked here, so that invalid addresses can still be
+    built and their errors reported along the others by
+    canada_post.validation (e.g. per job with validate_shipments)
+    """
+    __slots__ = ('postal_code', 'name', 'company', 'phone', 'address1',
+                 'address2', 'city', 'province')
+
     def __init__(self, postal_code, name=None, company=None, phone=None,
                  address=None, city=None, province=None,
                  *args, **kwargs):
@@ -10,41 +37,28 @@ class AddressBase(InfoObject):
         self.phone = phone
 
         if address:
-            if isinstance(address, tuple):
-                assert all(len(x) < 44 for x in address), ("Street address "
-                                                           "must be split in "
-                                                           "two 44 characters "
-                                                           "groups")
-                self.address1 = address[0]
-                self.address2 = address[1]
-            else:
-                assert len(address) < 88, ("Street address can have up to 88 "
-                                           "characters")
-                last_space_ix = address.rfind(" ", 0, 44)
-                self.address1 = address[:last_space_ix].strip()
-                self.address2 = address[last_space_ix:].strip()
-                assert len(self.address2) < 44, ("Must be able to split "
-                                                 "address in two 44 characters "
-                                                 "groups")
+            self.address1, self.address2 = split_address(address)
         else:
             self.address1 = self.address2 = None
 
         self.city = city
-        if city:
-            assert len(city) < 40, ("City name must have up to 40 characters")
-
         self.province = province
 
-        assert not args, "Too many positional arguments for {} object".format(
-            self.__class__.__name__)
+        if args:
+            raise TypeError("Too many positional arguments for {} object"
+                            .format(self.__class__.__name__))
         super(AddressBase, self).__init__(**kwargs)
 
 class Origin(AddressBase):
+    __slots__ = ('country_code',)
+
     def __init__(self, country_code="CA", *args, **kwargs):
         self.country_code = country_code
         super(Origin, self).__init__(*args, **kwargs)
 
 class Destination(AddressBase):
+    __slots__ = ('country_code', 'extra')
+
     def __init__(self, country_code, extra=None, *args, **kwargs):
         self.country_code = country_code
         self.extra = extra
@@ -0,0 +1,8 @@
+"""
+Python 2 fallbacks for the standard library functions the package uses
+"""
+try:
+    from time import monotonic
+except ImportError:
+    # python 2
+    from time import time as monotonic
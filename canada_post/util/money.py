@@ -7,6 +7,8 @@ def get_decimal(source):
     return Decimal(source or ZERO)
 
 class Adjustment(InfoObject):
+    __slots__ = ('code', 'name', 'cost', 'percent')
+
     def __init__(self, xml_source=None, **kwargs):
         if xml_source is not None:
             self.code = xml_source.find("adjustment-code").text
@@ -23,6 +25,9 @@ class Adjustment(InfoObject):
                                           cost=self.cost, percent=self.percent)
 
 class Price(InfoObject):
+    __slots__ = ('due', 'base', 'gst', 'gst_pc', 'pst', 'pst_pc', 'hst',
+                 'hst_pc', 'tax_total', 'adjustments', 'adjustment_total')
+
     def __init__(self, due=ZERO, base=ZERO, gst=ZERO, gst_pc=ZERO, pst=ZERO,
                  pst_pc=ZERO, hst=ZERO, hst_pc=ZERO, adjustments=[],
                  **kwargs):
@@ -8,6 +8,8 @@ class Parcel(InfoObject):
     Represents a Canada Post parcel. Holds things as dimensions, weight,
     tracking number...
     """
+    __slots__ = ('weight', 'length', 'width', 'height', 'unpackaged')
+
     def __init__(self, weight=0, length=0, width=0, height=0, unpackaged=False,
                  **kwargs):
         """
@@ -0,0 +1,57 @@
+"""
+sqlite connections for the stores that can be shared between threads and
+processes (canada_post.cache.SQLiteBackend, canada_post.store.ShipmentStore)
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+MEMORY = ":memory:"
+
+class _Unlocked(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class LocalConnection(object):
+    """
+    Calling it gives a context manager holding a connection to the database
+    at `path`, inside a transaction that's committed when it exits (or
+    rolled back if it raises).
+
+    Database files get one connection per thread, opened on first use since
+    sqlite connections can't be shared between threads, and are switched to
+    WAL mode so that readers don't wait for the writer. An in-memory
+    database only exists for its connection, so all the threads share one,
+    used by a single thread at a time
+    """
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._shared = None
+        # only the shared in-memory connection needs one
+        self._lock = threading.Lock() if path == MEMORY else _Unlocked()
+
+    def _connect(self):
+        if self.path == MEMORY:
+            if self._shared is None:
+                self._shared = sqlite3.connect(self.path,
+                                               timeout=self.timeout,
+                                               check_same_thread=False)
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def __call__(self):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                yield conn
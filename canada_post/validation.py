@@ -0,0 +1,235 @@
+"""
+Local validation of shipments, so that bad data fails fast instead of
+costing a round-trip to Canada Post and an HTTP 400.
+
+validate_shipment checks a (parcel, origin, destination, service) combination
+and returns the list of FieldError found, empty if it's valid:
+  * required fields, and the postal code format of each country
+  * field lengths, e.g. address lines of up to 44 characters
+  * the destination phone, required by some services
+  * the weight and dimension limits of each service
+  * the service is offered to the destination country
+validate_shipments does the same for a whole batch in one pass.
+CreateShipment raises a ValidationError (a ValueError) with the errors before
+sending anything.
+
+What each service requires and its limits come from canada_post.catalogue
+"""
+import re
+from canada_post import catalogue
+
+# maximum lengths of the fields of a shipment request
+NAME_LENGTH = 44
+COMPANY_LENGTH = 44
+ADDRESS_LINE_LENGTH = 44
+CITY_LENGTH = 40
+PHONE_LENGTH = 25
+
+POSTAL_CODE_FORMATS = {
+    'CA': re.compile(r"^[ABCEGHJ-NPRSTVXY]\d[ABCEGHJ-NPRSTV-Z]\d"
+                     r"[ABCEGHJ-NPRSTV-Z]\d$"),
+    'US': re.compile(r"^\d{5}(-?\d{4})?$"),
+}
+
+class FieldError(object):
+    """
+    A problem with a field of a shipment.
+      * field is its path, e.g. "destination.postal_code"
+      * code is the kind of problem: "required", "format", "length",
+        "limit" or "service"
+      * message describes it
+    """
+    __slots__ = ('field', 'code', 'message')
+
+    def __init__(self, field, code, message):
+        self.field = field
+        self.code = code
+        self.message = message
+
+    def __eq__(self, other):
+        return isinstance(other, FieldError) and \
+            (self.field, self.code) == (other.field, other.code)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.field, self.code))
+
+    def __str__(self):
+        return "{field}: {message}".format(field=self.field,
+                                            message=self.message)
+
+    def __repr__(self):
+        return "FieldError({field!r}, {code!r}, {message!r})".format(
+            field=self.field, code=self.code, message=self.message)
+
+class ValidationError(ValueError):
+    """
+    Invalid shipment data. `errors` is the list of FieldError found
+    """
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super(ValidationError, self).__init__(
+            "; ".join(str(error) for error in self.errors))
+
+def check(errors):
+    """
+    Raise a ValidationError if there's any error
+    """
+    if errors:
+        raise ValidationError(errors)
+
+def _length(errors, field, value, maximum):
+    if value and len(value) > maximum:
+        errors.append(FieldError(field, "length",
+                                 "Can have up to {0} characters".format(
+                                     maximum)))
+
+def validate_postal_code(errors, field, country_code, postal_code):
+    """
+    Check the postal code format of the country, appending to `errors`
+    """
+    country = (country_code or "").upper()
+    if not postal_code:
+        if country in POSTAL_CODE_FORMATS:
+            errors.append(FieldError(field, "required",
+                                     "Addresses within {0} require a postal "
+                                     "code".format(country)))
+        return
+    pattern = POSTAL_CODE_FORMATS.get(country)
+    if pattern is not None and not pattern.match(
+            postal_code.replace(" ", "").upper()):
+        errors.append(FieldError(field, "format",
+                                 "{0!r} isn't a valid {1} postal code".format(
+                                     postal_code, country)))
+
+def validate_address(errors, prefix, address):
+    """
+    Check the fields an address has in a shipment request, appending to
+    `errors`
+    """
+    if not any((address.address1, address.address2)):
+        errors.append(FieldError(prefix + ".address", "required",
+                                 "Must have an address"))
+    _length(errors, prefix + ".address1", address.address1,
+            ADDRESS_LINE_LENGTH)
+    _length(errors, prefix + ".address2", address.address2,
+            ADDRESS_LINE_LENGTH)
+    _length(errors, prefix + ".name", address.name, NAME_LENGTH)
+    _length(errors, prefix + ".company", address.company, COMPANY_LENGTH)
+    _length(errors, prefix + ".phone", address.phone, PHONE_LENGTH)
+    _length(errors, prefix + ".city", address.city, CITY_LENGTH)
+    validate_postal_code(errors, prefix + ".postal_code",
+                         address.country_code, address.postal_code)
+
+def validate_parcel(errors, parcel, service_code):
+    """
+    Check the weight and dimensions of the parcel against the limits of the
+    service, appending to `errors`
+    """
+    try:
+        weight = float(parcel.weight or 0)
+        dimensions = sorted((float(parcel.length or 0),
+                             float(parcel.width or 0),
+                             float(parcel.height or 0)), reverse=True)
+    except (TypeError, ValueError):
+        errors.append(FieldError("parcel", "format",
+                                 "Weight and dimensions must be numbers"))
+        return
+    if weight <= 0:
+        errors.append(FieldError("parcel.weight", "required",
+                                 "Must have a weight"))
+    limits = catalogue.limits(service_code)
+    if limits is None:
+        return
+    if weight > limits.max_weight:
+        errors.append(FieldError("parcel.weight", "limit",
+                                 "{0} takes up to {1}kg".format(
+                                     service_code, limits.max_weight)))
+    length, width, height = dimensions
+    if limits.max_length is not None and length > limits.max_length:
+        errors.append(FieldError("parcel.length", "limit",
+                                 "{0} takes up to {1}cm long".format(
+                                     service_code, limits.max_length)))
+    if limits.max_girth is not None and \
+            length + 2 * (width + height) > limits.max_girth:
+        errors.append(FieldError("parcel", "limit",
+                                 "{0} takes up to {1}cm of length plus "
+                                 "girth".format(service_code,
+                                                limits.max_girth)))
+    if limits.max_sum is not None and \
+            length + width + height > limits.max_sum:
+        errors.append(FieldError("parcel", "limit",
+                                 "{0} takes up to {1}cm of length plus "
+                                 "width plus height".format(
+                                     service_code, limits.max_sum)))
+
+def validate_shipment(parcel, origin, destination, service,
+                      contract_number=None):
+    """
+    Return the list of FieldError of a shipment, empty if it's valid. The
+    contract number is only checked if it's given (even if empty)
+    """
+    errors = []
+    code = service.code
+
+    # sender
+    if not origin.company:
+        errors.append(FieldError("origin.company", "required",
+                                 "The sender needs a company name for "
+                                 "Contract Shipping"))
+    if not origin.phone:
+        errors.append(FieldError("origin.phone", "required",
+                                 "The sender needs a phone for Contract "
+                                 "Shipping"))
+    if not origin.city:
+        errors.append(FieldError("origin.city", "required",
+                                 "Need the sender's city"))
+    if not origin.province:
+        errors.append(FieldError("origin.province", "required",
+                                 "Need the sender's province"))
+    validate_address(errors, "origin", origin)
+
+    # destination
+    # TODO: if the Deliver to Post Office option is used, the name
+    #  element must be present for the destination.
+    country = (destination.country_code or "").upper()
+    if not destination.phone and catalogue.phone_required(code):
+        errors.append(FieldError("destination.phone", "required",
+                                 "Service {0} requires destination to have "
+                                 "a phone number".format(code)))
+    if not destination.province and country in ("CA", "US"):
+        errors.append(FieldError("destination.province", "required",
+                                 "The province or state is required for "
+                                 "{0} destinations".format(country)))
+    validate_address(errors, "destination", destination)
+
+    family = code.split(".", 1)[0]
+    if family in catalogue.FAMILY_COUNTRIES:
+        expected = catalogue.FAMILY_COUNTRIES[family]
+        if (expected is None and country in ("CA", "US")) or \
+                (expected is not None and country != expected):
+            errors.append(FieldError("service", "service",
+                                     "{0} doesn't ship to {1}".format(
+                                         code, country)))
+    validate_parcel(errors, parcel, code)
+
+    if contract_number is not None and not contract_number:
+        errors.append(FieldError("contract_number", "required",
+                                 "Must have a contract number for contract "
+                                 "shipping"))
+    return errors
+
+def validate_shipments(jobs, contract_number=None):
+    """
+    Validate many (parcel, origin, destination, service, ...) jobs, extra
+    items are ignored. Returns a list with the list of FieldError of each
+    job, in order
+    """
+    results = []
+    for job in jobs:
+        parcel, origin, destination, service = tuple(job)[:4]
+        results.append(validate_shipment(parcel, origin, destination, service,
+                                         contract_number))
+    return results
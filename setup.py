@@ -15,5 +15,15 @@ setup(
     install_requires = [
         'requests>=0.8',
         "lxml",
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        # canada_post.aio.AsyncCanadaPostAPI
+        'async': ["aiohttp>=3.3"],
+        # canada_post.ratetable
+        'ratetable': ["numpy"],
+        # canada_post.instrumentation adapters
+        'prometheus': ["prometheus_client"],
+        'opentelemetry': ["opentelemetry-api"],
+    },
 )
@@ -0,0 +1,25 @@
+import pytest
+
+from canada_post.service import Service
+from canada_post.util.address import Origin, Destination
+from canada_post.util.parcel import Parcel
+
+@pytest.fixture
+def parcel():
+    return Parcel(weight=2, length=30, width=20, height=10)
+
+@pytest.fixture
+def origin():
+    return Origin(postal_code="H2B1A0", name="Shipping", company="ACME",
+                  phone="514 555 0101", address="1234 Main Street",
+                  city="Montreal", province="QC")
+
+@pytest.fixture
+def destination():
+    return Destination("CA", postal_code="K1A0B1", name="Jo",
+                       phone="613 555 0100", address="1 Wellington St",
+                       city="Ottawa", province="ON")
+
+@pytest.fixture
+def service():
+    return Service(data={'code': "DOM.EP"})
@@ -0,0 +1,46 @@
+"""
+The rate limiters of the accounts follow their configuration
+"""
+from canada_post import ratelimit
+from canada_post.accounts import AccountRegistry
+
+def limiter(client):
+    return client.get_rates.rate_limiter
+
+def test_limiter_reconfigured_when_rate_changes():
+    accounts = AccountRegistry(rate_limit=10)
+    first = limiter(accounts.add("acme", "1234567", "user", "pass"))
+    # another client of the same account, with another rate
+    second = limiter(accounts.add("acme-eu", "1234567", "user", "pass",
+                                  rate_limit=(2, 3)))
+    # one budget for the account, following the latest configuration
+    assert second is first
+    assert (first.rate, first.max_rate, first.burst) == (2, 2, 3)
+    accounts.remove("acme")
+    accounts.remove("acme-eu")
+
+def test_reconfiguring_keeps_a_throttled_rate_down():
+    registry = ratelimit.RateLimiterRegistry()
+    auth = AccountRegistry().add("acme", "1234567", "user", "pass").auth
+    limiter = registry.get("GetRates", auth, 10, backoff=0)
+    limiter.penalize()
+    assert registry.get("GetRates", auth, 20, backoff=0) is limiter
+    assert (limiter.rate, limiter.max_rate) == (5, 20)
+    assert registry.get("GetRates", auth, 4, backoff=0).rate == 4
+
+def test_same_configuration_shares_the_limiter():
+    registry = ratelimit.RateLimiterRegistry()
+    accounts = AccountRegistry()
+    auth = accounts.add("acme", "1234567", "user", "pass").auth
+    first = registry.get("GetRates", auth, 10, 2)
+    assert registry.get("GetRates", auth, 10, 2) is first
+    assert registry.get("GetRates", auth, 10, 4) is first
+    assert first.burst == 4
+
+def test_remove_forgets_the_limiters():
+    accounts = AccountRegistry(rate_limit=10)
+    client = accounts.add("acme", "1234567", "user", "pass")
+    old = limiter(client)
+    accounts.remove("acme")
+    assert limiter(accounts.add("acme", "1234567", "user", "pass")) \
+        is not old
@@ -0,0 +1,165 @@
+"""
+AsyncCanadaPostAPI against the Simulator
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from canada_post.aio import AsyncCanadaPostAPI
+from canada_post.cache import Cache, MemoryBackend, SQLiteBackend
+from canada_post.retry import RetryPolicy, OutcomeUnknown
+from canada_post.simulator import Simulator
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+def client(simulator, **kwargs):
+    return simulator.install(AsyncCanadaPostAPI("1234567", "user", "pass",
+                                                "42708517", **kwargs))
+
+def test_void_retried_after_a_lost_response(parcel, origin, destination,
+                                            service):
+    async def main(simulator):
+        async with client(simulator,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            shipment = await cpa.create_shipment(parcel, origin, destination,
+                                                 service, "group")
+            # voided, but answered with a 500: the retry finds nothing
+            simulator.lost_rate = 1
+            return await cpa.void_shipment(shipment), cpa
+
+    with Simulator(seed=0) as simulator:
+        voided, cpa = run(main(simulator))
+        assert voided
+        assert [shipment['status'] for shipment in
+                simulator.shipments.values()] == ["cancelled"]
+        assert cpa._void_shipment.retry_stats.retries == 1
+
+def test_void_of_an_unknown_shipment_still_fails(parcel, origin, destination,
+                                                  service):
+    async def main(simulator):
+        async with client(simulator,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            shipment = await cpa.create_shipment(parcel, origin, destination,
+                                                 service, "group")
+            await cpa.void_shipment(shipment)
+            await cpa.void_shipment(shipment)
+
+    with Simulator(seed=0) as simulator:
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            run(main(simulator))
+        assert error.value.status == 404
+
+def test_retried_void_of_an_unknown_shipment_fails(parcel, origin,
+                                                   destination, service):
+    async def main(simulator):
+        async with client(simulator,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            shipment = await cpa.create_shipment(parcel, origin, destination,
+                                                 service, "group")
+            del simulator.shipments[shipment.id]
+            # the 404 of the retry isn't from a previous attempt going through
+            method, pattern, handler = [route for route in simulator.routes
+                                        if route[0] == 'DELETE'][0]
+            failed = []
+
+            def fail_once(request, body, **kwargs):
+                if not failed:
+                    failed.append(True)
+                    return request._respond(500)
+                return handler(request, body, **kwargs)
+            simulator.routes.insert(0, (method, pattern, fail_once))
+            await cpa.void_shipment(shipment)
+
+    with Simulator(seed=0) as simulator:
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            run(main(simulator))
+        assert error.value.status == 404
+
+def test_create_recovers_a_lost_response(parcel, origin, destination,
+                                         service):
+    async def main(simulator):
+        async with client(simulator,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            shipment = await cpa.create_shipment(parcel, origin, destination,
+                                                 service, "group", "ref1")
+            return shipment, cpa._create_shipment.retry_stats
+
+    # every POST is processed, but answered with a 500
+    with Simulator(seed=0, lost_rate=1) as simulator:
+        shipment, stats = run(main(simulator))
+        assert list(simulator.shipments) == [shipment.id]
+        assert stats.recovered == 1
+
+def test_create_not_resent_when_the_lookup_fails(parcel, origin, destination,
+                                                 service):
+    async def main(simulator):
+        async with client(simulator, timeout=0.1,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            await cpa.create_shipment(parcel, origin, destination, service,
+                                      "group", "ref1")
+
+    # every request, including the lookups, outlasts the timeout
+    with Simulator(seed=0, latency=0.3) as simulator:
+        with pytest.raises(OutcomeUnknown):
+            run(main(simulator))
+        time.sleep(0.5)
+        assert len(simulator.shipments) == 1
+
+def test_create_without_reference_isnt_retried(parcel, origin, destination,
+                                               service):
+    async def main(simulator):
+        async with client(simulator,
+                          retry_policy=RetryPolicy(backoff=0)) as cpa:
+            await cpa.create_shipment(parcel, origin, destination, service,
+                                      "group")
+
+    with Simulator(seed=0, lost_rate=1) as simulator:
+        with pytest.raises(aiohttp.ClientResponseError):
+            run(main(simulator))
+        assert len(simulator.shipments) == 1
+        assert simulator.stats['requests'] == 1
+
+class ThreadRecordingBackend(MemoryBackend):
+    def __init__(self, blocking):
+        super(ThreadRecordingBackend, self).__init__()
+        self.blocking = blocking
+        self.threads = set()
+
+    def get(self, key, now):
+        self.threads.add(threading.current_thread())
+        return super(ThreadRecordingBackend, self).get(key, now)
+
+    def set(self, key, value, expires):
+        self.threads.add(threading.current_thread())
+        super(ThreadRecordingBackend, self).set(key, value, expires)
+
+@pytest.mark.parametrize("blocking", [True, False])
+def test_blocking_cache_is_used_from_the_executor(blocking, parcel, origin,
+                                                  destination):
+    backend = ThreadRecordingBackend(blocking)
+    cache = Cache(backend)
+
+    async def main(simulator):
+        async with client(simulator, rate_cache=cache) as cpa:
+            first = await cpa.get_rates(parcel, origin, destination)
+            second = await cpa.get_rates(parcel, origin, destination)
+            return first, second
+
+    with Simulator(seed=0) as simulator:
+        first, second = run(main(simulator))
+        assert [s.code for s in first] == [s.code for s in second]
+        assert simulator.stats['requests'] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    main_thread = threading.current_thread()
+    assert (main_thread in backend.threads) is not blocking
+    assert len(backend.threads) == 1
+
+def test_blocking_flags(tmpdir):
+    sqlite = Cache(SQLiteBackend(str(tmpdir.join("rates.db"))))
+    assert sqlite.blocking and sqlite.namespace("acme").blocking
+    assert not Cache().blocking and not Cache().namespace("acme").blocking
@@ -0,0 +1,94 @@
+"""
+Artifact downloads: resumed with Range requests, and cached on disk
+"""
+import os
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.service.artifacts import ArtifactCache
+from canada_post.simulator import Simulator
+
+PARTIAL = 100
+
+@pytest.fixture
+def label(parcel, origin, destination, service, tmpdir):
+    """
+    download(simulator, **options) downloads the label of a new shipment to
+    a file of tmpdir and returns (the CanadaPostAPI, the shipment, the path)
+    """
+    def download(simulator, partial=None, **options):
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              "42708517", **options))
+        shipment = cpa.create_shipment(parcel, origin, destination, service,
+                                       "group")
+        path = str(tmpdir.join(cpa.get_artifact.filename(shipment)))
+        if partial is not None:
+            with open(path + ".part", 'wb') as f:
+                f.write(partial)
+        size = cpa.get_artifact(shipment, path)
+        cpa.close()
+        with open(path, 'rb') as f:
+            content = f.read()
+        assert size == len(content)
+        assert not os.path.exists(path + ".part")
+        return content
+    return download
+
+def test_download(label):
+    with Simulator(seed=0, artifact_size=1000) as simulator:
+        assert label(simulator) == simulator.label
+        assert 206 not in simulator.stats
+
+def test_resume_with_range(label):
+    with Simulator(seed=0, artifact_size=1000) as simulator:
+        assert label(simulator, partial=simulator.label[:PARTIAL]) == \
+            simulator.label
+        assert simulator.stats[206] == 1
+
+def test_resume_when_the_range_is_ignored(label):
+    # the whole artifact comes back, the part already downloaded is skipped
+    with Simulator(seed=0, artifact_size=1000, ranges=False) as simulator:
+        assert label(simulator, partial=simulator.label[:PARTIAL]) == \
+            simulator.label
+        assert 206 not in simulator.stats
+
+def test_partial_file_already_complete(label):
+    with Simulator(seed=0, artifact_size=1000) as simulator:
+        assert label(simulator, partial=simulator.label) == simulator.label
+        assert simulator.stats[416] == 1
+
+def test_cache(label, tmpdir):
+    cache = ArtifactCache(str(tmpdir.join("cache")))
+    with Simulator(seed=0, artifact_size=1000) as simulator:
+        assert label(simulator, artifact_cache=cache) == simulator.label
+        artifacts = simulator.stats[200]
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              "42708517",
+                                              artifact_cache=cache))
+        shipment = next(iter(simulator.shipments))
+        link = "{0}/ers/artifact/1234567/{1}/0".format(
+            simulator.base_url, shipment)
+        assert link in cache
+        out = str(tmpdir.join("again.pdf"))
+        cpa.get_artifact.download(link, out)
+        cpa.close()
+        # served from the cache
+        assert simulator.stats[200] == artifacts
+    with open(out, 'rb') as f:
+        assert f.read() == simulator.label
+    assert os.listdir(cache._path('partial', "")) == []
+
+def test_cache_resumes_its_own_partial_file(tmpdir):
+    cache = ArtifactCache(str(tmpdir))
+    href = "https://example.com/artifact/1"
+    partial = cache.partial(href)
+    # each process has its own partial files
+    assert partial.endswith(".{0}".format(os.getpid()))
+    with open(partial, 'wb') as f:
+        f.write(b"label")
+    path = cache.commit(href)
+    assert cache.get(href) == path
+    assert not os.path.exists(partial)
+    assert [name for name in os.listdir(cache._path('refs', ""))
+            if name.endswith(".tmp")] == []
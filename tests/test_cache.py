@@ -0,0 +1,111 @@
+"""
+Caches and their backends
+"""
+import threading
+import time
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.cache import Cache, MemoryBackend, SQLiteBackend
+from canada_post.simulator import Simulator
+
+@pytest.fixture(params=["memory", "sqlite", "sqlite-file"])
+def backend(request, tmpdir):
+    if request.param == "memory":
+        return MemoryBackend(maxsize=3)
+    path = ":memory:" if request.param == "sqlite" else \
+        str(tmpdir.join("cache.db"))
+    return SQLiteBackend(path, maxsize=3)
+
+def test_ttl(backend):
+    backend.set("key", "value", 10)
+    assert backend.get("key", 9) == "value"
+    assert backend.get("key", 10) is None
+    # expired entries are dropped
+    assert len(backend) == 0
+
+def test_least_recently_used_evicted(backend):
+    expires = time.time() + 60
+    for key in "abc":
+        backend.set(key, key.upper(), expires)
+    # "a" is now more recently used than "b"
+    assert backend.get("a", time.time()) == "A"
+    backend.set("d", "D", expires)
+    assert len(backend) == 3
+    assert backend.get("b", time.time()) is None
+    assert [backend.get(key, time.time()) for key in "acd"] == \
+        ["A", "C", "D"]
+
+def test_cache_counts_and_expires(backend):
+    cache = Cache(backend, ttl=-1)
+    cache.set("expired", 1)
+    assert cache.get("expired") is None
+    cache.set("fresh", 2, ttl=60)
+    assert cache.get("fresh") == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_namespaces_are_separate(backend):
+    cache = Cache(backend)
+    acme, other = cache.namespace("acme"), cache.namespace("other")
+    acme.set("key", "acme")
+    other.set("key", "other")
+    assert (acme.get("key"), other.get("key")) == ("acme", "other")
+    acme.clear()
+    assert acme.get("key") is None and other.get("key") == "other"
+    assert (len(acme.backend), len(other.backend)) == (0, 1)
+
+@pytest.mark.parametrize("path", [":memory:", "file"])
+def test_sqlite_shared_by_threads(path, tmpdir):
+    if path == "file":
+        path = str(tmpdir.join("cache.db"))
+    backend = SQLiteBackend(path, maxsize=1000)
+    errors = []
+
+    def work(thread):
+        try:
+            for index in range(50):
+                key = "{0}-{1}".format(thread, index)
+                backend.set(key, index, 100)
+                assert backend.get(key, 0) == index
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(thread,))
+               for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(backend) == 400
+
+def test_get_rates_many_with_memory_sqlite(parcel, origin, destination):
+    cache = Cache(SQLiteBackend(":memory:"))
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              rate_cache=cache))
+        scenarios = [(parcel, origin, destination)] * 4
+        results = list(cpa.get_rates_many(scenarios, workers=4))
+        results += list(cpa.get_rates_many(scenarios, workers=4))
+        cpa.close()
+    assert all(result.ok for result in results), \
+        [result.error for result in results]
+    assert cache.hits >= 4
+
+class BrokenBackend(MemoryBackend):
+    def get(self, key, now):
+        raise IOError("disk full")
+
+    def set(self, key, value, expires):
+        raise IOError("disk full")
+
+def test_backend_errors_are_misses(parcel, origin, destination):
+    cache = Cache(BrokenBackend())
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              rate_cache=cache))
+        assert cpa.get_rates(parcel, origin, destination)
+        assert cpa.get_rates(parcel, origin, destination)
+        cpa.close()
+        assert simulator.stats['requests'] == 2
+    assert (cache.hits, cache.misses, cache.errors) == (0, 2, 4)
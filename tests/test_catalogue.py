@@ -0,0 +1,84 @@
+"""
+The service code catalogue, and quoting only its candidates
+"""
+from canada_post import catalogue
+from canada_post.api import CanadaPostAPI
+from canada_post.service import Service
+from canada_post.simulator import Simulator
+from canada_post.util.address import Destination
+from canada_post.util.parcel import Parcel
+
+def us(phone="212 555 0100"):
+    return Destination("US", postal_code="10001", phone=phone)
+
+def test_lookups():
+    assert catalogue.get("USA.XP").phone_required
+    assert catalogue.get("DOM.BAD") is None
+    assert "INT.SP.AIR" in catalogue.codes()
+    assert catalogue.limits("USA.TP").max_weight == 2
+    # unknown codes get the limits of their family
+    assert catalogue.limits("DOM.NEW") is catalogue.FAMILY_LIMITS['DOM']
+    assert catalogue.limits("BAD.NEW") is None
+    assert catalogue.get("INT.XP").ships_to("fr")
+    assert not catalogue.get("INT.XP").ships_to("US")
+
+def test_select():
+    domestic = catalogue.select(destination="ca")
+    assert domestic == set(["DOM.RP", "DOM.EP", "DOM.XP", "DOM.XP.CERT",
+                            "DOM.PC", "DOM.LIB"])
+    assert catalogue.select(destination="CA", min_speed="express") == \
+        set(["DOM.XP", "DOM.XP.CERT", "DOM.PC"])
+    assert catalogue.select(destination="CA", speeds=["economy"]) == \
+        set(["DOM.RP", "DOM.LIB"])
+    assert catalogue.select(destination="FR", tracked=False) == \
+        set(["INT.SP.AIR", "INT.SP.SURF"])
+    assert catalogue.select(destination="US", phone=False) == \
+        set(["USA.PW.ENV", "USA.TP", "USA.TP.LVM", "USA.SP.AIR"])
+    assert catalogue.select(destination="CA", options=["SO", "DNS"]) == \
+        domestic - set(["DOM.LIB"])
+    assert catalogue.select(destination="US", options=["SO"]) == \
+        catalogue.select(destination="US") - set(["USA.SP.AIR"])
+    assert catalogue.select(codes=["DOM.EP", "USA.EP", "BAD.CODE"],
+                            destination="CA") == set(["DOM.EP"])
+    assert isinstance(catalogue.select(), frozenset)
+    assert catalogue.select() == catalogue.codes()
+
+def test_candidates():
+    small = Parcel(weight=1, length=20, width=10, height=5)
+    assert catalogue.candidates(small, us()) == \
+        catalogue.select(destination="US") - set(["USA.PW.ENV"])
+    # without a phone
+    assert catalogue.candidates(small, us(phone=None)) == \
+        set(["USA.TP", "USA.TP.LVM", "USA.SP.AIR"])
+    # too heavy for the packets
+    assert catalogue.candidates(Parcel(weight=5), us(phone=None)) == set()
+    # the packets' length + width + height is 90cm at most, however it's laid
+    long = Parcel(weight=1, length=10, width=70, height=15)
+    assert "USA.TP" not in catalogue.candidates(long, us())
+    assert "USA.EP" in catalogue.candidates(long, us())
+    # the criteria apply too
+    assert catalogue.candidates(small, us(), min_speed="priority") == \
+        set(["USA.PW.PAK", "USA.PW.PARCEL"])
+
+def test_prune():
+    services = [Service(data={'code': code})
+                for code in ("USA.XP", "USA.TP", "BAD.CODE", "USA.EP")]
+    assert [service.code for service in
+            catalogue.prune(services, min_speed="expedited")] == \
+        ["USA.XP", "USA.TP", "USA.EP"]
+    assert [service.code for service in catalogue.prune(
+        services, Parcel(weight=1), us(phone=None))] == ["USA.TP"]
+
+def test_rates(parcel, origin, destination):
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass"))
+        services = catalogue.rates(cpa.get_rates, parcel, origin,
+                                   destination, min_speed="express")
+        assert set(service.code for service in services) == \
+            set(["DOM.XP", "DOM.PC"])
+        assert simulator.stats['requests'] == 1
+        # nothing to ask for
+        assert catalogue.rates(cpa.get_rates, Parcel(weight=40), origin,
+                               destination) == []
+        assert simulator.stats['requests'] == 1
+        cpa.close()
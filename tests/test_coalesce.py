@@ -0,0 +1,125 @@
+"""
+SingleFlight, and the coalescing of concurrent get_rates calls
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.service.rating import SingleFlight
+from canada_post.simulator import Simulator
+
+CALLERS = 5
+
+def callers(target):
+    """
+    Run target(index) in CALLERS threads, returning what they returned or
+    raised
+    """
+    results = [None] * CALLERS
+
+    def run(index):
+        try:
+            results[index] = target(index)
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_callers_share_the_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    made = []
+
+    def func():
+        made.append(True)
+        release.wait()
+        return object()
+    threads, results = callers(lambda index: flight.do("key", func))
+    wait_for(lambda: flight.coalesced == CALLERS - 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(made) == 1
+    assert (flight.calls, flight.coalesced) == (1, CALLERS - 1)
+    assert all(result is results[0] for result in results)
+    # the next call is a new one
+    assert flight.do("key", object) is not results[0]
+    assert flight.calls == 2
+
+def test_callers_share_the_error():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def func():
+        release.wait()
+        raise ValueError("failed")
+    threads, results = callers(lambda index: flight.do("key", func))
+    wait_for(lambda: flight.coalesced == CALLERS - 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert isinstance(results[0], ValueError)
+    assert all(result is results[0] for result in results)
+    assert flight.calls == 1
+
+def test_keys_dont_coalesce():
+    flight = SingleFlight()
+    threads, results = callers(
+        lambda index: flight.do(index, lambda: index))
+    for thread in threads:
+        thread.join()
+    assert results == list(range(CALLERS))
+    assert (flight.calls, flight.coalesced) == (CALLERS, 0)
+
+def test_get_rates(parcel, origin, destination):
+    with Simulator(seed=0, latency=0.3) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              coalesce=True))
+        threads, results = callers(
+            lambda index: cpa.get_rates(parcel, origin, destination))
+        for thread in threads:
+            thread.join()
+        flight = cpa.get_rates.singleflight
+        assert flight.calls + flight.coalesced == CALLERS
+        assert simulator.stats['requests'] == flight.calls < CALLERS
+        codes = [service.code for service in results[0]]
+        assert all([service.code for service in result] == codes
+                   for result in results)
+        cpa.close()
+
+def test_async_cancelled_caller_doesnt_cancel_the_others(parcel, origin,
+                                                         destination):
+    pytest.importorskip("aiohttp")
+    from canada_post.aio import AsyncCanadaPostAPI
+
+    async def main(simulator):
+        async with simulator.install(AsyncCanadaPostAPI(
+                "1234567", "user", "pass", coalesce=True)) as cpa:
+            tasks = [asyncio.ensure_future(
+                cpa.get_rates(parcel, origin, destination))
+                for _ in range(3)]
+            await asyncio.sleep(0.1)
+            # the caller that started the request
+            tasks[0].cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            return results, cpa._get_rates.singleflight
+
+    with Simulator(seed=0, latency=0.3) as simulator:
+        results, flight = asyncio.new_event_loop().run_until_complete(
+            main(simulator))
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1] and results[1] == results[2]
+        assert (flight.calls, flight.coalesced) == (1, 2)
+        assert simulator.stats['requests'] == 1
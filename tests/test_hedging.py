@@ -0,0 +1,132 @@
+"""
+HedgePolicy and its latency tracking
+"""
+import threading
+import time
+
+import pytest
+
+from canada_post.hedging import HedgePolicy, LatencyTracker
+from canada_post.ratelimit import TokenBucket
+
+class Sender(object):
+    """
+    send() for HedgePolicy.run: the calls sleep for the given delays in turn
+    and return their number, or raise it if it's an exception
+    """
+    def __init__(self, *delays, **kwargs):
+        self.delays = list(delays)
+        self.errors = kwargs.get('errors', ())
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            call = self.calls
+            self.calls += 1
+        time.sleep(self.delays[call])
+        if call in self.errors:
+            raise ValueError(call)
+        return call
+
+def policy(**kwargs):
+    kwargs.setdefault('initial_delay', 0.05)
+    kwargs.setdefault('budget', 1)
+    return HedgePolicy(**kwargs)
+
+def test_percentile():
+    latencies = LatencyTracker(window=100)
+    assert latencies.percentile(95) is None
+    for latency in range(200, 0, -1):
+        latencies.record(latency)
+    # only the last 100 are kept
+    assert len(latencies) == 100
+    assert latencies.percentile(0) == 1
+    assert latencies.percentile(95) == 95
+    assert latencies.percentile(100) == 100
+
+def test_delay():
+    hedge = HedgePolicy(initial_delay=1.0, min_samples=10, min_delay=0.01,
+                        max_delay=0.5, window=10)
+    hedge.latencies.record(0.2)
+    # not enough samples yet
+    assert hedge.delay() == 1.0
+    for _ in range(9):
+        hedge.latencies.record(0.2)
+    assert hedge.delay() == 0.2
+    for _ in range(10):
+        hedge.latencies.record(0.001)
+    assert hedge.delay() == 0.01
+    for _ in range(10):
+        hedge.latencies.record(2)
+    assert hedge.delay() == 0.5
+
+def test_fast_call_isnt_hedged():
+    hedge = policy()
+    send = Sender(0)
+    assert hedge.run(send) == 0
+    assert send.calls == 1
+    assert (hedge.requests, hedge.hedged, hedge.skipped) == (1, 0, 0)
+    assert len(hedge.latencies) == 1
+    hedge.close()
+
+def test_slow_call_is_hedged():
+    hedge = policy()
+    send = Sender(0.5, 0)
+    start = time.time()
+    assert hedge.run(send) == 1
+    # answered by the duplicate, without waiting for the first call
+    assert time.time() - start < 0.4
+    assert (hedge.hedged, hedge.wins) == (1, 1)
+    hedge.close()
+
+def test_first_answer_wins():
+    hedge = policy()
+    assert hedge.run(Sender(0.1, 0.5)) == 0
+    assert (hedge.hedged, hedge.wins) == (1, 0)
+    hedge.close()
+
+def test_duplicate_error_isnt_the_result():
+    hedge = policy()
+    assert hedge.run(Sender(0.2, 0, errors=[1])) == 0
+    assert hedge.wins == 0
+    hedge.close()
+
+def test_both_errors():
+    hedge = policy()
+    with pytest.raises(ValueError):
+        hedge.run(Sender(0.1, 0, errors=[0, 1]))
+    hedge.close()
+
+def test_budget():
+    hedge = policy(budget=0.5)
+    results = [hedge.run(Sender(0.1, 0)) for _ in range(4)]
+    # one duplicate for every two calls at most
+    assert (hedge.requests, hedge.hedged, hedge.skipped) == (4, 2, 2)
+    assert results == [1, 0, 1, 0]
+    hedge.close()
+
+def test_rate_limiter_without_tokens():
+    hedge = policy()
+    limiter = TokenBucket(rate=1)
+    limiter.acquire()
+    assert hedge.run(Sender(0.1, 0), limiter=limiter) == 0
+    assert (hedge.hedged, hedge.skipped) == (0, 1)
+    hedge.close()
+
+def test_busy_pool_isnt_hedged():
+    hedge = policy(workers=1)
+    assert hedge.run(Sender(0.1, 0)) == 0
+    assert (hedge.hedged, hedge.skipped) == (0, 1)
+    hedge.close()
+
+def test_loser_keeps_running():
+    hedge = policy()
+    send = Sender(0.3, 0)
+    assert hedge.run(send) == 1
+    assert hedge.running >= 1
+    time.sleep(0.4)
+    assert hedge.running == 0
+    # its latency is recorded when it's done
+    assert len(hedge.latencies) == 2
+    hedge.close()
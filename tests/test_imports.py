@@ -0,0 +1,23 @@
+"""
+Importing the light entry points mustn't load lxml, requests and the like,
+see benchmarks.imports
+"""
+import sys
+
+import pytest
+
+from benchmarks import imports
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+                                reason="needs python -X importtime")
+
+@pytest.mark.parametrize("name, statement", [
+    (name, statement) for name, statement, light in imports.ENTRY_POINTS
+    if light])
+def test_no_heavy_imports(name, statement):
+    _, _, heavy = imports.measure(statement)
+    assert heavy == []
+
+def test_services_load_their_dependencies():
+    _, _, heavy = imports.measure("import canada_post.service.rating")
+    assert "lxml" in heavy
@@ -0,0 +1,169 @@
+"""
+Call accounting, and the instruments of the services
+"""
+import time
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.cache import Cache, MemoryBackend
+from canada_post.instrumentation import (Call, Instrument,
+                                         OpenTelemetryInstrument,
+                                         PrometheusInstrument)
+from canada_post.retry import RetryPolicy
+from canada_post.simulator import Simulator
+
+class Recorder(Instrument):
+    """
+    Keeps the calls it's notified of
+    """
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def start(self, call):
+        self.started.append(call)
+
+    def finish(self, call):
+        self.finished.append(call)
+
+class Broken(Instrument):
+    def finish(self, call):
+        raise RuntimeError("broken")
+
+def client(simulator, *instruments, **kwargs):
+    return simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                           "42708517",
+                                           instruments=instruments, **kwargs))
+
+def test_phases():
+    recorder = Recorder()
+    call = Call("Service", [recorder])
+    assert recorder.started == [call]
+    time.sleep(0.05)
+    call.phase("build")
+    time.sleep(0.02)
+    call.skip()
+    call.phase("network")
+    time.sleep(0.05)
+    call.phase("build")
+    call.finish()
+    assert recorder.finished == [call]
+    assert call.phases["build"] >= 0.1
+    # the skipped time isn't in any phase
+    assert call.phases["network"] < 0.01
+    assert sum(call.phases.values()) <= call.duration - 0.02
+    assert call.duration == call.end - call.start
+
+def test_responses():
+    call = Call("Service", [])
+    call.request(b"<rates/>")
+    call.response(500)
+    call.response(200, "1234")
+    assert (call.request_size, call.response_size) == (8, 1234)
+    assert (call.status, call.attempts) == (200, 2)
+
+def test_error_and_broken_instrument():
+    recorder = Recorder()
+    with pytest.raises(ValueError):
+        with Call("Service", [Broken(), recorder]) as call:
+            raise ValueError("failed")
+    # the instruments after a broken one are still notified
+    assert recorder.finished == [call]
+    assert isinstance(call.error, ValueError)
+
+def test_get_rates(parcel, origin, destination):
+    recorder = Recorder()
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, recorder,
+                     rate_cache=Cache(MemoryBackend()))
+        cpa.get_rates(parcel, origin, destination)
+        cpa.get_rates(parcel, origin, destination)
+        cpa.close()
+    quoted, cached = recorder.finished
+    assert quoted.service == "GetRates"
+    assert set(quoted.phases) == set(["build", "serialize", "network",
+                                      "parse"])
+    assert (quoted.status, quoted.attempts) == (200, 1)
+    assert quoted.request_size > 0 and quoted.response_size > 0
+    assert not quoted.cached and quoted.error is None
+    assert cached.cached
+    assert (cached.status, cached.attempts) == (None, 0)
+    assert "network" not in cached.phases
+
+def test_retried_calls(parcel, origin, destination, service):
+    recorder = Recorder()
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, recorder,
+                     retry_policy=RetryPolicy(backoff=0))
+        shipment = cpa.create_shipment(parcel, origin, destination, service,
+                                       "group")
+        simulator.lost_rate = 1
+        cpa.void_shipment(shipment)
+        cpa.close()
+    create, void = recorder.finished[-2:]
+    assert (create.service, create.attempts, create.status) == \
+        ("CreateShipment", 1, 200)
+    assert (void.service, void.attempts, void.status) == \
+        ("VoidShipment", 2, 404)
+    assert void.error is None
+
+def test_failed_call(parcel, origin, destination):
+    recorder = Recorder()
+    with Simulator(seed=0, error_rate=1) as simulator:
+        cpa = client(simulator, recorder)
+        with pytest.raises(Exception):
+            cpa.get_rates(parcel, origin, destination)
+        cpa.close()
+    call, = recorder.finished
+    assert call.status == 500
+    assert call.error is not None
+
+def test_prometheus(parcel, origin, destination):
+    prometheus_client = pytest.importorskip("prometheus_client")
+    registry = prometheus_client.CollectorRegistry()
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, PrometheusInstrument(registry),
+                     rate_cache=Cache(MemoryBackend()))
+        cpa.get_rates(parcel, origin, destination)
+        cpa.get_rates(parcel, origin, destination)
+        cpa.close()
+
+    def value(name, **labels):
+        return registry.get_sample_value(name, labels)
+    assert value("canada_post_calls_total", service="GetRates",
+                 status="200") == 1
+    assert value("canada_post_calls_total", service="GetRates",
+                 status="cached") == 1
+    assert value("canada_post_call_seconds_count", service="GetRates") == 2
+    assert value("canada_post_phase_seconds_count", service="GetRates",
+                 phase="network") == 1
+    assert value("canada_post_payload_bytes_count", service="GetRates",
+                 direction="response") == 1
+
+def test_opentelemetry(parcel, origin, destination):
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import \
+        InMemorySpanExporter
+    from opentelemetry.trace import StatusCode
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    instrument = OpenTelemetryInstrument(provider.get_tracer("tests"))
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, instrument)
+        cpa.get_rates(parcel, origin, destination)
+        simulator.error_rate = 1
+        with pytest.raises(Exception):
+            cpa.get_rates(parcel, origin, destination)
+        cpa.close()
+    quoted, failed = exporter.get_finished_spans()
+    assert quoted.name == "canada_post.GetRates"
+    assert quoted.attributes["http.status_code"] == 200
+    assert quoted.attributes["canada_post.attempts"] == 1
+    assert quoted.attributes["canada_post.network_seconds"] > 0
+    assert failed.status.status_code == StatusCode.ERROR
+    assert failed.events[0].name == "exception"
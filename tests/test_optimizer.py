@@ -0,0 +1,58 @@
+"""
+The Optimizer looks every scenario up in the rate cache once
+"""
+from canada_post.api import CanadaPostAPI
+from canada_post.cache import Cache, MemoryBackend
+from canada_post.optimizer import Optimizer, combine
+from canada_post.simulator import Simulator
+from canada_post.util.address import Origin
+from canada_post.util.parcel import Parcel
+
+class CountingBackend(MemoryBackend):
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.lookups = 0
+
+    def get(self, key, now):
+        self.lookups += 1
+        return super(CountingBackend, self).get(key, now)
+
+def test_one_cache_lookup_per_scenario(parcel, origin, destination):
+    other = Origin(postal_code="M5V3L9")
+    splits = [[parcel], [Parcel(weight=1, length=20, width=20, height=10),
+                         Parcel(weight=1.5, length=20, width=20, height=10)]]
+    plans = combine([origin, other], splits)
+    with Simulator(seed=0) as simulator:
+        backend = CountingBackend()
+        cache = Cache(backend)
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              "42708517", rate_cache=cache))
+        optimizer = Optimizer(cpa.get_rates)
+        scenarios = len(set(key for plan_keys in
+                            optimizer.keys(destination, plans)
+                            for key in plan_keys))
+        assert scenarios == 6
+
+        first = optimizer(destination, plans)
+        assert (cache.hits, cache.misses) == (0, scenarios)
+        assert backend.lookups == scenarios
+        assert simulator.stats['requests'] == scenarios
+
+        second = optimizer(destination, plans)
+        assert (cache.hits, cache.misses) == (scenarios, scenarios)
+        assert backend.lookups == 2 * scenarios
+        assert simulator.stats['requests'] == scenarios
+        assert [plan.cost for plan in second.plans] == \
+            [plan.cost for plan in first.plans]
+        cpa.close()
+
+def test_empty_plans_are_skipped(parcel, origin, destination):
+    assert combine([origin], [[], [parcel]]) == [[(origin, parcel)]]
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                              "42708517"))
+        result = Optimizer(cpa.get_rates)(destination,
+                                          [[], [(origin, parcel)]])
+        cpa.close()
+    assert [plan.index for plan in result.plans] == [1]
+    assert not result.errors
@@ -0,0 +1,68 @@
+"""
+ShipmentPipeline must never create a job's shipment twice, whatever fails
+"""
+import collections
+import time
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.retry import RetryPolicy, OutcomeUnknown
+from canada_post.simulator import Simulator
+
+JOBS = 8
+
+def create(simulator, parcel, origin, destination, service, **kwargs):
+    cpa = simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                          "42708517", **kwargs))
+    jobs = [(parcel, origin, destination, service, "group",
+             "ref{0}".format(index)) for index in range(JOBS)]
+    result = cpa.create_shipments(jobs, workers=4)
+    cpa.close()
+    return result
+
+def server_shipments(simulator, wait=0):
+    # the requests the client gave up on are still being processed
+    time.sleep(wait)
+    return collections.Counter(shipment['reference'] for shipment in
+                               simulator.shipments.values())
+
+@pytest.mark.parametrize("policy", [
+    None,
+    RetryPolicy(max_attempts=1),
+    RetryPolicy(backoff=0.01),
+])
+def test_read_timeouts_dont_duplicate(parcel, origin, destination, service,
+                                      policy):
+    # every request, including the lookups, outlasts the read timeout
+    with Simulator(latency=0.3, seed=0) as simulator:
+        result = create(simulator, parcel, origin, destination, service,
+                        timeout=0.1, retry_policy=policy)
+        assert result.stats.failed == JOBS
+        created = server_shipments(simulator, wait=0.5)
+    assert sorted(created.values()) == [1] * JOBS
+    if policy is not None and policy.max_attempts > 1:
+        assert all(isinstance(error.error, OutcomeUnknown)
+                   for error in result.errors)
+
+def test_lost_responses_are_recovered(parcel, origin, destination, service):
+    with Simulator(lost_rate=0.5, seed=1) as simulator:
+        result = create(simulator, parcel, origin, destination, service,
+                        retry_policy=RetryPolicy(backoff=0.01))
+        created = server_shipments(simulator)
+    assert result.stats.created == JOBS
+    assert sorted(created.values()) == [1] * JOBS
+    assert set(shipment.id for shipment in result.shipments) == \
+        set(simulator.shipments)
+
+def test_pipeline_retries_go_through_the_policy(parcel, origin, destination,
+                                                service):
+    # the throttled requests are retried once by the policy, and not again
+    #  by the pipeline
+    with Simulator(throttle_rate=1, retry_after=0, seed=0) as simulator:
+        policy = RetryPolicy(max_attempts=2, backoff=0.01)
+        result = create(simulator, parcel, origin, destination, service,
+                        retry_policy=policy)
+        assert simulator.stats['requests'] == JOBS * 2
+    assert result.stats.failed == JOBS
+    assert result.stats.retries == JOBS
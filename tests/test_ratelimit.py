@@ -0,0 +1,79 @@
+"""
+Token buckets and the adaptive rate limiter
+"""
+import email.utils
+import time
+
+import pytest
+
+from canada_post.ratelimit import (TokenBucket, RateLimiter,
+                                   parse_retry_after)
+
+def test_bucket_spaces_callers():
+    bucket = TokenBucket(rate=10, burst=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+
+def test_throttling_halves_the_rate_once_per_hold():
+    limiter = RateLimiter(rate=10, backoff=0.5)
+    limiter.penalize()
+    assert limiter.rate == 5
+    # the requests that were in flight get throttled too
+    limiter.penalize()
+    limiter.update(429)
+    assert limiter.rate == 5
+    assert limiter.throttled == 3
+    assert limiter.available() == 0.0
+
+def test_rate_never_drops_below_min_rate():
+    limiter = RateLimiter(rate=10, min_rate=4, backoff=0)
+    for _ in range(3):
+        limiter.penalize()
+    assert limiter.rate == 4
+
+def test_successes_bring_the_rate_back():
+    limiter = RateLimiter(rate=10, increase=0.1, backoff=0)
+    limiter.penalize()
+    assert limiter.rate == 5
+    for _ in range(3):
+        limiter.update(200)
+    assert limiter.rate == pytest.approx(8)
+    for _ in range(10):
+        limiter.reward()
+    assert limiter.rate == 10
+
+def test_queued_callers_are_spaced_after_the_hold():
+    limiter = RateLimiter(rate=10, burst=5)
+    limiter.penalize(retry_after=1)
+    delays = [limiter.reserve() for _ in range(4)]
+    # none before the hold ends, then one every 1 / 5 seconds
+    assert delays[0] >= 1
+    gaps = [later - earlier for earlier, later in zip(delays, delays[1:])]
+    assert gaps == [pytest.approx(0.2, abs=0.01)] * 3
+
+def test_retry_after_extends_the_hold():
+    limiter = RateLimiter(rate=10)
+    limiter.update(503, "2")
+    assert limiter.reserve() > 1.9
+    limiter.penalize(retry_after=0.5)
+    # a shorter Retry-After doesn't shorten the hold
+    assert limiter.reserve() > 1.9
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("3", 3.0),
+    ("1.5", 1.5),
+    ("-4", 0.0),
+    ("soon", None),
+])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
+
+def test_parse_retry_after_date():
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert parse_retry_after(date) == pytest.approx(30, abs=2)
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert parse_retry_after(past) == 0.0
@@ -0,0 +1,153 @@
+"""
+RateTable building, lookups, refreshes and files
+"""
+import threading
+from decimal import Decimal
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from canada_post.ratetable import RateGrid, RateTable, PRICE_FIELDS
+from canada_post.service import Service
+from canada_post.util.address import Destination, Origin
+from canada_post.util.money import Price
+from canada_post.util.parcel import Parcel
+
+DUE = PRICE_FIELDS.index("due")
+
+class Rates(object):
+    """
+    A GetRates stand-in: Regular Parcel costs 10$ plus 1$ per kg, and
+    Xpresspost, only offered up to 1kg, 20$ plus 2$ per kg. Quotes to the
+    countries in `failing` raise
+    """
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, parcel, origin, destination):
+        with self._lock:
+            self.calls += 1
+        if destination.country_code in self.failing:
+            raise ValueError("No quote to {0}".format(
+                destination.country_code))
+        weight = Decimal(str(parcel.weight))
+        services = [self.service("DOM.RP", "Regular Parcel", 10 + weight)]
+        if weight <= 1:
+            services.append(self.service("DOM.XP", "Xpresspost",
+                                         20 + 2 * weight))
+        return services
+
+    def service(self, code, name, due):
+        return Service(data={'code': code, 'name': name,
+                             'price': Price(due=due, base=due)})
+
+def grid(**kwargs):
+    return RateGrid(origins=["H2B 1A0"],
+                    destinations=[Destination("CA", postal_code="K1A0B1"),
+                                  Destination("US", postal_code="10001")],
+                    weights=[4, 1, 2], **kwargs)
+
+def due(table, weight, origin, destination):
+    prices = table.lookup(Parcel(weight=weight), origin, destination)
+    return dict((code, prices[index][DUE])
+                for index, code in enumerate(table.services))
+
+def test_build():
+    rates = Rates()
+    table = RateTable.build(rates, grid(), workers=2)
+    assert rates.calls == 6
+    assert sorted(table.services) == ["DOM.RP", "DOM.XP"]
+    assert table.prices.shape == (1, 2, 1, 3, 2, len(PRICE_FIELDS))
+    assert (table.updated > 0).all()
+    assert table.names["DOM.XP"] == "Xpresspost"
+
+def test_weight_interpolation(origin, destination):
+    table = RateTable.build(Rates(), grid())
+    assert due(table, 1, origin, destination)["DOM.RP"] == 11
+    assert due(table, 1.5, origin, destination)["DOM.RP"] == 11.5
+    assert due(table, 3, origin, destination)["DOM.RP"] == 13
+    # below the first breakpoint, its prices
+    assert due(table, 0.2, origin, destination)["DOM.RP"] == 11
+    with pytest.raises(KeyError):
+        table.lookup(Parcel(weight=5), origin, destination)
+
+def test_services_not_offered(origin, destination):
+    table = RateTable.build(Rates(), grid())
+    assert due(table, 1, origin, destination)["DOM.XP"] == 22
+    assert numpy.isnan(due(table, 2, origin, destination)["DOM.XP"])
+    # nor between a breakpoint where it is and one where it isn't
+    assert numpy.isnan(due(table, 1.5, origin, destination)["DOM.XP"])
+    assert [service.code for service in
+            table.estimate(Parcel(weight=1), origin, destination)] == \
+        ["DOM.RP", "DOM.XP"]
+    services = table.estimate(Parcel(weight=1.5), origin, destination)
+    assert [service.code for service in services] == ["DOM.RP"]
+    assert services[0].price.due == Decimal("11.50")
+    assert services[0].name == "Regular Parcel"
+
+def test_destinations(origin):
+    table = RateTable.build(Rates(), grid())
+    # other postal codes of a country in the grid use its first destination
+    assert due(table, 1, origin, Destination("CA", postal_code="V6B1A1")) \
+        == due(table, 1, origin, Destination("CA", postal_code="K1A0B1"))
+    with pytest.raises(KeyError):
+        table.lookup(Parcel(weight=1), origin,
+                     Destination("FR", postal_code=""))
+    with pytest.raises(KeyError):
+        table.lookup(Parcel(weight=1), Origin(postal_code="V6B1A1"),
+                     Destination("CA", postal_code="K1A0B1"))
+
+def test_dimension_brackets(origin, destination):
+    table = RateTable.build(Rates(), grid(dimensions=[(100, 50, 50),
+                                                       (20, 30, 10)]))
+    assert table.grid.dimensions == [(30, 20, 10), (100, 50, 50)]
+    # rated with the smallest bracket it fits in, whichever way it's laid
+    assert due(table, 1, origin, destination)["DOM.RP"] == 11
+    table.prices[0, 0, 1] += 5
+    large = Parcel(weight=1, length=10, width=40, height=10)
+    assert table.lookup(large, origin, destination)[0][DUE] == 16
+    with pytest.raises(KeyError):
+        table.lookup(Parcel(weight=1, length=120, width=10, height=10),
+                     origin, destination)
+
+def test_partial_refresh(origin, destination):
+    us = Destination("US", postal_code="10001")
+    rates = Rates(failing=["US"])
+    table = RateTable(grid())
+    assert table.refresh(rates) == (3, 3)
+    assert numpy.isnan(table.lookup(Parcel(weight=1), origin, us)).all()
+    # the failed cells are still stale, the others aren't
+    assert table.stale(max_age=3600) == [(0, 1, 0, 0), (0, 1, 0, 1),
+                                          (0, 1, 0, 2)]
+    rates.failing.clear()
+    rates.calls = 0
+    assert table.refresh(rates, max_age=3600) == (3, 0)
+    assert rates.calls == 3
+    assert due(table, 2, origin, us)["DOM.RP"] == 12
+    assert table.stale(max_age=3600) == []
+    # refreshing a destination only quotes its cells
+    rates.calls = 0
+    assert table.refresh(rates, destinations=["CA:K1A"]) == (3, 0)
+    assert rates.calls == 3
+
+def test_save_and_load(tmp_path, origin, destination):
+    table = RateTable.build(Rates(failing=["US"]), grid(
+        dimensions=[(30, 20, 10)]))
+    path = str(tmp_path / "rates.npz")
+    table.save(path)
+    loaded = RateTable.load(path)
+    assert loaded.services == table.services
+    assert loaded.names == table.names
+    assert loaded.grid.as_dict() == table.grid.as_dict()
+    numpy.testing.assert_array_equal(loaded.prices, table.prices)
+    numpy.testing.assert_array_equal(loaded.updated, table.updated)
+    parcel = Parcel(weight=1.5, length=10, width=10, height=10)
+    assert [(service.code, service.price.due) for service in
+            loaded.estimate(parcel, origin, destination)] == \
+        [(service.code, service.price.due) for service in
+         table.estimate(parcel, origin, destination)]
+    # and it can be refreshed
+    assert loaded.stale(max_age=3600) == table.stale(max_age=3600)
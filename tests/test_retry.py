@@ -0,0 +1,28 @@
+from canada_post.retry import RetryPolicy, RetryStats
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_failed_responses_are_closed_before_retrying():
+    responses = [FakeResponse(503), FakeResponse(500), FakeResponse(200)]
+    sent = iter(responses)
+    stats = RetryStats()
+    policy = RetryPolicy(max_attempts=3, backoff=0)
+    response = policy.run(lambda: next(sent), stats=stats)
+    assert response is responses[-1]
+    assert [r.closed for r in responses] == [True, True, False]
+    assert stats.retries == 2
+
+def test_last_response_is_returned_open():
+    responses = [FakeResponse(503), FakeResponse(503)]
+    sent = iter(responses)
+    response = RetryPolicy(max_attempts=2, backoff=0).run(lambda: next(sent))
+    assert response is responses[-1]
+    assert not response.closed
+    assert responses[0].closed
@@ -0,0 +1,42 @@
+"""
+The services of a CanadaPostAPI share one keep-alive session
+"""
+from canada_post.api import CanadaPostAPI
+from canada_post.simulator import Simulator
+
+CALLS = 10
+
+def api(simulator, **kwargs):
+    return simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                           "42708517", **kwargs))
+
+def test_sequential_calls_share_one_connection(parcel, origin, destination,
+                                               service):
+    with Simulator(seed=0) as simulator:
+        cpa = api(simulator)
+        for _ in range(CALLS):
+            cpa.get_rates(parcel, origin, destination)
+        shipment = cpa.create_shipment(parcel, origin, destination, service,
+                                       "group")
+        cpa.void_shipment(shipment)
+        cpa.close()
+        assert simulator.stats['requests'] == CALLS + 2
+        assert simulator.stats['connections'] == 1
+
+def test_services_share_the_session():
+    cpa = CanadaPostAPI("1234567", "user", "pass")
+    assert all(service.session is cpa.session for service in cpa.services())
+
+def test_without_keep_alive_every_call_connects(parcel, origin, destination):
+    with Simulator(seed=0) as simulator:
+        cpa = api(simulator, keep_alive=False)
+        for _ in range(CALLS):
+            cpa.get_rates(parcel, origin, destination)
+        # no connection was kept for reuse
+        adapter = cpa.session.get_adapter(cpa.get_rates.get_url())
+        pools = [adapter.poolmanager.pools[key]
+                 for key in adapter.poolmanager.pools.keys()]
+        assert pools and all(conn is None for pool in pools
+                             for conn in list(pool.pool.queue))
+        cpa.close()
+        assert simulator.stats['connections'] == CALLS
@@ -0,0 +1,87 @@
+"""
+ShipmentStore, and the services writing to it
+"""
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from canada_post.api import CanadaPostAPI
+from canada_post.service.contract_shipping import Shipment
+from canada_post.simulator import Simulator
+from canada_post.store import ShipmentStore
+
+JOBS = 3
+
+class BrokenStore(object):
+    """
+    A store whose every write fails
+    """
+    def add(self, shipment, group=None, reference=None):
+        raise sqlite3.OperationalError("no such table: shipments")
+
+    def set_status(self, shipment_ids, status):
+        raise sqlite3.OperationalError("no such table: shipments")
+
+def jobs(parcel, origin, destination, service):
+    return [(parcel, origin, destination, service, "group",
+             "ref{0}".format(index)) for index in range(JOBS)]
+
+def test_store_failure_doesnt_fail_the_shipment(parcel, origin, destination,
+                                                 service):
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI(
+            "1234567", "user", "pass", "42708517",
+            shipment_store=BrokenStore()))
+        result = cpa.create_shipments(jobs(parcel, origin, destination,
+                                           service))
+        assert not result.errors
+        assert len(simulator.shipments) == JOBS
+        assert cpa.void_shipment(result.shipments[0])
+        cpa.close()
+
+def test_async_store_failure_doesnt_fail_the_shipment(parcel, origin,
+                                                       destination, service):
+    pytest.importorskip("aiohttp")
+    from canada_post.aio import AsyncCanadaPostAPI
+
+    async def main(simulator):
+        async with simulator.install(AsyncCanadaPostAPI(
+                "1234567", "user", "pass", "42708517",
+                shipment_store=BrokenStore())) as cpa:
+            shipment = await cpa.create_shipment(parcel, origin, destination,
+                                                 service, "group")
+            return await cpa.void_shipment(shipment)
+
+    with Simulator(seed=0) as simulator:
+        assert asyncio.new_event_loop().run_until_complete(main(simulator))
+        assert len(simulator.shipments) == 1
+
+def test_memory_store_shared_by_threads(parcel, origin, destination,
+                                        service):
+    store = ShipmentStore(":memory:")
+    with Simulator(seed=0) as simulator:
+        cpa = simulator.install(CanadaPostAPI(
+            "1234567", "user", "pass", "42708517", shipment_store=store))
+        result = cpa.create_shipments(jobs(parcel, origin, destination,
+                                           service), workers=JOBS)
+        assert not result.errors
+        cpa.close()
+    assert len(store) == JOBS
+    assert sorted(shipment.id for shipment in store.by_group("group")) == \
+        sorted(simulator.shipments)
+
+def test_memory_store_concurrent_writes():
+    store = ShipmentStore(":memory:")
+
+    def add(start):
+        for index in range(start, start + 50):
+            store.add(Shipment(id=str(index), status="created"), "group")
+    threads = [threading.Thread(target=add, args=(start,))
+               for start in range(0, 400, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store) == 400
@@ -0,0 +1,126 @@
+"""
+The precompiled request templates must render exactly what the lxml tree
+builders they replaced serialized
+"""
+from decimal import Decimal
+
+import pytest
+from lxml import etree
+
+from benchmarks.templates import (legacy_rates_request,
+                                  legacy_shipment_request, scenarios,
+                                  SERVICES)
+from canada_post.service.contract_shipping import CreateShipment
+from canada_post.service.rating import GetRates, rate_options, scenario_key
+from canada_post.service.template import (Template, Element, Text, Const, If,
+                                          Each, escape)
+
+SCENARIOS = list(scenarios())
+
+def _id(scenario):
+    auth, parcel, origin, destination = scenario
+    return "{0}-{1}-{2}-{3}".format(auth.dev, parcel.weight,
+                                    origin.postal_code,
+                                    destination.country_code)
+
+@pytest.mark.parametrize("scenario", SCENARIOS, ids=_id)
+def test_rates_request(scenario):
+    auth, parcel, origin, destination = scenario
+    assert GetRates(auth).build_request(parcel, origin, destination) == \
+        legacy_rates_request(auth, parcel, origin, destination)
+
+@pytest.mark.parametrize("scenario", [scenario for scenario in SCENARIOS
+                                      if scenario[0].contract_number],
+                         ids=_id)
+def test_shipment_request(scenario):
+    auth, parcel, origin, destination = scenario
+    service = SERVICES[destination.country_code]
+    assert CreateShipment(auth).build_request(
+        parcel, origin, destination, service, "grp") == \
+        legacy_shipment_request(auth, parcel, origin, destination, service,
+                                "grp")
+
+def test_rates_request_with_services_and_options():
+    auth, parcel, origin, destination = SCENARIOS[0]
+    options = (b'<options><option><option-code>COV</option-code>'
+               b'<option-amount>100.50</option-amount></option>'
+               b'<option><option-code>SO</option-code></option></options>')
+    services = (b'<services><service-code>DOM.EP</service-code>'
+                b'<service-code>DOM.XP</service-code></services>')
+    request = GetRates(auth).build_request(
+        parcel, origin, destination, services=["DOM.EP", "DOM.XP"],
+        options=[("COV", Decimal("100.50")), "SO"])
+    assert options + b"<parcel-characteristics>" in request
+    assert services + b"<origin-postal-code>" in request
+    # and the rest of the request is unchanged
+    assert request.replace(options, b"").replace(services, b"") == \
+        legacy_rates_request(auth, parcel, origin, destination)
+
+@pytest.mark.parametrize("options, expected", [
+    (None, []),
+    ([], []),
+    ({}, []),
+    (["SO", "DNS"], [("SO", None), ("DNS", None)]),
+    ({"COV": 100}, [("COV", 100)]),
+    (["SO", ("COV", 100)], [("SO", None), ("COV", 100)]),
+])
+def test_rate_options(options, expected):
+    assert rate_options(options) == expected
+
+def test_scenario_key_filters():
+    auth, parcel, origin, destination = SCENARIOS[0]
+
+    def key(services=None, options=None):
+        return scenario_key(auth, parcel, origin, destination, services,
+                            options)
+    # the keys of unfiltered quotes have no suffix
+    assert key() == key([], {})
+    assert key().count("|") == 8
+    assert key(["DOM.XP", "DOM.EP"]) == key(["DOM.EP", "DOM.XP"])
+    assert key(["DOM.EP"]) != key()
+    assert key(options=["SO"]) == key(options={"SO": None})
+    assert key(options={"COV": 100, "SO": None}) == \
+        key(options=["SO", ("COV", Decimal("100.00"))])
+    assert key(options={"COV": 100}) != key(options={"COV": 200})
+    assert key(["SO"]) != key(options=["SO"])
+
+def _lxml_text(value):
+    element = etree.Element("a")
+    element.text = value
+    return etree.tostring(element)
+
+@pytest.mark.parametrize("value", [
+    u"plain",
+    u"Ren\xe9e & Co <shipping>",
+    u"a > b",
+    u"Widgets\r\nInc",
+    u"\xc9lodie \u2603 \U0001f4e6",
+    u"tab\tand quote \" '",
+    u"",
+])
+def test_text_matches_lxml(value):
+    template = Template(Text("a", "value"))
+    assert template.render({'value': value}) == _lxml_text(value)
+
+@pytest.mark.parametrize("value", [u"nul\x00", u"bell\x07", u"\ufffe"])
+def test_invalid_characters_are_refused(value):
+    with pytest.raises(ValueError):
+        escape(value)
+    with pytest.raises(ValueError):
+        _lxml_text(value)
+
+def test_nodes():
+    template = Template(Element(
+        "root",
+        Const("fixed", u"x & y"),
+        Text("empty", "none"),
+        If("flag", Text("shown", "text")),
+        Element("optional", If("missing", Const("never", "n"))),
+        Each("items", Text("item", "name")),
+        xmlns="urn:test"))
+    assert template.render({
+        'none': None, 'flag': True, 'text': u"\xe9", 'missing': False,
+        'items': [{'name': "a"}, {'name': "b"}],
+    }) == (b'<root xmlns="urn:test"><fixed>x &amp; y</fixed><empty/>'
+           b'<shown>&#233;</shown><optional/><item>a</item><item>b</item>'
+           b'</root>')
@@ -0,0 +1,125 @@
+"""
+Local validation of shipments, and the errors reported per job
+"""
+import pytest
+
+from canada_post import Auth
+from canada_post.api import CanadaPostAPI
+from canada_post.service import Service
+from canada_post.service.contract_shipping import CreateShipment
+from canada_post.util.address import Destination, Origin, split_address
+from canada_post.util.parcel import Parcel
+from canada_post.validation import (ValidationError, validate_shipment,
+                                    validate_shipments)
+
+LONG = "1234 Boulevard du Sacre-Coeur, Appartement 56, Pavillon " \
+       "Est, Batiment C, Bureau 7890 Sous-sol"
+
+def codes(errors):
+    return sorted((error.field, error.code) for error in errors)
+
+def test_valid(parcel, origin, destination, service):
+    assert validate_shipment(parcel, origin, destination, service,
+                             "42708517") == []
+
+@pytest.mark.parametrize("address, lines", [
+    ("1 Wellington St", ("1 Wellington St", "")),
+    # up to 44 characters, not split
+    ("x" * 40 + " abc", ("x" * 40 + " abc", "")),
+    ("x" * 40 + " abcdef", ("x" * 40, "abcdef")),
+    # no space to split at
+    ("x" * 50, ("x" * 44, "x" * 6)),
+    (("line 1", "line 2"), ("line 1", "line 2")),
+])
+def test_split_address(address, lines):
+    assert split_address(address) == lines
+
+def test_long_fields_are_reported_not_raised(parcel, origin, service):
+    # the constructor accepts them, so that they're reported with the rest
+    destination = Destination("CA", postal_code="K1A0B1", name="Jo",
+                              address=LONG * 2, city="C" * 41,
+                              province="ON")
+    lines = Destination("CA", postal_code="K1A0B1", name="Jo",
+                        address=("a" * 45, "b"), city="Ottawa",
+                        province="ON")
+    assert codes(validate_shipment(parcel, origin, destination, service)) == [
+        ("destination.address2", "length"), ("destination.city", "length")]
+    assert codes(validate_shipment(parcel, origin, lines, service)) == [
+        ("destination.address1", "length")]
+
+def test_required_fields(parcel, service):
+    origin = Origin(postal_code="H2B1A0")
+    destination = Destination("CA", postal_code="")
+    assert codes(validate_shipment(parcel, origin, destination, service,
+                                   "")) == [
+        ("contract_number", "required"),
+        ("destination.address", "required"),
+        ("destination.postal_code", "required"),
+        ("destination.province", "required"),
+        ("origin.address", "required"),
+        ("origin.city", "required"),
+        ("origin.company", "required"),
+        ("origin.phone", "required"),
+        ("origin.province", "required"),
+    ]
+
+@pytest.mark.parametrize("country, postal_code, valid", [
+    ("CA", "K1A 0B1", True),
+    ("CA", "k1a0b1", True),
+    ("CA", "D1A0B1", False),
+    ("US", "90210", True),
+    ("US", "90210-1234", True),
+    ("US", "9021", False),
+    ("FR", "75001", True),
+])
+def test_postal_codes(parcel, origin, country, postal_code, valid):
+    destination = Destination(country, postal_code=postal_code, name="Jo",
+                              phone="555 0100", address="1 Main St",
+                              city="Somewhere", province="XX")
+    service = Service(data={'code': {"CA": "DOM.EP", "US": "USA.EP"}.get(
+        country, "INT.XP")})
+    errors = codes(validate_shipment(parcel, origin, destination, service))
+    assert (("destination.postal_code", "format") not in errors) is valid
+
+def test_service_rules(origin, destination):
+    us = Destination("US", postal_code="90210", name="Jo",
+                     address="1 Main St", city="Beverly Hills",
+                     province="CA")
+    heavy = Parcel(weight=31, length=210, width=50, height=50)
+    assert codes(validate_shipment(heavy, origin, us, Service(
+        data={'code': "USA.EP"}))) == [
+        ("destination.phone", "required"),
+        ("parcel", "limit"), ("parcel.length", "limit"),
+        ("parcel.weight", "limit")]
+    assert codes(validate_shipment(Parcel(weight=1), origin, destination,
+                                   Service(data={'code': "USA.EP"}))) == [
+        ("service", "service")]
+    assert codes(validate_shipment(Parcel(weight="heavy"), origin,
+                                   destination,
+                                   Service(data={'code': "DOM.EP"}))) == [
+        ("parcel", "format")]
+
+def test_request_raises_validation_error(parcel, origin, service):
+    create = CreateShipment(Auth("1234567", "user", "pass", "42708517"))
+    destination = Destination("CA", postal_code="K1A0B1", name="Jo",
+                              address=LONG * 2, city="Ottawa", province="ON")
+    with pytest.raises(ValidationError) as error:
+        create.build_request(parcel, origin, destination, service, "group")
+    assert isinstance(error.value, ValueError)
+    assert codes(error.value.errors) == [("destination.address2", "length")]
+
+def test_batch_reports_address_errors_per_job(parcel, origin, destination,
+                                              service):
+    bad = Destination("CA", postal_code="K1A0B1", name="Jo",
+                      address=LONG * 2, city="C" * 41, province="ON")
+    jobs = [(parcel, origin, destination, service, "group"),
+            (parcel, origin, bad, service, "group")]
+    assert [codes(errors) for errors in validate_shipments(jobs)] == [
+        [], [("destination.address2", "length"),
+             ("destination.city", "length")]]
+
+    # the pipeline reports it and never sends it
+    cpa = CanadaPostAPI("1234567", "user", "pass", "42708517")
+    result = cpa.create_shipments(jobs[1:])
+    assert result.stats.invalid == 1
+    assert isinstance(result.errors[0].error, ValidationError)
@@ -0,0 +1,97 @@
+"""
+VoidShipment.void and void_many against the Simulator
+"""
+import pytest
+import requests
+
+from canada_post.api import CanadaPostAPI
+from canada_post.retry import RetryPolicy
+from canada_post.simulator import Simulator
+
+def client(simulator, **kwargs):
+    return simulator.install(CanadaPostAPI("1234567", "user", "pass",
+                                           "42708517", **kwargs))
+
+def create(cpa, parcel, origin, destination, service, count):
+    result = cpa.create_shipments([
+        (parcel, origin, destination, service, "group",
+         "ref{0}".format(index)) for index in range(count)])
+    assert not result.errors
+    return result.shipments
+
+def fail_first_void(simulator, *shipments):
+    """
+    Answer the first DELETE of each of the shipments with a 500 without
+    processing it, so that it's retried
+    """
+    method, pattern, handler = [route for route in simulator.routes
+                                if route[0] == 'DELETE'][0]
+    failing = set(shipment.id for shipment in shipments)
+
+    def fail_once(request, body, **kwargs):
+        if kwargs['id'] in failing:
+            failing.discard(kwargs['id'])
+            return request._respond(500)
+        return handler(request, body, **kwargs)
+    simulator.routes.insert(0, (method, pattern, fail_once))
+
+def test_void(parcel, origin, destination, service):
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator)
+        shipment, = create(cpa, parcel, origin, destination, service, 1)
+        assert cpa.void_shipment.void(shipment) is True
+        assert simulator.shipments[shipment.id]['status'] == "cancelled"
+        # voiding it again finds it voided
+        assert cpa.void_shipment.void(shipment) is False
+        cpa.close()
+
+def test_void_of_an_unknown_shipment_fails(parcel, origin, destination,
+                                           service):
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator)
+        shipment, = create(cpa, parcel, origin, destination, service, 1)
+        del simulator.shipments[shipment.id]
+        with pytest.raises(requests.HTTPError) as error:
+            cpa.void_shipment.void(shipment)
+        assert error.value.response.status_code == 404
+        cpa.close()
+
+def test_void_retried_after_a_lost_response(parcel, origin, destination,
+                                            service):
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, retry_policy=RetryPolicy(backoff=0))
+        shipment, = create(cpa, parcel, origin, destination, service, 1)
+        # voided, but answered with a 500: the retry gets a 404
+        simulator.lost_rate = 1
+        assert cpa.void_shipment.void(shipment) is True
+        assert simulator.shipments[shipment.id]['status'] == "cancelled"
+        assert cpa.void_shipment.retry_stats.retries == 1
+        cpa.close()
+
+def test_retried_void_of_an_unknown_shipment_fails(parcel, origin,
+                                                   destination, service):
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, retry_policy=RetryPolicy(backoff=0))
+        shipment, = create(cpa, parcel, origin, destination, service, 1)
+        del simulator.shipments[shipment.id]
+        # the 404 of the retry isn't from a previous attempt going through
+        fail_first_void(simulator, shipment)
+        with pytest.raises(requests.HTTPError):
+            cpa.void_shipment.void(shipment)
+        cpa.close()
+
+def test_void_shipments(parcel, origin, destination, service):
+    with Simulator(seed=0) as simulator:
+        cpa = client(simulator, retry_policy=RetryPolicy(backoff=0))
+        shipments = create(cpa, parcel, origin, destination, service, 6)
+        assert cpa.void_shipment.void(shipments[0])
+        del simulator.shipments[shipments[1].id]
+        fail_first_void(simulator, shipments[1], shipments[2])
+        result = cpa.void_shipments(shipments, workers=3)
+        assert (result.voided, result.already_voided, result.failed) == \
+            (4, 1, 1)
+        assert not result.ok
+        assert [error.index for error in result.errors] == [1]
+        assert [shipment['status'] for shipment in
+                simulator.shipments.values()] == ["cancelled"] * 5
+        cpa.close()